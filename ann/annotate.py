@@ -10,8 +10,14 @@
 ##
 __author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
 
+import threading
+from bisect import bisect_right
 import file_utils as fu
 import utils as u
+import pipeline
+import intervals
+import backends
+from records import Record, withChrPrefix, withoutChrPrefix, clean_mysql_chars
 
 indicesKnownGenes=[12, 1, 3] #12 for gene
 
@@ -72,14 +78,9 @@ def binarySearchUniqueAndSorted(arg0, key):
     return -1 # NOT_FOUND
 
 
-"""Cleans characters not accepted by MySQL
+"""Columns of the chromosome, position, reference and alternate allele
+   in a line of the given input format
 """
-def clean_mysql_chars(entry):
-    entry = entry.replace("\"", "")
-    entry = entry.replace("\'", "")
-    return str(entry)
-
-
 def getFormatSpecificIndices(format='vcf'):
     chr_ind = 0
     pos_ind = 1
@@ -107,1297 +108,1272 @@ def getComplementary(nuc):
         return compNuc
 
 
-""""Format must be pileup or vcf
-    Types of variants in dbSNP135: DIV, SNV, MNV, MIXED
-""" 
-def getSnpsFromDbSnp(vcf, format='vcf', tmpextin='', tmpextout='.1',
-    varclass='SNV', sep='\t'):
-    
-    outfile = vcf + tmpextout
-    fh_out = open(outfile, "w")
-    logcountfile = vcf + '.count.log'
-    fh_log = open(logcountfile, 'w')
-    var_count = 0
-
-    inds = getFormatSpecificIndices(format=format)
-
-    fh = open(vcf)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        if not line.startswith("#"):
-            fields = line.split(sep)
-            chr = fields[inds[0]].strip()
-            if chr.startswith("chr"):
-                chr = chr.replace('chr', '')
-
-            pos = fields[inds[1]].strip()
-            ref = clean_mysql_chars(fields[inds[2]]).strip()
-            alt = clean_mysql_chars(fields[inds[3]]).strip()
-
-            compRef = getComplementary(ref)
-            compAlt = getComplementary(alt)
-
-            sql = 'select * from dbSNP where CHR="' + str(chr) + \
-                '" AND POS=' + str(pos) + ' AND ( REF="' + str(ref) + \
-                '" OR REF ="' + str(compRef) + '" )  AND INFO = "' + \
-                varclass + '" ;'
-            cursor.execute(sql)
-            rows = cursor.fetchall()
-
-            fields[2] = '.'
-            rsids = []
-            mafs = []
-            if (len(rows) > 0):
-                for row in rows:
-                    rsids.append(str(row[3]))
-                    if (str(row[7]) != '.'):
-                        mafs.append('GMAF=' + str(row[7]))
-
-                maf_str=''
-                if (len(mafs) > 0):
-                    maf_str = ';' + ';'.join([str(x) for x in mafs])
-
-                var_count = var_count + 1
-                if (str(fields[7]) == '.'):
-                    fields[7] = 'DB' + maf_str
-                else:
-                    fields[7] = fields[7] + ';DB;VC=' + varclass + maf_str
+"""Column indices of POS and REF among the dbSNP column names
+"""
+def getDbSnpColumnIndices(names):
+    names = [str(n).upper() for n in names]
+    return [names.index('POS'), names.index('REF')]
 
-                fields[2] = str(';'.join(rsids))
-                l = '\t'.join([str(x) for x in fields])
-                fh_out.write(l + '\n')
 
-            else:
-                ## reset rsid to "." - in case there was annotation from old release of dbSNP
-                fh_out.write('\t'.join([str(x) for x in fields]) + '\n')
+"""Resolves a window of variants against dbSNP with one query per chromosome
+   Returns the matching rows for each variant, in window order
+"""
+def lookupDbSnpBatch(backend, cursor, variants, varclass='SNV'):
+    by_chr = {}
+    for (chr, pos, ref, alt) in variants:
+        by_chr.setdefault(chr, set()).add(int(pos))
+
+    hits = {}
+    for chr in by_chr:
+        rows = backend.pointLookup(cursor, 'dbSNP', {'CHR': str(chr), 
+            'INFO': varclass, 'POS': sorted(by_chr[chr])})
+        if (len(rows) > 0):
+            pos_ind, ref_ind = getDbSnpColumnIndices(
+                backend.columns(cursor, 'dbSNP'))
+            for row in rows:
+                hits.setdefault((chr, int(row[pos_ind])), []).append(
+                    (str(row[ref_ind]).upper(), row))
+
+    results = []
+    for (chr, pos, ref, alt) in variants:
+        refs = [str(ref).upper(), str(getComplementary(ref)).upper()]
+        results.append([row for (r, row) in hits.get((chr, int(pos)), [])
+            if r in refs])
+    return results
+
+
+"""Resolves a window of variants against the three bigRefGene tiers
+   (exact base change, position only, covering range) with one query per
+   chromosome and tier in the window. Each variant takes the rows of the 
+   first tier that has any, as the per-variant lookup does; None if no 
+   tier matches.
+"""
+def lookupRefSeqBatch(backend, cursor, variants):
+    results = [None] * len(variants)
+    by_chr = {}
+    for (i, (chr, pos, ref, alt)) in enumerate(variants):
+        by_chr.setdefault(chr, []).append(i)
+
+    for chr in by_chr:
+        # Tier 1: same position and base change, on either strand
+        pending = by_chr[chr]
+        rows = queryRefSeqPositions(backend, cursor, 'chrom_pos_equal_base', 
+            chr, [variants[i][1] for i in pending])
+        if (len(rows) > 0):
+            names = backend.columns(cursor, 'chrom_pos_equal_base')
+            (start_ind, ref_ind, alt_ind) = (names.index('start'), 
+                names.index('haplotypeReference'), 
+                names.index('haplotypeAlternate'))
+            for i in pending:
+                (chr, pos, ref, alt) = variants[i]
+                changes = [(str(ref).upper(), str(alt).upper()), 
+                    (str(getComplementary(ref)).upper(), 
+                    str(getComplementary(alt)).upper())]
+                hits = [row for row in rows 
+                    if (int(row[start_ind]) == int(pos)) and 
+                    ((str(row[ref_ind]).upper(), 
+                    str(row[alt_ind]).upper()) in changes)]
+                if (len(hits) > 0):
+                    results[i] = list(collapseRefSeqRows(hits))
+
+        # Tier 2: same position
+        pending = [i for i in pending if results[i] is None]
+        rows = queryRefSeqPositions(backend, cursor, 'chrom_pos_equal_nobase',
+            chr, [variants[i][1] for i in pending])
+        if (len(rows) > 0):
+            start_ind = backend.columns(cursor, 
+                'chrom_pos_equal_nobase').index('start')
+            by_pos = {}
+            for row in rows:
+                by_pos.setdefault(int(row[start_ind]), []).append(row)
+            for i in pending:
+                hits = by_pos.get(int(variants[i][1]), [])
+                if (len(hits) > 0):
+                    results[i] = list(collapseRefSeqRows(hits))
+
+        # Tier 3: ranges covering any of the remaining positions, 
+        # resolved locally
+        pending = [i for i in pending if results[i] is None]
+        rows = backend.coverQuery(cursor, 'chrom_pos_unequal', str(chr), 
+            [variants[i][1] for i in pending], chromName='CHR', 
+            startName='start', endName='end')
+        if (len(rows) > 0):
+            names = backend.columns(cursor, 'chrom_pos_unequal')
+            index = intervals.IntervalIndex(rows, names.index('CHR'),
+                names.index('start'), names.index('end'))
+            for i in pending:
+                hits = index.overlap(str(chr), int(variants[i][1]))
+                if (len(hits) > 0):
+                    results[i] = list(collapseRefSeqRows(hits))
+    return results
+
+
+"""Matching rows of each variant in index, a snapshot table over dbSNP
+   positions, with the same matching as lookupDbSnpBatch()
+"""
+def lookupDbSnpIndex(index, variants, varclass='SNV'):
+    names = [str(n).upper() for n in index.names]
+    (ref_ind, info_ind) = (names.index('REF'), names.index('INFO'))
+    results = []
+    for (chr, pos, ref, alt) in variants:
+        refs = [str(ref).upper(), str(getComplementary(ref)).upper()]
+        results.append([row for row in index.overlap(chr, pos) 
+            if (str(row[ref_ind]).upper() in refs) and 
+            (str(row[info_ind]).upper() == varclass.upper())])
+    return results
+
+
+"""Resolves a variant against snapshot tables of the three bigRefGene
+   tiers, taking the rows of the first tier that has any
+"""
+def lookupRefSeqIndex(indexes, variant):
+    (chr, pos, ref, alt) = variant
+    (base, nobase, unequal) = indexes
+    (ref_ind, alt_ind) = (base.names.index('haplotypeReference'), 
+        base.names.index('haplotypeAlternate'))
+    changes = [(str(ref).upper(), str(alt).upper()), 
+        (str(getComplementary(ref)).upper(), 
+        str(getComplementary(alt)).upper())]
+
+    rows = [row for row in base.overlap(chr, pos) 
+        if (str(row[ref_ind]).upper(), str(row[alt_ind]).upper()) in changes]
+    if (len(rows) == 0):
+        rows = nobase.overlap(chr, pos)
+    if (len(rows) == 0):
+        rows = unequal.overlap(chr, pos)
+    if (len(rows) > 0):
+        return list(collapseRefSeqRows(rows))
+    return None
+
+
+def queryRefSeqPositions(backend, cursor, table, chr, positions):
+    if (len(positions) == 0):
+        return []
+    return backend.pointLookup(cursor, table, {'CHR': str(chr), 
+        'start': sorted(set([int(p) for p in positions]))})
+
+
+"""(chr, pos, ref, alt) key used by the dbSNP and bigRefGene lookups
+"""
+def getVariantKey(record):
+    return (record.chrom_nochr, record.pos, record.ref, record.alt)
 
-            linenum = linenum + 1
 
-        else:
-            fh_out.write(line + '\n')
+"""Collapses bigRefGene rows into a set of INFO fragments
+"""
+def collapseRefSeqRows(rows):
+    m = set([])
+    for row in rows:
+        m.add(collapseRefSeq('\t'.join([str(x) for x in row[1:len(row)]])))
+    return m
+
+
+"""refGene transcript with its exon boundaries parsed into integers
+"""
+class Transcript(object):
+
+    def __init__(self, row):
+        self.row = row
+        self.strand = str(row[3])
+        self.txStart = int(row[4])
+        self.txEnd = int(row[5])
+        self.cdsStart = int(row[6])
+        self.cdsEnd = int(row[7])
+        self.exonCount = int(row[8])
+        exonsSt = str(row[9].decode('utf-8')).split(',')
+        exonsEn = str(row[10].decode('utf-8')).split(',')
+        self.exonStarts = [int(exonsSt[e]) for e in range(self.exonCount)]
+        self.exonEnds = [int(exonsEn[e]) for e in range(self.exonCount)]
+        # Exons that are sorted and disjoint hold pos in at most one exon
+        self.disjoint = all([self.exonEnds[e] < self.exonStarts[e + 1] 
+            for e in range(self.exonCount - 1)])
+
+    """Indices of the exons containing pos, in exon order
+    """
+    def exonHits(self, pos):
+        if not self.disjoint:
+            return [e for e in range(self.exonCount) 
+                if u.isBetween(pos, self.exonStarts[e], self.exonEnds[e])]
+        e = bisect_right(self.exonStarts, pos) - 1
+        if (e >= 0) and (pos <= self.exonEnds[e]):
+            return [e]
+        return []
+
+    """Exon number as reported in INFO, counted from the 5' end
+    """
+    def exonNumber(self, e):
+        if (self.strand == '-'):
+            return self.exonCount - e
+        return e + 1
+
+
+# Transcript indexes loaded so far in this process, by table and offset
+transcript_indexes = {}
+
+"""Loads all transcripts of a gene table into an interval index over
+   their spans widened by the promoter offset, once per process
+   Hits come back in table order, as the range query returns them
+   rows, when given, are the table's rows read from somewhere else
+"""
+def getTranscriptIndex(cursor, table, promoter_offset, rows=None):
+    key = (table, promoter_offset)
+    if key not in transcript_indexes:
+        if rows is None:
+            (names, rows) = backends.getBackend().scanInOrder(cursor, table)
+        transcripts = [Transcript(row) for row in rows]
+        transcript_indexes[key] = intervals.IntervalIndex(
+            [(str(t.row[2]), t.txStart - promoter_offset, 
+            t.txEnd + promoter_offset, t) for t in transcripts], 0, 1, 2)
+    return transcript_indexes[key]
+
+
+"""Base class for annotation stages
+
+   A stage annotates one VCF data record at a time: key() picks out what
+   the stage looks up, lookup() resolves that key against the reference
+   database and apply() folds the result into the record and the stage
+   counters. lookup() only depends on the key, so a window of keys can
+   be resolved at once through lookupBatch().
+
+   after names the stages whose annotations apply() reads; a stage is
+   only run once those stages have annotated the records.
+"""
+class Annotator(object):
+    name = ''
+    after = []
+    # Guards the counters lookups update, for stages whose lookups run on 
+    # several threads at once
+    counts_lock = threading.Lock()
+
+    def __init__(self, cursor, format='vcf', sep='\t'):
+        self.cursor = cursor
+        self.backend = backends.getBackend()
+        self.inds = getFormatSpecificIndices(format=format)
+        self.sep = sep
+        self.counts = {}
+        self.cache = None
+        self.cache_name = self.__class__.__name__
+
+    def isHeader(self, line):
+        return line.startswith('##') or line.startswith('#CHROM') or \
+            line.startswith('CHROM')
+
+    def key(self, record):
+        raise NotImplementedError
+
+    def lookup(self, key):
+        raise NotImplementedError
+
+    def lookupBatch(self, keys):
+        return [self.lookup(key) for key in keys]
+
+    """lookupBatch() through the result cache, when the stage has one
+    """
+    def lookupCached(self, keys):
+        if self.cache is None:
+            return self.lookupBatch(keys)
+
+        found = self.cache.get(self.cache_name, keys)
+        missing = [i for i in range(len(keys)) if i not in found]
+        values = self.lookupBatch([keys[i] for i in missing])
+        self.cache.put(self.cache_name, [keys[i] for i in missing], values)
+        for (i, value) in zip(missing, values):
+            found[i] = value
+
+        self.count('cache_hits', len(keys) - len(missing))
+        self.count('cache_misses', len(missing))
+        return [found[i] for i in range(len(keys))]
+
+    def count(self, name, n=1):
+        with Annotator.counts_lock:
+            self.counts[name] = self.counts.get(name, 0) + n
+
+    def apply(self, record, result):
+        raise NotImplementedError
+
+    """Records of a window the stage looks up, i.e. all but the headers
+    """
+    def pending(self, records):
+        return [record for record in records 
+            if not self.isHeader(record.line)]
+
+    """Annotates a window of records in place, returns the records
+    """
+    def annotate(self, records):
+        pending = self.pending(records)
+        results = self.lookupCached([self.key(record) for record in pending])
+        for (record, result) in zip(pending, results):
+            self.apply(record, result)
+        return records
+
+    """Called with the input file before its lines are annotated
+    """
+    def prepare(self, infile):
+        pass
+
+    def writeLog(self, fh_log):
+        pass
+
+    """Releases anything the stage holds beyond the shared cursor
+    """
+    def close(self):
+        for name in ['index', 'cpg_index']:
+            index = getattr(self, name, None)
+            if (index is not None) and hasattr(index, 'close'):
+                index.close()
+        if self.cache is not None:
+            self.cache.close()
+
+    """Adds the counts of the same stage run over another part of the input
+    """
+    def merge(self, other):
+        for c in other.counts:
+            self.counts[c] = self.counts.get(c, 0) + other.counts[c]
+
+    # Stages are pickled without their database handle, indexes, cache and
+    # filter so worker processes can send their counts back
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state['cursor'] = None
+        state['backend'] = None
+        state['cache'] = None
+        for name in ['index', 'cpg_index', 'bloom', 'span_rows', 'span_lists']:
+            if name in state:
+                state[name] = None
+        return state
+
+
+"""Base class for the overlap stages that log "In <table>: x in y variants"
+   index, when given, is an intervals.IntervalIndex over the stage's table
+   that answers lookups in place of the range query
+"""
+class OverlapAnnotator(Annotator):
+
+    def __init__(self, cursor, format='vcf', table='', sep='\t', index=None):
+        Annotator.__init__(self, cursor, format=format, sep=sep)
+        self.table = table
+        self.name = table
+        self.index = index
+        self.cache_name = self.__class__.__name__ + '.' + table
+        self.counts = {'var_count': 0, 'line_count': 0}
+
+    def key(self, record):
+        return (record.chrom, record.pos)
 
-    ratioInDbSnp = (var_count / float(linenum)) * 100
-    fh_log.write("## Please notice that all Isoforms were counted\n")
-    fh_log.write("## Numbers may exceed number of variants in the annotated file\n")
-    fh_log.write(f"Total: {str(linenum)}\n")
-    fh_log.write(f"In dbSNP: {str(var_count)} ({str(ratioInDbSnp)}%)\n")
-    fh_log.close()
+    def writeLog(self, fh_log):
+        fh_log.write(f"In {str(self.table)}: " + \
+            f"{str(self.counts['var_count'])} in " + \
+            f"{str(self.counts['line_count'])} variants\n")
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+
+""""Format must be pileup or vcf
+    Types of variants in dbSNP135: DIV, SNV, MNV, MIXED
+    batch_size > 1 resolves that many variants per dbSNP round trip
+    bloom, a bloom.BloomFilter over dbSNP positions, skips the query for
+    variants at positions dbSNP does not have
+    index, a snapshot table over dbSNP positions, answers lookups in 
+    place of the queries
+""" 
+class DbSnpAnnotator(Annotator):
+    name = 'dbSNP'
+
+    def __init__(self, cursor, format='vcf', varclass='SNV', sep='\t', 
+        batch_size=1, bloom=None, index=None):
+        Annotator.__init__(self, cursor, format=format, sep=sep)
+        self.varclass = varclass
+        self.batch_size = batch_size
+        self.bloom = bloom
+        self.index = index
+        self.cache_name = self.__class__.__name__ + '.' + varclass
+        self.counts = {'variants': 0, 'var_count': 0}
+
+    def isHeader(self, line):
+        return line.startswith("#")
+
+    def key(self, record):
+        return getVariantKey(record)
+
+    def lookup(self, key):
+        (chr, pos, ref, alt) = key
+        compRef = getComplementary(ref)
+        return self.fragments(self.backend.pointLookup(self.cursor, 'dbSNP', 
+            {'CHR': str(chr), 'POS': int(pos), 'REF': [str(ref), compRef], 
+            'INFO': self.varclass}))
+
+    def lookupBatch(self, keys):
+        if self.bloom is None:
+            return self.queryBatch(keys)
+
+        results = [([], []) for key in keys]
+        screened = [i for i in range(len(keys)) 
+            if self.bloom.mayContain(keys[i][0], keys[i][1])]
+        self.count('bloom_skipped', len(keys) - len(screened))
+        for (i, result) in zip(screened, 
+            self.queryBatch([keys[i] for i in screened])):
+            results[i] = result
+        return results
+
+    def queryBatch(self, keys):
+        if self.index is not None:
+            return [self.fragments(rows) for rows in 
+                lookupDbSnpIndex(self.index, keys, varclass=self.varclass)]
+        if (self.batch_size <= 1):
+            return Annotator.lookupBatch(self, keys)
+
+        results = []
+        for i in range(0, len(keys), self.batch_size):
+            results.extend([self.fragments(rows) for rows in 
+                lookupDbSnpBatch(self.backend, self.cursor, 
+                keys[i:i + self.batch_size], 
+                varclass=self.varclass)])
+        return results
+
+    """rsids and GMAF entries of the matching dbSNP rows
+    """
+    def fragments(self, rows):
+        rsids = []
+        mafs = []
+        for row in rows:
+            rsids.append(str(row[3]))
+            if (str(row[7]) != '.'):
+                mafs.append('GMAF=' + str(row[7]))
+        return (rsids, mafs)
+
+    def apply(self, record, result):
+        fields = record.fields
+        self.counts['variants'] = self.counts['variants'] + 1
+        ## reset rsid to "." - in case there was annotation from old release of dbSNP
+        fields[2] = '.'
+        (rsids, mafs) = result
+        if (len(rsids) > 0):
+            self.counts['var_count'] = self.counts['var_count'] + 1
+            maf_str = ''
+            if (len(mafs) > 0):
+                maf_str = ';' + ';'.join([str(x) for x in mafs])
+            if record.info.isEmpty():
+                record.info.set('DB' + maf_str)
+            else:
+                record.info.append('DB;VC=' + self.varclass + maf_str)
+
+            fields[2] = str(';'.join(rsids))
+
+    def writeLog(self, fh_log):
+        linenum = self.counts['variants'] + 1
+        var_count = self.counts['var_count']
+        ratioInDbSnp = (var_count / float(linenum)) * 100
+        fh_log.write("## Please notice that all Isoforms were counted\n")
+        fh_log.write("## Numbers may exceed number of variants in the annotated file\n")
+        fh_log.write(f"Total: {str(linenum)}\n")
+        fh_log.write(f"In dbSNP: {str(var_count)} ({str(ratioInDbSnp)}%)\n")
 
 
 """NOTE: all isoforms are collapsed in one record
     1. chrom_pos_equal_base
     2. chrom_pos_equal_nobase
     3. chrom_pos_unequal
+    batch_size > 1 resolves that many variants per set of tier queries
+    index, the snapshot tables of the three tiers in that order, answers
+    lookups in place of the queries
 """
-def getBigRefGene(vcf, format='vcf', tmpextin='.1', tmpextout='.2', sep='\t'):
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-    fh_out = open(outfile, "w")
-    inds = getFormatSpecificIndices(format=format)
-    fh = open(vcf)
-
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    vcf_linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        if not line.startswith("#"):
-            fields = line.split(sep)
-            chr = fields[inds[0]].strip()
-            if chr.startswith("chr"):
-                chr = chr.replace('chr', '')
-
-            pos = fields[inds[1]].strip()
-            ref = clean_mysql_chars(fields[inds[2]]).strip()
-            alt = clean_mysql_chars(fields[inds[3]]).strip()
-
-            compRef = getComplementary(ref)
-            compAlt = getComplementary(alt)
-
-            sql1 = 'select * from chrom_pos_equal_base where CHR="' + \
-                str(chr) + '" AND start = ' + str(pos) + \
-                ' AND ((haplotypeReference="' + str(ref) + \
-                '" AND haplotypeAlternate ="' + str(alt) + \
-                '") OR (haplotypeReference="' + str(compRef) + \
-                '" AND haplotypeAlternate ="' + str(compAlt) + '"));'
-
-            sql2 = 'select * from chrom_pos_equal_nobase where CHR="' + \
-                str(chr) + '" AND start = ' + str(pos) + ';'
-
-            sql3 = 'select * from chrom_pos_unequal where CHR="' + \
-                str(chr) + '" AND start <= ' + str(pos) + ' AND ' + \
-                str(pos) + ' <= end ;'
-
-            keep_going = True
-            cursor.execute(sql1)
-            rows = cursor.fetchall()
-
-            if (len(rows) > 0):
-                keep_going = False
-                m = set([])
-                for row in rows:
-                    m.add(collapseRefSeq('\t'.join([str(x) for x in row[1:len(row)] ])))
-
-                fields[7] = fields[7] + ';' + ';'.join(m)
-                if (str(fields[7]).startswith(".;")):
-                    fields[7] = str(fields[7]).replace('.;', '', 1)
-
-                l = '\t'.join([str(x) for x in fields])
-                fh_out.write(l + '\n')
-
-            if (keep_going):
-                cursor.execute(sql2)
-                rows = cursor.fetchall()
-
-                if (len(rows) > 0):
-                    keep_going = False
-                    m = set([])
-                    for row in rows:
-                        m.add(collapseRefSeq('\t'.join([str(x) for x in row[1:len(row)]])))
-
-                    fields[7] = fields[7] + ';' + ';'.join(m)
-                    if (str(fields[7]).startswith(".;")):
-                        fields[7] = str(fields[7]).replace('.;', '', 1)
-                    
-                    l = '\t'.join([str(x) for x in fields])
-                    fh_out.write(l + '\n')
-
-            if (keep_going):
-                cursor.execute(sql3)
-                rows = cursor.fetchall()
-
-                if (len(rows) > 0):
-                    keep_going = False
-                    m = set([])
-                    for row in rows:
-                        m.add(collapseRefSeq('\t'.join([str(x) for x in row[1:len(row)]])))
-
-                    fields[7] = fields[7] + ';' + ';'.join(m)
-                    if (str(fields[7]).startswith(".;")):
-                        fields[7] = str(fields[7]).replace('.;', '', 1)
-
-                    l = '\t'.join([str(x) for x in fields])
-                    fh_out.write(l + '\n')
-
-            if (keep_going):
-                fh_out.write(line + '\n')
-
-            vcf_linenum = vcf_linenum + 1
-
-        else:
-            fh_out.write(line + '\n')
-
-    conn.close()
-    fh.close()
-    fh_out.close()
+class BigRefGeneAnnotator(Annotator):
+    name = 'BigRefGene'
+
+    def __init__(self, cursor, format='vcf', sep='\t', batch_size=1, 
+        index=None):
+        Annotator.__init__(self, cursor, format=format, sep=sep)
+        self.batch_size = batch_size
+        self.index = index
+
+    def isHeader(self, line):
+        return line.startswith("#")
+
+    def key(self, record):
+        return getVariantKey(record)
+
+    def lookup(self, key):
+        (chr, pos, ref, alt) = key
+        changes = [(str(ref).upper(), str(alt).upper()), 
+            (getComplementary(ref), getComplementary(alt))]
+
+        # Tier 1: same position and base change, on either strand
+        rows = self.backend.pointLookup(self.cursor, 'chrom_pos_equal_base', 
+            {'CHR': str(chr), 'start': int(pos), 
+            'haplotypeReference': [change[0] for change in changes], 
+            'haplotypeAlternate': [change[1] for change in changes]})
+        names = self.backend.columns(self.cursor, 'chrom_pos_equal_base')
+        (ref_ind, alt_ind) = (names.index('haplotypeReference'), 
+            names.index('haplotypeAlternate'))
+        rows = [row for row in rows if (str(row[ref_ind]).upper(), 
+            str(row[alt_ind]).upper()) in changes]
+
+        # Tier 2: same position; tier 3: ranges covering the position
+        if (len(rows) == 0):
+            rows = self.backend.pointLookup(self.cursor, 
+                'chrom_pos_equal_nobase', {'CHR': str(chr), 'start': int(pos)})
+        if (len(rows) == 0):
+            rows = self.backend.rangeQuery(self.cursor, 'chrom_pos_unequal', 
+                str(chr), pos, pos, chromName='CHR', startName='start', 
+                endName='end')
+        if (len(rows) > 0):
+            return list(collapseRefSeqRows(rows))
+        return None
+
+    def lookupBatch(self, keys):
+        if self.index is not None:
+            return [lookupRefSeqIndex(self.index, key) for key in keys]
+        if (self.batch_size <= 1):
+            return Annotator.lookupBatch(self, keys)
+
+        results = []
+        for i in range(0, len(keys), self.batch_size):
+            results.extend(lookupRefSeqBatch(self.backend, self.cursor, 
+                keys[i:i + self.batch_size]))
+        return results
+
+    def apply(self, record, m):
+        if (m is None):
+            return
+
+        record.info.append(';'.join(m))
+        record.info.dropPlaceholder()
 
 
 """Get information about location in gene structures
 """
-def getGenes(vcf, format='vcf', table='refGene', promoter_offset=500, 
-    tmpextin='.2', tmpextout='.3', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-    fh_out = open(outfile, "w")
-
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
-
-    interGenic_count = 0
-    cds_count = 0
-    utr3_count = 0
-    utr5_count = 0
-    intronic_count = 0
-    non_coding_intronic_count = 0
-    exonic_count = 0
-    non_coding_exonic_count = 0
-    promoter_count = 0
-
-    inds = getFormatSpecificIndices(format=format)
-    fh = open(vcf)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        if not line.startswith("#"):
-            fields = line.split(sep)
-            chr = fields[inds[0]].strip()
-
-            if not chr.startswith("chr"):
-                chr = "chr" + chr
-
-            pos = fields[inds[1]].strip()
-            ref = clean_mysql_chars(fields[inds[2]]).strip()
-            alt = clean_mysql_chars(fields[inds[3]]).strip()
-            info_field = clean_mysql_chars(fields[7]).strip()
-            this_gene_name = str(u.parse_field(info_field, 'name', ';', '='))
-
-            sql = 'select * from ' + table + ' where chrom="' + str(chr) + \
-                '" AND (txStart - ' + str(promoter_offset) +') <= ' + \
-                str(pos) + ' AND ' + str(pos) + ' <= (txEnd + ' + \
-                str(promoter_offset) +');'
-
-            cursor.execute(sql)
-            rows = cursor.fetchall()
-            info = []
-
-            if (len(rows) > 0):
-                cnt = 1
-                for row in rows:
-                    #count location
-                    positionType = str(u.parse_field(info_field, 
-                        'positionType', ';', '='))
-                    
-                    if (positionType == 'intron'):
-                        intronic_count = intronic_count + 1
-                    elif (positionType == 'non_coding_intron'):
-                        non_coding_intronic_count = non_coding_intronic_count + 1
-                    elif (positionType == 'CDS'):
-                        cds_count = cds_count + 1
-                    elif (positionType == 'non_coding_exon'):
-                        non_coding_exonic_count = non_coding_exonic_count + 1
-                    elif (positionType == 'utr5'):
-                        utr5_count = utr5_count + 1
-                    elif (positionType == 'utr3'):
-                        utr3_count = utr3_count + 1
-
-                    txtStart = int(row[4])
-                    txtEnd = int(row[5])
-                    cdsStart = int(row[6])
-                    cdsEnd = int(row[7])
-                    exonCount = int(row[8])
-                    exonStarts =str(row[9].decode("utf-8"))
-                    exonEnds = str(row[10].decode("utf-8"))
-                    geneSymbol = str(row[12])
-                    strand = str(row[3])
-
-                    promoter_plus = txtStart - int(promoter_offset)
-                    promoter_minus = txtEnd + int(promoter_offset)
-                    region = ""
-                    pos = int(pos)
-                    exons = []
-                    exonsSt = exonStarts.split(',')
-                    exonsEn = exonEnds.split(',')
-
-                    if (cdsStart == cdsEnd):
-                        for e in range(0, exonCount):
-                            if (u.isBetween(pos, int(exonsSt[e]), int(exonsEn[e]))):
-                                exnum = e + 1
-                                if (strand == '-'):
-                                    exnum = exonCount - e
-                                exons.append("non_coding_exon=" + "ex" + \
-                                    str(exnum) + '/' + str(exonCount))
-                        if (len(exons) > 0):
-                            region = ";".join(exons)
-                    elif (u.isBetween(pos, cdsStart, cdsEnd)):
-                        for e in range(0, exonCount):
-                            if u.isBetween(pos, int(exonsSt[e]), int(exonsEn[e])):
-                                exnum = e + 1
-                                if (strand == '-'):
-                                    exnum = exonCount - e
-                                exons.append("exon=" +  "ex" + \
-                                    str(exnum) + '/' + str(exonCount))
-                                exonic_count = exonic_count + 1
-                        if (len(exons) > 0):
-                            region = ";".join(exons)
-
-                    elif (u.isBetween(pos, promoter_plus, txtStart) and 
-                        (strand == "+")):
-                        sql = 'select chrom, chromStart, chromEnd, name from ' + \
-                            'cpgIslandExt where chrom="' + str(chr) + \
-                            '" AND (chromStart <= ' + str(pos) + \
-                            ' AND ' + str(pos) + ' <= chromEnd);'
-                        cursor.execute(sql)
-                        rows = cursor.fetchone()
-
-                        if (rows is not None):
-                            region = 'putativePromoterRegion=' + \
-                                "".join(str(rows[3]).split())
-                            promoter_count = promoter_count + 1
-
-                    elif (u.isBetween(pos, txtEnd, promoter_minus) and (strand == "-")):
-                        sql = 'select chrom, chromStart, chromEnd, name from ' + \
-                            'cpgIslandExt where chrom="' + str(chr) + \
-                            '" AND (chromStart <= ' + str(pos) + \
-                            ' AND ' + str(pos) + ' <= chromEnd);'
-                        cursor.execute(sql)
-
-                        rows = cursor.fetchone()
-                        if (rows is not None):
-                            region = 'putativePromoterRegion=' +  \
-                                "".join(str(rows[3]).split())
-                            promoter_count = promoter_count + 1
-
-                    else:
-                        region = ''
-
-                    if (region != ''):
-                        info.append(collapseGeneNames(row=row, 
-                            indices=indicesKnownGenes, region=region, cnt=cnt))
-
-                    cnt = cnt + 1
-
-                str_info = ";".join(info)
-                fields[7] = fields[7] + ';' + str_info
-                fh_out.write('\t'.join(fields) + '\n')
+class GenesAnnotator(Annotator):
+    name = 'refGene'
+    # Counts the positionType set by BigRefGene
+    after = ['BigRefGene']
+    location_counts = ['interGenic_count', 'cds_count', 'utr3_count', 
+        'utr5_count', 'intronic_count', 'non_coding_intronic_count', 
+        'exonic_count', 'non_coding_exonic_count', 'promoter_count']
+
+    def __init__(self, cursor, format='vcf', table='refGene', 
+        promoter_offset=500, sep='\t', index=None, cpg_index=None):
+        Annotator.__init__(self, cursor, format=format, sep=sep)
+        self.table = table
+        self.name = table
+        self.promoter_offset = promoter_offset
+        self.index = index
+        self.cpg_index = cpg_index
+        self.cpg_last = None
+        self.counts = dict([(c, 0) for c in self.location_counts])
+        self.cache_name = self.__class__.__name__ + '.' + table + '.' + \
+            str(promoter_offset)
+
+    def isHeader(self, line):
+        return line.startswith("#")
+
+    def key(self, record):
+        return (record.chrom, record.pos)
+
+    """Transcripts within promoter_offset of pos
+    """
+    def lookupTranscripts(self, chr, pos):
+        if self.index is not None:
+            return [hit[3] for hit in self.index.overlap(chr, pos)]
+
+        return [Transcript(row) for row in self.backend.rangeQuery(
+            self.cursor, self.table, str(chr), 
+            int(pos) - self.promoter_offset, int(pos) + self.promoter_offset,
+            startName='txStart', endName='txEnd')]
+
+    """Name of the CpG island overlapping pos, or None
+       The last answer is kept, so all transcripts of a variant share it;
+       it is read once, as async runs look up several records at a time
+    """
+    def lookupCpgIsland(self, chr, pos):
+        last = self.cpg_last
+        if (last is not None) and (last[0] == (chr, pos)):
+            return last[1]
+
+        if self.cpg_index is not None:
+            row = self.cpg_index.first(chr, pos)
+            name = None if (row is None) else \
+                row[self.cpg_index.names.index('name')]
+        else:
+            row = self.backend.rangeFirst(self.cursor, 'cpgIslandExt', 
+                str(chr), pos, pos, 
+                columns=['chrom', 'chromStart', 'chromEnd', 'name'])
+            name = None if (row is None) else row[3]
+
+        cpg = None if (name is None) else "".join(str(name).split())
+        self.cpg_last = ((chr, pos), cpg)
+        return cpg
+
+    """Returns None for intergenic positions, otherwise the number of 
+       transcripts, their INFO fragments and the counters they add
+    """
+    def lookup(self, key):
+        (chr, pos) = key
+        rows = self.lookupTranscripts(chr, pos)
+        if (len(rows) == 0):
+            return None
+
+        info = []
+        exonic_count = 0
+        promoter_count = 0
+        cnt = 1
+        for t in rows:
+            txtStart = t.txStart
+            txtEnd = t.txEnd
+            cdsStart = t.cdsStart
+            cdsEnd = t.cdsEnd
+            exonCount = t.exonCount
+            strand = t.strand
+
+            promoter_plus = txtStart - int(self.promoter_offset)
+            promoter_minus = txtEnd + int(self.promoter_offset)
+            region = ""
+            pos = int(pos)
+            exons = []
+
+            if (cdsStart == cdsEnd):
+                for e in t.exonHits(pos):
+                    exons.append("non_coding_exon=" + "ex" + \
+                        str(t.exonNumber(e)) + '/' + str(exonCount))
+                if (len(exons) > 0):
+                    region = ";".join(exons)
+            elif (u.isBetween(pos, cdsStart, cdsEnd)):
+                for e in t.exonHits(pos):
+                    exons.append("exon=" +  "ex" + \
+                        str(t.exonNumber(e)) + '/' + str(exonCount))
+                    exonic_count = exonic_count + 1
+                if (len(exons) > 0):
+                    region = ";".join(exons)
+
+            elif (u.isBetween(pos, promoter_plus, txtStart) and 
+                (strand == "+")):
+                cpg = self.lookupCpgIsland(chr, pos)
+                if (cpg is not None):
+                    region = 'putativePromoterRegion=' + cpg
+                    promoter_count = promoter_count + 1
+
+            elif (u.isBetween(pos, txtEnd, promoter_minus) and (strand == "-")):
+                cpg = self.lookupCpgIsland(chr, pos)
+                if (cpg is not None):
+                    region = 'putativePromoterRegion=' + cpg
+                    promoter_count = promoter_count + 1
 
             else:
-                fields[7] = fields[7] + ";positionType=interGenic"
-                fh_out.write('\t'.join(fields) + '\n')
-                interGenic_count = interGenic_count + 1
+                region = ''
+
+            if (region != ''):
+                info.append(collapseGeneNames(row=t.row, 
+                    indices=indicesKnownGenes, region=region, cnt=cnt))
+
+            cnt = cnt + 1
+
+        return (len(rows), info, {'exonic_count': exonic_count, 
+            'promoter_count': promoter_count})
+
+    """Counts the location reported by getBigRefGene once per transcript
+    """
+    def countPositionType(self, record, transcripts):
+        info_field = clean_mysql_chars(record.info.text()).strip()
+        positionType = str(u.parse_field(info_field, 'positionType', ';', '='))
+        
+        if (positionType == 'intron'):
+            c = 'intronic_count'
+        elif (positionType == 'non_coding_intron'):
+            c = 'non_coding_intronic_count'
+        elif (positionType == 'CDS'):
+            c = 'cds_count'
+        elif (positionType == 'non_coding_exon'):
+            c = 'non_coding_exonic_count'
+        elif (positionType == 'utr5'):
+            c = 'utr5_count'
+        elif (positionType == 'utr3'):
+            c = 'utr3_count'
+        else:
+            return
+        self.counts[c] = self.counts[c] + transcripts
 
-            linenum = linenum + 1
+    def apply(self, record, result):
+        if (result is None):
+            record.info.append("positionType=interGenic")
+            self.counts['interGenic_count'] = self.counts['interGenic_count'] + 1
+            return
 
-        else:
-            fh_out.write(line + '\n')
+        (transcripts, info, counts) = result
+        self.countPositionType(record, transcripts)
+        for c in counts:
+            self.counts[c] = self.counts[c] + counts[c]
 
-    print("Variants located:")
-    fh_log.write("Variants located:\n")
+        record.info.append(";".join(info))
 
-    print(f"In interGenic {str(interGenic_count)}")
-    fh_log.write(f"In interGenic {str(interGenic_count)}\n")
+    def writeLog(self, fh_log):
+        print("Variants located:")
+        fh_log.write("Variants located:\n")
 
-    print(f"In CDS {str(cds_count)}")
-    fh_log.write(f"In CDS {str(cds_count)}\n")
+        for (label, c) in [('interGenic', 'interGenic_count'), 
+            ('CDS', 'cds_count'), ('\'3 UTR', 'utr3_count'), 
+            ('\'5 UTR', 'utr5_count'), ('Intronic', 'intronic_count'), 
+            ('Non_coding_intronic', 'non_coding_intronic_count'), 
+            ('Exonic', 'exonic_count'), 
+            ('Non_coding_exonic', 'non_coding_exonic_count'),
+            ('Putative Promoter Region', 'promoter_count')]:
+            print(f"In {label} {str(self.counts[c])}")
+            fh_log.write(f"In {label} {str(self.counts[c])}\n")
 
-    print(f"In \'3 UTR {str(utr3_count)}")
-    fh_log.write(f"In \'3 UTR {str(utr3_count)}\n")
 
-    print(f"In \'5 UTR {str(utr5_count)}")
-    fh_log.write(f"In \'5 UTR {str(utr5_count)}\n")
+"""Method used in INDELS, where bigRefGeneTable is not applicable
+"""
+class ExonsEtAlAnnotator(GenesAnnotator):
+
+    def countPositionType(self, record, transcripts):
+        pass
+
+    def lookup(self, key):
+        (chr, pos) = key
+        rows = self.lookupTranscripts(chr, pos)
+        if (len(rows) == 0):
+            return None
+
+        info = []
+        counts = dict([(c, 0) for c in self.location_counts])
+        cnt = 1
+        for t in rows:
+            txtStart = t.txStart
+            txtEnd = t.txEnd
+            cdsStart = t.cdsStart
+            cdsEnd = t.cdsEnd
+            exonCount = t.exonCount
+            strand = t.strand
+
+            promoter_plus = txtStart - int(self.promoter_offset)
+            promoter_minus = txtEnd + int(self.promoter_offset)
+            region = ""
+            pos = int(pos)
+            exons = []
+
+            if (cdsStart == cdsEnd):
+                for e in t.exonHits(pos):
+                    exons.append("non_coding_exon=" + "ex" + \
+                        str(t.exonNumber(e)) + '/' + str(exonCount))
+                    counts['non_coding_exonic_count'] += 1
+                if (len(exons) > 0):
+                    region='positionType=non_coding_exon;' + ";".join(exons)
+                else:
+                    counts['non_coding_intronic_count'] += 1
+                    region = 'positionType=non_coding_intron'
+
+            elif (u.isBetween(pos, cdsStart, cdsEnd) and (cdsStart < cdsEnd)):
+                counts['cds_count'] += 1
+                for e in t.exonHits(pos):
+                    exons.append("exon=" + "ex" + \
+                        str(t.exonNumber(e)) + '/' + str(exonCount))
+                    counts['exonic_count'] += 1
+                if (len(exons) > 0):
+                    region = 'positionType=CDS;' + ";".join(exons)
+                else:
+                    counts['intronic_count'] += 1
+                    region = 'positionType=CDS;' + 'intron'
+
+            elif (u.isBetween(pos, txtStart, cdsStart) and \
+                (cdsStart < cdsEnd) and (strand == "+")):
+                counts['utr5_count'] += 1
+                region = 'positionType=utr5'
+
+            elif (u.isBetween(pos, cdsEnd, txtEnd) and \
+                (cdsStart < cdsEnd) and (strand == "+")):
+                counts['utr3_count'] += 1
+                region = 'positionType=utr3'
+
+            elif (u.isBetween(pos, cdsEnd, txtEnd) and 
+                (cdsStart < cdsEnd) and (strand == "-")):
+                counts['utr5_count'] += 1
+                region = 'positionType=utr5'
+
+            elif (u.isBetween(pos, txtStart, cdsStart) and \
+                (cdsStart < cdsEnd) and (strand == "-")):
+                counts['utr3_count'] += 1
+                region = 'positionType=utr3'
+
+            elif (u.isBetween(pos, promoter_plus, txtStart) and \
+                (strand == "+")):
+                cpg = self.lookupCpgIsland(chr, pos)
+                if (cpg is not None):
+                    region = 'putativePromoterRegion=' + cpg
+                    counts['promoter_count'] += 1
+
+            elif (u.isBetween(pos, txtEnd, promoter_minus) and \
+                (strand == "-")):
+                cpg = self.lookupCpgIsland(chr, pos)
+                if (cpg is not None):
+                    region = 'putativePromoterRegion=' + cpg
+                    counts['promoter_count'] += 1
 
-    print(f"In Intronic {str(intronic_count)}")
-    fh_log.write(f"In Intronic {str(intronic_count)}\n")
+            else:
+                region = ''
 
-    print(f"In Non_coding_intronic {str(non_coding_intronic_count)}")
-    fh_log.write(f"In Non_coding_intronic {str(non_coding_intronic_count)}\n")
+            if (region != ''):
+                info.append(collapseGeneNames(
+                    row=t.row, indices=indicesKnownGenes, 
+                    region=region, cnt=cnt))
 
-    print(f"In Exonic {str(exonic_count)}")
-    fh_log.write(f"In Exonic {str(exonic_count)}\n")
+            cnt = cnt + 1
 
-    print(f"In Non_coding_exonic {str(non_coding_exonic_count)}")
-    fh_log.write(f"In Non_coding_exonic {str(non_coding_exonic_count)}\n")
+        return (len(rows), info, counts)
 
-    print(f"In Putative Promoter Region {str(promoter_count)}")
-    fh_log.write(f"In Putative Promoter Region {str(promoter_count)}\n")
 
-    fh_out.close()
-    fh_log.close()
-    fh.close()
-    conn.close()
+"""Overlap with tfbsConsSites
+   index, when given, maps chromosomes to the snapshot table of their
+   tfbsConsSites table; the others are queried
+"""
+class TfbsConsSitesAnnotator(OverlapAnnotator):
+    allowed_chrom=['1','2','3','4','5','6','7','8','9','10','11','12','13',
+        '14','15','16','17','18','19','20','21','22','X','Y']
 
+    def __init__(self, cursor, format='vcf', table='tfbsConsSites', sep='\t',
+        span_fetch=False, index=None):
+        OverlapAnnotator.__init__(self, cursor, format=format, table=table, 
+            sep=sep, index=index)
+        self.span_fetch = span_fetch
+        self.spans = None
+        # Rows read over each chromosome's span and their NCList, by 
+        # chromosome
+        self.span_rows = None
+        self.span_lists = None
+
+    def key(self, record):
+        # For some reason this table has no "chr" preceeding number
+        return (record.chrom_nochr, record.pos)
+
+    """With span_fetch set, notes the position span of each chromosome's
+       variants so its table is read once over that span
+    """
+    def prepare(self, infile):
+        if not self.span_fetch or (self.index is not None):
+            return
+        self.spans = {}
+        self.span_rows = None
+        self.span_lists = None
+        with open(infile) as fh:
+            for line in fh:
+                record = Record(line, self.inds, self.sep)
+                if self.isHeader(record.line):
+                    continue
+                (chrIndex, pos) = self.key(record)
+                (low, high) = self.spans.get(chrIndex, (pos, pos))
+                self.spans[chrIndex] = (min(low, pos), max(high, pos))
+
+    def lookup(self, key):
+        (chrIndex, pos) = key
+        if (chrIndex not in self.allowed_chrom):
+            return []
+
+        if (self.index is not None) and (chrIndex in self.index):
+            table = self.index[chrIndex]
+            cols = [table.names.index(c) 
+                for c in ['chrom', 'chromStart', 'chromEnd', 'name']]
+            return self.records([[row[c] for c in cols] 
+                for chrom in table.chroms() 
+                for row in table.overlap(chrom, pos)])
+
+        return self.records(self.backend.rangeQuery(self.cursor, 
+            'tfbsConsSites' + chrIndex, None, pos, pos, 
+            columns=['chrom', 'chromStart', 'chromEnd', 'name']))
+
+    def lookupBatch(self, keys):
+        if self.spans is None:
+            return OverlapAnnotator.lookupBatch(self, keys)
+        return [self.lookupSpan(key) for key in keys]
+
+    """Resolves key against the rows of its chromosome's span, which are
+       read the first time the chromosome comes up and kept for the rest
+       of the job, so each chromosome is read once whatever the input 
+       order. Hits keep table order, as the per-variant query returns them.
+    """
+    def lookupSpan(self, key):
+        (chrIndex, pos) = key
+        if (chrIndex not in self.allowed_chrom):
+            return []
+
+        if self.span_lists is None:
+            self.span_rows = {}
+            self.span_lists = {}
+        if chrIndex not in self.span_lists:
+            (low, high) = self.spans.get(chrIndex, (int(pos), int(pos)))
+            rows = self.backend.rangeQuery(self.cursor, 
+                'tfbsConsSites' + chrIndex, None, low, high, 
+                columns=['chrom', 'chromStart', 'chromEnd', 'name'])
+            self.span_rows[chrIndex] = rows
+            self.span_lists[chrIndex] = intervals.NCList(
+                [(int(row[1]), int(row[2]), i) for (i, row) in enumerate(rows)])
+
+        rows = self.span_rows[chrIndex]
+        return self.records([rows[i] 
+            for i in sorted(self.span_lists[chrIndex].query(int(pos)))])
+
+    def records(self, rows):
+        records = []
+        for row in rows:
+            t = str(row[3]) + '.' + str(row[0]) + '.' + \
+                str(row[1]) + '.' + str(row[2])
+            t = t.strip()
+            records.append('tfbsRegion' + '=' + t)
+        return records
+
+    def apply(self, record, records):
+        if (len(records) == 0):
+            return
+
+        self.counts['line_count'] = self.counts['line_count'] + 1
+        self.counts['var_count'] = self.counts['var_count'] + len(records)
+        record.info.add(';'.join(records))
 
-"""Method used in INDELS, where bigRefGeneTable is not applicable
+
+"""Overlap with GadAll table
 """
-def getExonsEtAl(vcf, format='vcf', table='refGene', promoter_offset=500, 
-    tmpextin='.2', tmpextout='.3', sep='\t'):
+class GadAllAnnotator(OverlapAnnotator):
 
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-    fh_out = open(outfile, "w")
-
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
-
-    interGenic_count = 0
-    cds_count = 0
-    utr3_count = 0
-    utr5_count = 0
-    intronic_count = 0
-    non_coding_intronic_count = 0
-    exonic_count = 0
-    non_coding_exonic_count = 0
-    promoter_count = 0
-
-    inds = getFormatSpecificIndices(format=format)
-    fh = open(vcf)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        if not line.startswith("#"):
-            fields = line.split(sep)
-            chr = fields[inds[0]].strip()
-            
-            if not chr.startswith("chr"):
-                chr = "chr" + chr
-            
-            pos = fields[inds[1]].strip()
-            ref = clean_mysql_chars(fields[inds[2]]).strip()
-            alt = clean_mysql_chars(fields[inds[3]]).strip()
-            info_field = clean_mysql_chars(fields[7]).strip()
-            this_gene_name = str(u.parse_field(info_field, 'name', ';', '='))
-
-            sql = 'select * from ' + table + ' where chrom="' + str(chr) + \
-                '"   AND (txStart - ' + str(promoter_offset) + ') <= ' + \
-                str(pos) + ' AND ' + str(pos) + ' <= (txEnd + ' + \
-                str(promoter_offset) +');'
-            cursor.execute(sql)
-            rows = cursor.fetchall()
-            info = []
-            if (len(rows) > 0):
-                cnt = 1
-                for row in rows:
-                    txtStart = int(row[4])
-                    txtEnd = int(row[5])
-                    cdsStart = int(row[6])
-                    cdsEnd = int(row[7])
-                    exonCount = int(row[8])
-                    exonStarts =str(row[9].decode('utf-8'))
-                    exonEnds = str(row[10].decode('utf-8'))
-                    geneSymbol = str(row[12])
-                    strand = str(row[3])
-
-                    promoter_plus = txtStart - int(promoter_offset)
-                    promoter_minus = txtEnd + int(promoter_offset)
-                    region = ""
-                    pos = int(pos)
-                    exons = []
-                    exonsSt = exonStarts.split(',')
-                    exonsEn = exonEnds.split(',')
-
-                    if (cdsStart == cdsEnd):
-                        for e in range(0, exonCount):
-                            if (u.isBetween(pos, int(exonsSt[e]), int(exonsEn[e]))):
-                                exnum = e + 1
-                                if (strand == '-'):
-                                    exnum =  exonCount - e
-                                exons.append("non_coding_exon=" + "ex" + \
-                                    str(exnum) + '/' + str(exonCount))
-                                non_coding_exonic_count = non_coding_exonic_count + 1
-                        if (len(exons) > 0):
-                            region='positionType=non_coding_exon;' + ";".join(exons)
-                        else:
-                            non_coding_intronic_count = non_coding_intronic_count + 1
-                            region = 'positionType=non_coding_intron'
-
-                    elif (u.isBetween(pos, cdsStart, cdsEnd) and (cdsStart < cdsEnd)):
-                        cds_count = cds_count + 1
-                        for e in range(0, exonCount):
-                            if (u.isBetween(pos, int(exonsSt[e]), int(exonsEn[e]))):
-                                exnum = e + 1
-                                if (strand == '-'):
-                                    exnum =  exonCount - e
-                                exons.append("exon=" + "ex" + \
-                                    str(exnum) + '/' + str(exonCount))
-                                exonic_count=exonic_count+1
-                        if (len(exons) > 0):
-                            region = 'positionType=CDS;' + ";".join(exons)
-                        else:
-                            intronic_count = intronic_count + 1
-                            region = 'positionType=CDS;' + 'intron'
-
-                    elif (u.isBetween(pos, txtStart, cdsStart) and \
-                        (cdsStart < cdsEnd) and (strand == "+")):
-                        utr5_count = utr5_count + 1
-                        region = 'positionType=utr5'
-
-                    elif (u.isBetween(pos, cdsEnd, txtEnd) and \
-                        (cdsStart < cdsEnd) (strand == "+")):
-                        utr3_count = utr3_count + 1
-                        region = 'positionType=utr3'
-
-                    elif (u.isBetween(pos, cdsEnd, txtEnd) and 
-                        (cdsStart < cdsEnd) (strand == "-")):
-                        utr5_count = utr5_count + 1
-                        region = 'positionType=utr5'
-
-                    elif (u.isBetween(pos, txtStart, cdsStart) and \
-                        (cdsStart < cdsEnd) and (strand == "-")):
-                        utr3_count = utr3_count + 1
-                        region = 'positionType=utr3'
-
-                    elif (u.isBetween(pos, promoter_plus, txtStart) and \
-                        (strand == "+")):
-                        sql = 'select chrom, chromStart, chromEnd, name ' + \
-                            'from cpgIslandExt where chrom="' + str(chr) +  \
-                            '" AND (chromStart <= ' + str(pos) + ' AND ' + \
-                            str(pos) + ' <= chromEnd);'
-                        cursor.execute(sql)
-                        rows = cursor.fetchone()
-
-                        if (rows is not None):
-                            region = 'putativePromoterRegion=' + \
-                                "".join(str(rows[3]).split())
-                            promoter_count = promoter_count + 1
-
-                    elif (u.isBetween(pos, txtEnd, promoter_minus) and \
-                        (strand == "-")):
-                        sql = 'select chrom, chromStart, chromEnd, name ' + \
-                            'from cpgIslandExt where chrom="' + str(chr) + \
-                            '" AND (chromStart <= ' + str(pos) + ' AND ' + \
-                            str(pos) + ' <= chromEnd);'
-                        cursor.execute(sql)
-                        rows = cursor.fetchone()
-
-                        if (rows is not None):
-                            region = 'putativePromoterRegion=' + \
-                            "".join(str(rows[3]).split())
-                            promoter_count = promoter_count + 1
-
-                    else:
-                        region = ''
-
-                    if (region != ''):
-                        info.append(collapseGeneNames(
-                            row=row, indices=indicesKnownGenes, 
-                            region=region, cnt=cnt))
-
-                    cnt = cnt + 1
-
-                str_info = ";".join(info)
-                fields[7] = fields[7] + ';' + str_info
-                fh_out.write('\t'.join(fields) + '\n')
+    def __init__(self, cursor, format='vcf', table='gadAll', sep='\t', 
+        index=None):
+        OverlapAnnotator.__init__(self, cursor, format=format, table=table, 
+            sep=sep, index=index)
 
-            else:
-                fields[7] = fields[7] + ";positionType=interGenic"
-                fh_out.write('\t'.join(fields) + '\n')
-                interGenic_count = interGenic_count + 1
+    def key(self, record):
+        # For some reason this table has no "chr" preceeding number
+        return (record.chrom_nochr, record.pos)
+
+    def lookup(self, key):
+        (chr, pos) = key
+        if self.index is not None:
+            rows = self.index.overlap(chr, pos)
+        else:
+            rows = self.backend.rangeQuery(self.cursor, self.table, str(chr), 
+                pos, pos, chromName='chromosome')
+        records = []
+        r_tmp = []
+        for row in rows:
+            if not fu.isOnTheList(r_tmp, str(row[3])):
+                r_tmp.append(str(row[3]))
+                records.append(str(self.table) + '=' + str(row[3]))
+        return (len(rows), records)
+
+    def apply(self, record, result):
+        (hits, records) = result
+        if (hits == 0):
+            return
+
+        self.counts['line_count'] = self.counts['line_count'] + 1
+        self.counts['var_count'] = self.counts['var_count'] + hits
+        record.info.add(';'.join(records))
+        # Lines with gadAll hits have always been written with "\t " 
+        # between fields
+        record.spaced = True
 
-            linenum = linenum + 1
 
+""" Overlap with gwasCatalog table """
+class GwasCatalogAnnotator(OverlapAnnotator):
+
+    def __init__(self, cursor, format='vcf', table='gwasCatalog', sep='\t',
+        index=None):
+        OverlapAnnotator.__init__(self, cursor, format=format, table=table, 
+            sep=sep, index=index)
+
+    def lookup(self, key):
+        (chr, pos) = key
+        if self.index is not None:
+            rows = self.index.overlap(chr, pos)
         else:
-            fh_out.write(line + '\n')
+            # The rows ending at pos, among those overlapping it
+            end_ind = self.backend.columns(self.cursor, 
+                self.table).index('chromEnd')
+            rows = [row for row in self.backend.rangeQuery(self.cursor, 
+                self.table, str(chr), pos, pos) 
+                if (int(row[end_ind]) == int(pos))]
+        records = []
+        for row in rows:
+            records.append(str(self.table) + '=' + str('pubMedID') + \
+                '=' + str(row[5]) + ',trait=' + str(row[10]))
+        return records
+
+    def apply(self, record, records):
+        if (len(records) == 0):
+            return
+
+        self.counts['line_count'] = self.counts['line_count'] + 1
+        self.counts['var_count'] = self.counts['var_count'] + len(records)
+        record.info.add(';'.join(records))
 
-    print("Variants located:")
-    fh_log.write("Variants located:\n")
 
-    print(f"In interGenic {str(interGenic_count)}")
-    fh_log.write(f"In interGenic {str(interGenic_count)}\n")
+"""Overlap with HUGO Gene Nomenclature Committee (HGNC) table
+"""
+class HugoAnnotator(OverlapAnnotator):
 
-    print(f"In CDS {str(cds_count)}")
-    fh_log.write(f"In CDS {str(cds_count)}\n")
+    def __init__(self, cursor, format='vcf', table='hugo', sep='\t', 
+        index=None):
+        OverlapAnnotator.__init__(self, cursor, format=format, table=table, 
+            sep=sep, index=index)
 
-    print(f"In \'3 UTR {str(utr3_count)}")
-    fh_log.write(f"In \'3 UTR {str(utr3_count)}\n")
+    def lookup(self, key):
+        (chr, pos) = key
+        if self.index is not None:
+            rows = self.index.overlap(chr, pos)
+        else:
+            rows = self.backend.rangeQuery(self.cursor, self.table, str(chr), 
+                pos, pos)
+        records = []
+        r_tmp = []
+        for row in rows:
+            t = str(str(row[5]) + ',' + str(row[6])).strip()
+            if not fu.isOnTheList(r_tmp, t):
+                r_tmp.append(t)
+                records.append('HGNC_GeneAnnotation' + '=' + t)
+        return (len(rows), ','.join(records).replace(';', ','))
+
+    def apply(self, record, result):
+        (hits, records_str) = result
+        if (hits == 0):
+            return
+
+        self.counts['line_count'] = self.counts['line_count'] + 1
+        self.counts['var_count'] = self.counts['var_count'] + hits
+        record.info.add(records_str)
 
-    print(f"In \'5 UTR {str(utr5_count)}")
-    fh_log.write(f"In \'5 UTR {str(utr5_count)}\n")
 
-    print(f"In Intronic {str(intronic_count)}")
-    fh_log.write(f"In Intronic "+str(intronic_count) +'\n')
+"""Overlap with segdup regions genomicSuperDups
+"""
+class GenomicSuperDupsAnnotator(OverlapAnnotator):
 
-    print(f"In Non_coding_intronic {str(non_coding_intronic_count)}")
-    fh_log.write(f"In Non_coding_intronic {str(non_coding_intronic_count)}\n")
+    def __init__(self, cursor, format='vcf', table='genomicSuperDups', 
+        sep='\t', index=None):
+        OverlapAnnotator.__init__(self, cursor, format=format, table=table, 
+            sep=sep, index=index)
 
-    print(f"In Exonic {str(exonic_count)}")
-    fh_log.write(f"In Exonic {str(exonic_count)}\n")
+    def lookup(self, key):
+        (chr, pos) = key
+        if self.index is not None:
+            rows = self.index.first(chr, pos)
+        else:
+            rows = self.backend.rangeFirst(self.cursor, self.table, str(chr), 
+                pos, pos)
+        if rows is None:
+            return None
+        return (str(rows[7]), str(rows[8]), str(rows[9]))
+
+    def apply(self, record, other):
+        if other is not None:
+            self.counts['line_count'] = self.counts['line_count'] + 1
+            self.counts['var_count'] = self.counts['var_count'] + 1
+            (otherChrom, otherStart, otherEnd) = other
+            record.info.append(str(self.table) + '=' + \
+                str(True) + ';' + 'otherChrom=' + \
+                str(otherChrom) + ';otherStart=' + \
+                str(otherStart) + ';otherEnd=' + str(otherEnd))
 
-    print(f"In Non_coding_exonic {str(non_coding_exonic_count)}")
-    fh_log.write(f"In Non_coding_exonic {str(non_coding_exonic_count)}\n")
 
-    print(f"In Putative Promoter Region {str(promoter_count)}")
-    fh_log.write(f"In Putative Promoter Region {str(promoter_count)}\n")
+"""Searches Genes Databases and returns Genes/Cytobands 
+   with which SNP or INDEL overlaps
+"""
+class RefGeneAnnotator(OverlapAnnotator):
+    colindex = 1
+    colindex2 = 12
 
-    fh_out.close()
-    fh_log.close()
-    fh.close()
-    conn.close()
+    def __init__(self, cursor, format='vcf', table='refGene', sep='\t'):
+        OverlapAnnotator.__init__(self, cursor, format=format, table=table, 
+            sep=sep)
+
+    def lookup(self, key):
+        (chr, pos) = key
+        overlapsWith = []
+        for row in self.backend.rangeQuery(self.cursor, self.table, str(chr), 
+            pos, pos, startName='txStart', endName='txEnd'):
+            overlapsWith.append('name2' + '=' + \
+                str(row[self.colindex2]) + ';' + 'name' + '=' + \
+                str(row[self.colindex]))
+        return overlapsWith
+
+    def apply(self, record, overlapsWith):
+        if (len(overlapsWith) > 0):
+            self.counts['line_count'] = self.counts['line_count'] + 1
+            self.counts['var_count'] = self.counts['var_count'] + \
+                len(overlapsWith)
+            genes = ';'.join([str(x) for x in overlapsWith])
+            record.info.add(str(genes))
 
 
-"""Overlap with tfbsConsSites
+"""Method to find overlap with Cytoband table
 """
-def addOverlapWithTfbsConsSites(vcf, format='vcf', table='tfbsConsSites', 
-    tmpextin='.2', tmpextout='.3', sep='\t'):
+class CytobandAnnotator(OverlapAnnotator):
+
+    def __init__(self, cursor, format='vcf', table='cytoBand', sep='\t', 
+        index=None):
+        OverlapAnnotator.__init__(self, cursor, format=format, table=table, 
+            sep=sep, index=index)
+        self.colindex = 12
+        self.startName = 'txStart'
+        self.endName = 'txEnd'
+
+        if (table == 'cytoBand'):
+            self.colindex = 3
+            self.startName = 'chromStart'
+            self.endName = 'chromEnd'
+
+    def lookup(self, key):
+        (chr, pos) = key
+        if self.index is not None:
+            rows = self.index.overlap(chr, pos)
+        else:
+            rows = self.backend.rangeQuery(self.cursor, self.table, str(chr), 
+                pos, pos, startName=self.startName, endName=self.endName)
+        overlapsWith = u.dedup([str(row[self.colindex]) for row in rows])
+        return (len(rows), overlapsWith)
 
-    allowed_chrom=['1','2','3','4','5','6','7','8','9','10','11','12','13',
-        '14','15','16','17','18','19','20','21','22','X','Y']
+    def apply(self, record, result):
+        (hits, overlapsWith) = result
+        if (hits > 0):
+            self.counts['line_count'] = self.counts['line_count'] + 1
+            self.counts['var_count'] = self.counts['var_count'] + hits
+            cytoband = ';'.join([str(x) for x in overlapsWith])
+            record.info.add(str(self.table) + '=' + str(cytoband))
 
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
 
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
+"""Method to find overlap with CNV tables
+"""
+class CnvDatabaseAnnotator(OverlapAnnotator):
 
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
+    def __init__(self, cursor, format='vcf', table='dgv_Cnv', sep='\t', 
+        index=None):
+        OverlapAnnotator.__init__(self, cursor, format=format, table=table, 
+            sep=sep, index=index)
 
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
+    def lookup(self, key):
+        (chr, pos) = key
+        if self.index is not None:
+            return (self.index.first(chr, pos) is not None)
+        return (self.backend.rangeFirst(self.cursor, self.table, str(chr), 
+            pos, pos) is not None)
 
-    linenum = 1
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if (line.startswith("##")):
-            fh_out.write(line + '\n')
+    def apply(self, record, isOverlap):
+        if isOverlap:
+            self.counts['line_count'] = self.counts['line_count'] + 1
+            self.counts['var_count'] = self.counts['var_count'] + 1
+            record.info.add(str(self.table) + '=' + str(isOverlap))
 
-        #header line
-        elif (line.startswith('#CHROM') or line.startswith('CHROM')):
-            fh_out.write(line + '\n')
 
+"""Method to find overlap with targetScanS tables
+"""
+class MiRNAAnnotator(OverlapAnnotator):
+
+    def __init__(self, cursor, format='vcf', table='targetScanS', sep='\t', 
+        index=None):
+        OverlapAnnotator.__init__(self, cursor, format=format, table=table, 
+            sep=sep, index=index)
+        self.name = 'miRNA'
+
+    def lookup(self, key):
+        (chr, pos) = key
+        if self.index is not None:
+            rows = self.index.first(chr, pos)
         else:
-            fields = line.split(sep)
-            chr = fields[inds[0]].strip()
-            # For some reason this table has no "chr" preceeding number
-            if not chr.startswith("chr"):
-                chr = "chr" + chr
-
-            pos=fields[inds[1]].strip()
-            isOverlap = False
-            chrIndex=chr.replace('chr', '')
-
-            if (chrIndex in allowed_chrom):
-                isOverlap = False
-                sql = 'select chrom, chromStart, chromEnd, name ' + \
-                    'from tfbsConsSites' + chrIndex + \
-                    ' where  chromStart <= ' + str(pos) + ' AND ' + \
-                    str(pos) + ' <= chromEnd;'
-                cursor.execute(sql)
-                rows = cursor.fetchall()
-                records = []
-
-                if (len(rows) > 0):
-                    records_count = 1
-                    line_count = line_count + 1
-
-                    for row in rows:
-                        var_count = var_count + 1
-                        t = str(row[3]) + '.' + str(row[0]) + '.' + \
-                            str(row[1]) + '.' + str(row[2])
-                        t = t.strip()
-                        records.append('tfbsRegion' + '=' + t)
-                        records_count = records_count + 1
-
-                    if str(fields[7]).endswith(';'):
-                        fields[7] = fields[7] + ';'.join(records)
-                    else:
-                        fields[7] = fields[7] + ';' + ';'.join(records)
-
-                    fh_out.write('\t'.join(fields) + '\n')
-
-                else: # chrom is not on the list
-                    fh_out.write(line + '\n')
-
-            else: # chrom is not on the list
-                fh_out.write(line + '\n')
-
-        linenum = linenum + 1
-
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
-
-    conn.close()
-    fh.close()
-    fh_out.close()
+            rows = self.backend.rangeFirst(self.cursor, self.table, str(chr), 
+                pos, pos)
+        if rows is None:
+            return None
+        t = str(rows[4]) + ',' +  str(rows[1]) + '_' + \
+            str(rows[2]) + '_' + str(rows[3])
+        return 'miRNAsites=' + t.strip()
+
+    def apply(self, record, t):
+        if t is not None:
+            self.counts['line_count'] = self.counts['line_count'] + 1
+            self.counts['var_count'] = self.counts['var_count'] + 1
+            record.info.add(t)
+
+    def writeLog(self, fh_log):
+        fh_log.write(f"In miRNAsites: {str(self.counts['var_count'])} in " + \
+            f"{str(self.counts['line_count'])} variants\n")
+
+
+"""Runs one stage over basefile + tmpextin into basefile + tmpextout, 
+   writing its counts to basefile.count.log
+"""
+def runAnnotator(annotator_class, basefile, tmpextin, tmpextout, 
+    logmode='a', **kwargs):
+    with backends.getBackend().connection() as conn:
+        annotator = annotator_class(conn.cursor(), **kwargs)
+        pipeline.annotateFile([annotator], basefile + tmpextin, 
+            basefile + tmpextout)
+    pipeline.writeLogs([annotator], basefile + '.count.log', mode=logmode)
 
 
-"""Overlap with GadAll table
-"""
-def addOverlapWithGadAll(vcf, format='vcf', table='gadAll', tmpextin='', 
-    tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
-
-    logcountfile = basefile+'.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
-
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                # For some reason this table has no "chr" preceeding number
-                if chr.startswith("chr"):
-                    chr = str(chr).replace("chr", "")
-
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-
-                sql = 'select * from ' + table + ' where chromosome="' + \
-                    str(chr) + '" AND (chromStart <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= chromEnd);'
-                cursor.execute(sql)
-                rows = cursor.fetchall()
-                records = []
-
-                if (len(rows) > 0):
-                    records_count = 1
-                    line_count = line_count + 1
-                    r_tmp = []
-                    for row in rows:
-                        var_count = var_count + 1
-                        if not fu.isOnTheList(r_tmp, str(row[3])):
-                            r_tmp.append(str(row[3]) )
-                            records.append(str(table) + '=' + str(row[3]))
-                            records_count = records_count + 1
-                    if str(fields[7]).endswith(';'):
-                        fields[7] = fields[7] + ';'.join(records)
-                    else:
-                        fields[7] = fields[7] + ';' + ';'.join(records)
-                    fh_out.write('\t '.join(fields) + '\n')
-                else:
-                    fh_out.write(line + '\n')
+def getSnpsFromDbSnp(vcf, format='vcf', tmpextin='', tmpextout='.1',
+    varclass='SNV', sep='\t', batch_size=1):
+    runAnnotator(DbSnpAnnotator, vcf, tmpextin, tmpextout, logmode='w', 
+        format=format, varclass=varclass, sep=sep, batch_size=batch_size)
 
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + '\n')
 
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
+def getBigRefGene(vcf, format='vcf', tmpextin='.1', tmpextout='.2', sep='\t'):
+    runAnnotator(BigRefGeneAnnotator, vcf, tmpextin, tmpextout, 
+        format=format, sep=sep)
 
-    conn.close()
-    fh.close()
-    fh_out.close()
 
+def getGenes(vcf, format='vcf', table='refGene', promoter_offset=500, 
+    tmpextin='.2', tmpextout='.3', sep='\t'):
+    runAnnotator(GenesAnnotator, vcf, tmpextin, tmpextout, format=format, 
+        table=table, promoter_offset=promoter_offset, sep=sep)
 
-""" Overlap with gwasCatalog table """
-def addOverlapWithGwasCatalog(vcf, format='vcf', table='gwasCatalog', \
-    tmpextin='', tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
-
-    logcountfile = basefile+'.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
-
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
-                
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-
-                sql = 'select * from ' + table + ' where chrom="' + \
-                    str(chr) + '" AND chromEnd = ' + str(pos) + ';'
-                cursor.execute(sql)
-                rows = cursor.fetchall()
-                records = []
-
-                if (len(rows) > 0):
-                    line_count = line_count + 1
-                    records_count = 1
-                    for row in rows:
-                        var_count = var_count + 1
-                        records.append(str(table) + '=' + str('pubMedID') + \
-                            '=' + str(row[5]) + ',trait=' + str(row[10]))
-                        records_count = records_count + 1
-                    if str(fields[7]).endswith(';'):
-                        fields[7] = fields[7] + ';'.join(records)
-                    else:
-                        fields[7] = fields[7] + ';' + ';'.join(records)
-                    fh_out.write('\t'.join(fields) + '\n')
-                else:
-                    fh_out.write(line + '\n')
 
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + '\n')
+def getExonsEtAl(vcf, format='vcf', table='refGene', promoter_offset=500, 
+    tmpextin='.2', tmpextout='.3', sep='\t'):
+    runAnnotator(ExonsEtAlAnnotator, vcf, tmpextin, tmpextout, format=format,
+        table=table, promoter_offset=promoter_offset, sep=sep)
 
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+def addOverlapWithTfbsConsSites(vcf, format='vcf', table='tfbsConsSites', 
+    tmpextin='.2', tmpextout='.3', sep='\t'):
+    runAnnotator(TfbsConsSitesAnnotator, vcf, tmpextin, tmpextout, 
+        format=format, table=table, sep=sep)
 
 
-"""Overlap with HUGO Gene Nomenclature Committee (HGNC) table
-"""
-def addOverlapWitHUGOGeneNomenclature(vcf, format='vcf', table='hugo', 
-    tmpextin='', tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
-
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
-
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
-
-                pos=fields[inds[1]].strip()
-                isOverlap = False
-
-                sql = 'select * from ' + table + ' where chrom="' + \
-                    str(chr) + '" AND (chromStart <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= chromEnd);'
-                cursor.execute(sql)
-                rows = cursor.fetchall()
-                records = []
-
-                if (len(rows) > 0):
-                    line_count = line_count + 1
-                    records_count = 1
-                    r_tmp = []
-                    for row in rows:
-                        var_count = var_count + 1
-                        t = str(str(row[5]) + ',' + str(row[6])).strip()
-                        if not fu.isOnTheList(r_tmp, t):
-                            r_tmp.append(t)
-                            records.append('HGNC_GeneAnnotation' + '=' + t)
-                        records_count = records_count + 1
-
-                    records_str = ','.join(records).replace(';', ',')
-
-                    if str(fields[7]).endswith(';'):
-                        fields[7] = fields[7] +records_str
-                    else:
-                        fields[7] = fields[7] + ';' + records_str
-                    fh_out.write('\t'.join(fields) + '\n')
-                else:
-                    fh_out.write(line + '\n')
+def addOverlapWithGadAll(vcf, format='vcf', table='gadAll', tmpextin='', 
+    tmpextout='.1', sep='\t'):
+    runAnnotator(GadAllAnnotator, vcf, tmpextin, tmpextout, format=format, 
+        table=table, sep=sep)
 
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + '\n')
 
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
+def addOverlapWithGwasCatalog(vcf, format='vcf', table='gwasCatalog', \
+    tmpextin='', tmpextout='.1', sep='\t'):
+    runAnnotator(GwasCatalogAnnotator, vcf, tmpextin, tmpextout, 
+        format=format, table=table, sep=sep)
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+
+def addOverlapWitHUGOGeneNomenclature(vcf, format='vcf', table='hugo', 
+    tmpextin='', tmpextout='.1', sep='\t'):
+    runAnnotator(HugoAnnotator, vcf, tmpextin, tmpextout, format=format, 
+        table=table, sep=sep)
 
 
-"""Overlap with segdup regions genomicSuperDups
-"""
 def addOverlapWithGenomicSuperDups(vcf, format='vcf', 
     table='genomicSuperDups', tmpextin='', tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
-
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
-
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
-
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-                otherChrom = ''
-                otherStart = ''
-                otherEnd = ''
-                l = str(isOverlap)
-
-                sql = 'select * from ' + table + ' where chrom="'+ str(chr) + \
-                    '" AND (chromStart <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= chromEnd);'
-                cursor.execute(sql)
-                rows = cursor.fetchone()
-
-                if rows is not None:
-                    line_count = line_count + 1
-                    var_count = var_count + 1
-                    isOverlap = True
-                    otherChrom = rows[7]
-                    otherStart = rows[8]
-                    otherEnd = rows[9]
-                    fields[7] = fields[7] + ';' + str(table) + '=' + \
-                        str(isOverlap) + ';' + 'otherChrom=' + \
-                        str(otherChrom) + ';otherStart=' + \
-                        str(otherStart) + ';otherEnd=' + str(otherEnd)
-
-                fh_out.write('\t'.join(fields) + '\n')
-
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + '\n')
-
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
-
-    conn.close()
-    fh.close()
-    fh_out.close()
+    runAnnotator(GenomicSuperDupsAnnotator, vcf, tmpextin, tmpextout, 
+        format=format, table=table, sep=sep)
 
 
-"""Searches Genes Databases and returns Genes/Cytobands 
-   with which SNP or INDEL overlaps
-"""
 def addOverlapWithRefGene(vcf, format='vcf', table='refGene', 
     tmpextin='', tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
-
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
-    colindex = 1
-    colindex2 = 12
-    name = 'name'
-    name2 = 'name2'
-    startName = 'txStart'
-    endName = 'txEnd'
-
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
-
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-                
-                sql = 'select * from ' + table + ' where chrom="' + \
-                    str(chr) + '" AND (' + startName + ' <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= ' + endName +');'
-                overlapsWith = []
-                cursor.execute(sql)
-                rows = cursor.fetchall()
-
-                if (len(rows) > 0):
-                    line_count = line_count + 1
-                    for row in rows:
-                        var_count = var_count + 1
-                        overlapsWith.append(name2 + '=' + \
-                            str(row[colindex2]) + ';' + name + '=' + \
-                            str(row[colindex]))
-
-                    genes = ';'.join([str(x) for x in overlapsWith])
-                    if str(fields[7]).endswith(";"):
-                        fields[7] = fields[7] + str(genes)
-                    else:
-                        fields[7] = fields[7] + ';' + str(genes)
-                fh_out.write('\t'.join(fields) + '\n')
-
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + '\n')
-
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
-
-    conn.close()
-    fh.close()
-    fh_out.close()
+    runAnnotator(RefGeneAnnotator, vcf, tmpextin, tmpextout, format=format, 
+        table=table, sep=sep)
 
 
-"""Method to find overlap with Cytoband table
-"""
 def addOverlapWithCytoband(vcf, format='vcf', table='cytoBand', 
     tmpextin='', tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
-
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
-    colindex = 12
-    startName = 'txStart'
-    endName = 'txEnd'
-
-    if (table == 'cytoBand'):
-        colindex = 3
-        startName = 'chromStart'
-        endName = 'chromEnd'
-
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
-
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-                
-                sql = 'select * from ' + table + ' where chrom="' + \
-                    str(chr) + '" AND (' + startName + ' <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= ' + endName + ');'
-                overlapsWith = []
-                cursor.execute(sql)
-                rows = cursor.fetchall()
-
-                if (len(rows) > 0):
-                    line_count = line_count + 1
-                    for row in rows:
-                        var_count = var_count + 1
-                        overlapsWith.append(str(row[colindex]))
-                    overlapsWith = u.dedup(overlapsWith)
-                    cytoband = ';'.join([str(x) for x in overlapsWith])
-
-                    if str(fields[7]).endswith(";"):
-                        fields[7] = fields[7] + str(table) + '=' + str(cytoband)
-                    else:
-                        fields[7] = fields[7] + ';' + str(table) + '=' + str(cytoband)
-                fh_out.write('\t'.join(fields) + '\n')
-
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + '\n')
-
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
+    runAnnotator(CytobandAnnotator, vcf, tmpextin, tmpextout, format=format, 
+        table=table, sep=sep)
 
-    conn.close()
-    fh.close()
-    fh_out.close()
 
-
-"""Method to find overlap with CNV tables
-"""
 def addOverlapWithCnvDatabase(vcf, format='vcf', table='dgv_Cnv', 
     tmpextin='', tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
-
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
-
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
-
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-                sql = 'select * from ' + table + ' where chrom="' + \
-                    str(chr) + '" AND (chromStart <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= chromEnd);'
-                cursor.execute(sql)
-                rows = cursor.fetchone()
-
-                if rows is not None:
-                    line_count = line_count + 1
-                    var_count = var_count + 1
-                    isOverlap = True
-                    if str(fields[7]).endswith(";"):
-                        fields[7] = fields[7] + str(table) + '=' + \
-                        str(isOverlap)
-                    else:
-                        fields[7] = fields[7] + ';' + str(table) + \
-                        '='+str(isOverlap)
-                fh_out.write('\t'.join(fields) + '\n')
-
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + '\n')
-
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
-
-    conn.close()
-    fh.close()
-    fh_out.close()
+    runAnnotator(CnvDatabaseAnnotator, vcf, tmpextin, tmpextout, 
+        format=format, table=table, sep=sep)
 
 
-"""Method to find overlap with targetScanS tables
-"""
 def addOverlapWithMiRNA(vcf, format='vcf', table='targetScanS', 
     tmpextin='', tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
-
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
-
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
-
-                pos = fields[inds[1]].strip()
-                sql = 'select * from ' + table + ' where chrom="' + \
-                    str(chr) + '" AND (chromStart <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= chromEnd);'
-                cursor.execute(sql)
-                rows = cursor.fetchone()
-
-                if rows is not None:
-                    line_count = line_count + 1
-                    var_count = var_count + 1
-                    t = str(rows[4]) + ',' +  str(rows[1]) + '_' + \
-                        str(rows[2]) + '_' + str(rows[3])
-                    t = 'miRNAsites=' + t.strip()
-                    if str(fields[7]).endswith(";"):
-                        fields[7] = fields[7] + t
-                    else:
-                        fields[7] = fields[7] + ';' + t
-                fh_out.write('\t'.join(fields) + '\n')
-
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + '\n')
-
-    fh_log.write(f"In miRNAsites: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
-
-    conn.close()
-    fh.close()
-    fh_out.close()
+    runAnnotator(MiRNAAnnotator, vcf, tmpextin, tmpextout, format=format, 
+        table=table, sep=sep)
 
-### EOF
\ No newline at end of file
+### EOF
@@ -5,15 +5,20 @@ from boto3.exceptions import Boto3Error
 from botocore.exceptions import BotoCoreError
 from botocore.exceptions import ClientError
 from uuid import uuid4
-import subprocess
-from subprocess import SubprocessError
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
 from datetime import datetime, timedelta
 import os
+import glob
+import time
+import threading
+import hashlib
 import logging
 import json
 import ast
 from configparser import ConfigParser
-
+import run
 
 current_file_path = os.path.abspath(__file__)
 current_dir_path = os.path.dirname(current_file_path)
@@ -24,86 +29,371 @@ config.read(config_file_path)
 logging.basicConfig(filename=log_file_path, level=logging.ERROR)
 
 
-region = config["aws"]["AwsRegionName"]
-s3 = boto3.resource("s3", region_name=region)
-s3_client = boto3.client("s3", region_name=region)
-results_bucket = s3.Bucket(config["aws"]["AwsS3ResultsBucket"])
-dynamodb = boto3.resource("dynamodb")
-table = dynamodb.Table(config["aws"]["AwsDynamodbAnnotationsTable"])
-# Connect to SQS and get the message queue
-sqs = boto3.client("sqs", region_name=region)
-queue_url = sqs.get_queue_url(QueueName=config["aws"]["AwsSqsJobRequestQueueName"])[
-    "QueueUrl"
-]
-
-# Poll the message queue in a loop
-print("Start listening to the message queue...")
-while True:
-    try:
-        # Attempt to read a message from the queue
-        # Use long polling - DO NOT use sleep() to wait between polls
-        messages = sqs.receive_message(
+"""Pool of warm worker processes that run jobs with run.annotate_job
+
+   Workers are forked from a server process that has already imported
+   run.py (and with it the annotation driver and boto3), so a job starts
+   without interpreter startup or imports. Each worker keeps its AWS
+   clients and reference handles across the jobs it runs.
+"""
+
+
+def job_workers():
+    return config.getint("ann", "JobWorkers", fallback=0) or os.cpu_count()
+
+
+def start_workers():
+    context = multiprocessing.get_context("forkserver")
+    context.set_forkserver_preload(["run"])
+    return ProcessPoolExecutor(
+        max_workers=job_workers(),
+        mp_context=context,
+        initializer=run.init_worker,
+    )
+
+
+"""Reports the jobs that have finished, drops them from jobs, a dict of
+   future -> job, and returns the receipt handles of the ones that
+   succeeded
+
+   The message of a failed job is left on the queue; it is received again
+   once its visibility timeout lapses.
+"""
+
+
+def reap_jobs(jobs):
+    handles = []
+    for future in [f for f in jobs if f.done()]:
+        job = jobs.pop(future)
+        error = future.exception()
+        if error is None:
+            result = future.result()
+            print(f"Job {job['job_id']} finished in {result['secs']:.2f} seconds.")
+            handles.append(job["handle"])
+        else:
+            print(f"error {error}")
+            logging.error(f"Job {job['job_id']} failed: {error!r}")
+    return handles
+
+
+"""Bytes a job has written so far: the total size of its files in the
+   data folder, which all start with its job id (0 until the job id is
+   known)
+"""
+
+
+def job_progress(job):
+    size = 0
+    if job["prefix"] is None:
+        return size
+    for path in glob.glob(glob.escape(job["prefix"]) + "*"):
+        try:
+            size = size + os.path.getsize(path)
+        except OSError:
+            pass
+    return size
+
+
+"""Keeps the messages of jobs hidden while the jobs make progress
+
+   A message is extended by visibility_timeout once less than half of its
+   current timeout is left. A job whose files have not grown for
+   stall_timeout seconds is reported as stalled, once, but its message is
+   still extended: a pool worker cannot be interrupted in the middle of a
+   task, so letting the message lapse would run the job a second time
+   while the first run still holds its worker and would delete the
+   message with an outdated receipt handle when it ends.
+"""
+
+
+def heartbeat(sqs, queue_url, jobs, visibility_timeout, stall_timeout):
+    now = time.time()
+    due = []
+    for job in jobs:
+        size = job_progress(job)
+        # A message waiting for its download to start is not stalled
+        if (size != job["size"]) or (job["prefix"] is None):
+            job["size"] = size
+            job["progressed"] = now
+            job["stalled"] = False
+        if (now - job["progressed"] > stall_timeout) and not job["stalled"]:
+            job["stalled"] = True
+            logging.error(
+                f"Job {job['job_id']} made no progress for {stall_timeout} seconds"
+            )
+        if job["visible_at"] - now > visibility_timeout / 2:
+            continue
+        due.append(job)
+
+    for i in range(0, len(due), 10):
+        batch = due[i : i + 10]
+        response = sqs.change_message_visibility_batch(
             QueueUrl=queue_url,
-            MaxNumberOfMessages=1,
-            WaitTimeSeconds=3,
+            Entries=[
+                {
+                    "Id": str(n),
+                    "ReceiptHandle": job["handle"],
+                    "VisibilityTimeout": visibility_timeout,
+                }
+                for (n, job) in enumerate(batch)
+            ],
         )
-        # If message read, extract job parameters from the message body as before
-
-        if "Messages" in messages:
-            # Get the first message
-            msg = messages["Messages"][0]
-
-            # Get the message body
-
-            body = msg["Body"]
-            body_json = json.loads(body)
-            data = ast.literal_eval(body_json["Message"])
-
-            bucket = data["s3_input_bucket"]
-            key = data["s3_key_input_file"]
-            user_id = data["user_id"]
-            user_email = data["user_email"]
-            job_id = data["job_id"]
-            file_name = data["file_name"]
-            print(f"Processing job {key}..")
-
-            # Include below the same code you used in prior homework
-            # Get the input file S3 object and copy it to a local file
-            # Use a local directory structure that makes it easy to organize
-            # multiple running annotation jobs
-
-            if not key.endswith(".vcf"):
-                s3_client.delete_object(Bucket=bucket, Key=key)
-
-            file_path = os.path.join(current_dir_path, "data", f"{job_id}~{file_name}")
-            os.makedirs(
-                os.path.dirname(file_path), exist_ok=True
-            )  # Create dir if doesn't exist
-            with open(file_path, "wb") as f:
-                s3_client.download_fileobj(bucket, key, f)
-
-            run_file_path = os.path.join(current_dir_path, "run.py")
-            ps = subprocess.Popen(
-                ["python3", run_file_path, file_path, user_id, user_email, job_id]
-            )
-            table.update_item(
-                Key={"job_id": job_id},
-                UpdateExpression="SET job_status = :new_status",
-                ConditionExpression="job_status = :expected_status",
-                ExpressionAttributeValues={
-                    ":new_status": "RUNNING",
-                    ":expected_status": "PENDING",
-                },
+        for done in response.get("Successful", []):
+            batch[int(done["Id"])]["visible_at"] = now + visibility_timeout
+        for failed in response.get("Failed", []):
+            logging.error(f"Could not extend message visibility: {failed}")
+
+
+"""Runs heartbeat() on its own thread every tenth of the visibility
+timeout, over the running jobs and the messages received but not yet
+handed to a worker (jobs and receiving, guarded by lock), so a long
+download or a busy main loop does not let messages lapse. Jobs that
+have finished are reaped and their messages deleted first.
+"""
+
+
+def start_heartbeat(
+    sqs, queue_url, jobs, receiving, lock, visibility_timeout, stall_timeout
+):
+    def beat():
+        while True:
+            time.sleep(max(1, visibility_timeout / 10))
+            with lock:
+                handles = reap_jobs(jobs)
+                tracked = list(jobs.values()) + list(receiving.values())
+            try:
+                delete_messages(sqs, queue_url, handles)
+                heartbeat(sqs, queue_url, tracked, visibility_timeout, stall_timeout)
+            except (ClientError, BotoCoreError) as e:
+                logging.error(f"Heartbeat failed: {e}")
+
+    thread = threading.Thread(target=beat, daemon=True)
+    thread.start()
+    return thread
+
+
+"""File object that hashes what is written to it on the way to fileobj
+
+   It has no seek(), so downloads write to it in order and the hash is
+   that of the whole object once the download is done.
+"""
+
+
+class HashingWriter(object):
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.hash = hashlib.sha256()
+
+    def write(self, data):
+        self.hash.update(data)
+        return self.fileobj.write(data)
+
+    def hexdigest(self):
+        return self.hash.hexdigest()
+
+
+"""Deletes the messages with the given receipt handles, ten per request
+"""
+
+
+def delete_messages(sqs, queue_url, handles):
+    for i in range(0, len(handles), 10):
+        response = sqs.delete_message_batch(
+            QueueUrl=queue_url,
+            Entries=[
+                {"Id": str(n), "ReceiptHandle": handle}
+                for (n, handle) in enumerate(handles[i : i + 10])
+            ],
+        )
+        for failed in response.get("Failed", []):
+            logging.error(f"Could not delete message: {failed}")
+
+
+if __name__ == "__main__":
+    region = config["aws"]["AwsRegionName"]
+    s3 = boto3.resource("s3", region_name=region)
+    s3_client = boto3.client("s3", region_name=region)
+    results_bucket = s3.Bucket(config["aws"]["AwsS3ResultsBucket"])
+    dynamodb = boto3.resource("dynamodb")
+    table = dynamodb.Table(config["aws"]["AwsDynamodbAnnotationsTable"])
+    # Connect to SQS and get the message queue
+    sqs = boto3.client("sqs", region_name=region)
+    queue_url = sqs.get_queue_url(QueueName=config["aws"]["AwsSqsJobRequestQueueName"])[
+        "QueueUrl"
+    ]
+
+    pool = start_workers()
+    slots = job_workers()
+    visibility_timeout = config.getint("ann", "JobVisibilityTimeout", fallback=300)
+    stall_timeout = config.getint("ann", "JobStallTimeout", fallback=1800)
+    reuse = config.getboolean("ann", "ResultReuse", fallback=True)
+    stream_input = config.getboolean("ann", "StreamInput", fallback=False)
+    jobs = {}
+    receiving = {}
+    lock = threading.Lock()
+    start_heartbeat(
+        sqs, queue_url, jobs, receiving, lock, visibility_timeout, stall_timeout
+    )
+
+    # Poll the message queue in a loop
+    print("Start listening to the message queue...")
+    while True:
+        messages = {}
+        try:
+            with lock:
+                handles = reap_jobs(jobs)
+            delete_messages(sqs, queue_url, handles)
+
+            # Take only as many jobs as there are idle workers; the rest
+            # stay on the queue for other annotators
+            free = slots - len(jobs)
+            if free <= 0:
+                wait(list(jobs), timeout=3, return_when=FIRST_COMPLETED)
+                continue
+
+            # Attempt to read messages from the queue
+            # Use long polling - DO NOT use sleep() to wait between polls
+            # Received messages stay invisible for visibility_timeout, and
+            # are kept invisible by the heartbeat thread from here until
+            # their jobs finish
+            received = time.time()
+            messages = sqs.receive_message(
+                QueueUrl=queue_url,
+                MaxNumberOfMessages=min(free, 10),
+                WaitTimeSeconds=3,
+                VisibilityTimeout=visibility_timeout,
             )
+            with lock:
+                for msg in messages.get("Messages", []):
+                    receiving[msg["ReceiptHandle"]] = {
+                        "job_id": None,
+                        "handle": msg["ReceiptHandle"],
+                        "prefix": None,
+                        "visible_at": received + visibility_timeout,
+                        "size": 0,
+                        "progressed": time.time(),
+                        "stalled": False,
+                    }
+            # If messages read, extract job parameters from each message body as before
+
+            for msg in messages.get("Messages", []):
+                try:
+                    # Get the message body
+
+                    body = msg["Body"]
+                    body_json = json.loads(body)
+                    data = ast.literal_eval(body_json["Message"])
+
+                    bucket = data["s3_input_bucket"]
+                    key = data["s3_key_input_file"]
+                    user_id = data["user_id"]
+                    user_email = data["user_email"]
+                    job_id = data["job_id"]
+                    file_name = data["file_name"]
+                    print(f"Processing job {key}..")
+
+                    # Include below the same code you used in prior homework
+                    # Get the input file S3 object and copy it to a local file
+                    # Use a local directory structure that makes it easy to organize
+                    # multiple running annotation jobs
+
+                    if not (
+                        key.endswith(".vcf")
+                        or (stream_input and key.endswith(".vcf.gz"))
+                    ):
+                        s3_client.delete_object(Bucket=bucket, Key=key)
+
+                    file_path = os.path.join(
+                        current_dir_path, "data", f"{job_id}~{file_name}"
+                    )
+                    os.makedirs(
+                        os.path.dirname(file_path), exist_ok=True
+                    )  # Create dir if doesn't exist
+                    job = receiving[msg["ReceiptHandle"]]
+                    job["job_id"] = job_id
+                    job["prefix"] = os.path.join(
+                        os.path.dirname(file_path), f"{job_id}~"
+                    )
+                    if stream_input:
+                        # The worker reads the input from S3 as it downloads;
+                        # its results are indexed for reuse, but the hash is
+                        # only known once the whole input has been read
+                        if file_path.endswith(".gz"):
+                            file_path = file_path[:-3]
+                        future = pool.submit(
+                            run.stream_job,
+                            bucket,
+                            key,
+                            file_path,
+                            user_id,
+                            user_email,
+                            job_id,
+                        )
+                    else:
+                        with open(file_path, "wb") as f:
+                            writer = HashingWriter(f)
+                            s3_client.download_fileobj(bucket, key, writer)
+
+                        # Inputs annotated before against the same reference
+                        # release get a copy of the earlier results
+                        digest = writer.hexdigest() if reuse else None
+                        entry = run.find_result(digest) if reuse else None
+                        if entry is not None:
+                            future = pool.submit(
+                                run.reuse_job,
+                                file_path,
+                                user_id,
+                                user_email,
+                                job_id,
+                                digest,
+                                entry,
+                            )
+                        else:
+                            future = pool.submit(
+                                run.annotate_job,
+                                file_path,
+                                user_id,
+                                user_email,
+                                job_id,
+                                digest,
+                            )
+                    with lock:
+                        jobs[future] = receiving.pop(msg["ReceiptHandle"])
+                    table.update_item(
+                        Key={"job_id": job_id},
+                        UpdateExpression="SET job_status = :new_status",
+                        ConditionExpression="job_status = :expected_status",
+                        ExpressionAttributeValues={
+                            ":new_status": "RUNNING",
+                            ":expected_status": "PENDING",
+                        },
+                    )
+                except KeyError as e:
+                    print(f"error {e}")
+                    logging.error(f"Key error {e} while handling message: {msg}")
+                except ClientError as e:
+                    print(f"error {e}")
+                    logging.error(f"ClientError {e} while handling message: {msg}")
+                finally:
+                    # A message that did not become a job is received again
+                    # once its visibility lapses
+                    with lock:
+                        receiving.pop(msg["ReceiptHandle"], None)
 
-            sqs.delete_message(QueueUrl=queue_url, ReceiptHandle=msg["ReceiptHandle"])
-
-    except KeyError as e:
-        print(f"error {e}")
-        logging.error(f"Key error {e} while handling message: {messages}")
-    except SubprocessError as e:
-        print(f"error {e}")
-        logging.error(f"SubprocessError {e} while handling message: {messages}")
-    except ClientError as e:
-        print(f"error {e}")
-        logging.error(f"ClientError {e} while handling message: {messages}")
+        except BrokenProcessPool as e:
+            # A worker died; its jobs' messages are received again once
+            # their visibility lapses. Start a fresh pool.
+            print(f"error {e}")
+            logging.error(f"BrokenProcessPool {e} while handling message: {messages}")
+            with lock:
+                handles = reap_jobs(jobs)
+            delete_messages(sqs, queue_url, handles)
+            pool.shutdown(wait=False)
+            pool = start_workers()
+        except ClientError as e:
+            print(f"error {e}")
+            logging.error(f"ClientError {e} while handling message: {messages}")
+        finally:
+            # Stop extending what is left of a batch cut short by an error
+            with lock:
+                receiving.clear()
@@ -0,0 +1,492 @@
+# backends.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Reference database backends, selected by [ann] Backend
+#
+# Build the R*Tree indexes of a SQLite reference database with:
+#   python backends.py reference.db cytoBand hugo gadAll:chromosome ...
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+import pymysql
+import utils as u
+import intervals
+import binning
+from configparser import ConfigParser
+
+config = ConfigParser(os.environ)
+config.read(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    'ann_config.ini'))
+
+"""Where the annotation stages read reference tables from
+
+   The stages read through the queries below, on a cursor from 
+   connection(): pointLookup() for rows with given column values (dbSNP,
+   the bigRefGene tiers), rangeQuery() and rangeFirst() for rows 
+   overlapping a range and coverQuery() for rows covering any of a list
+   of positions. Rows come back with all columns, in the order of 
+   columns(), unless columns are named. overlapIndex() returns an object
+   with overlap(chrom, pos) and first(chrom, pos) that answers a table's
+   range overlaps, or None to have the stage query per variant. scan() 
+   reads a whole table, scanInOrder() in the order range queries return
+   its rows in, and streamCursor() opens a cursor that does not buffer 
+   the result set, for sweeps over large tables.
+
+   This class runs the queries as SQL with param as the placeholder; 
+   values are always passed as parameters.
+"""
+class Backend(object):
+    param = '%s'
+
+    def __init__(self):
+        # Column names of the tables read so far
+        self.table_columns = {}
+
+    def connect(self):
+        raise NotImplementedError
+
+    """Connection for the duration of a with block
+    """
+    @contextmanager
+    def connection(self):
+        conn = self.connect()
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+    def streamCursor(self, conn):
+        return conn.cursor()
+
+    """Column names and all rows of table
+    """
+    def scan(self, cursor, table):
+        cursor.execute('select * from ' + table + ';')
+        rows = cursor.fetchall()
+        return ([str(d[0]) for d in cursor.description], rows)
+
+    """Column names and all rows of table, in the order range queries 
+       return them in within a chromosome (see orderColumns())
+    """
+    def scanInOrder(self, cursor, table):
+        order = self.orderColumns(cursor, table)
+        if (len(order) == 0):
+            return self.scan(cursor, table)
+        cursor.execute('select t.*, ' + ', '.join(['t.' + c for c in order]) +
+            ' from ' + table + ' t;')
+        width = len(cursor.description) - len(order)
+        names = [str(d[0]) for d in cursor.description][:width]
+        rows = sorted(cursor.fetchall(), key=lambda row: tuple(row[width:]))
+        return (names, [tuple(row[:width]) for row in rows])
+
+    """Column names of table
+    """
+    def columns(self, cursor, table):
+        if table not in self.table_columns:
+            cursor.execute('select * from ' + table + ' limit 0;')
+            self.table_columns[table] = [str(d[0]) 
+                for d in cursor.description]
+        return self.table_columns[table]
+
+    def select(self, table, columns):
+        return 'select ' + ('*' if (columns is None) else ', '.join(columns)) + \
+            ' from ' + table + ' where '
+
+    """Rows of table whose columns have the given values; equal maps a 
+       column to a value or to a list of values any of which matches
+    """
+    def pointLookup(self, cursor, table, equal, columns=None):
+        terms = []
+        params = []
+        for (name, value) in equal.items():
+            if isinstance(value, (list, tuple)):
+                terms.append(name + ' IN (' + 
+                    ', '.join([self.param] * len(value)) + ')')
+                params.extend(value)
+            else:
+                terms.append(name + ' = ' + self.param)
+                params.append(value)
+        cursor.execute(self.select(table, columns) + ' AND '.join(terms) + 
+            ';', params)
+        return cursor.fetchall()
+
+    def rangeSql(self, cursor, table, chrom, ranges, chromName, startName,
+        endName, columns):
+        terms = []
+        params = []
+        if chrom is not None:
+            terms.append(chromName + ' = ' + self.param)
+            params.append(chrom)
+        terms.append('(' + ' OR '.join(['(' + startName + ' <= ' + 
+            self.param + ' AND ' + self.param + ' <= ' + endName + ')'] * 
+            len(ranges)) + ')')
+        for (low, high) in ranges:
+            params.extend([int(high), int(low)])
+        sql = self.select(table, columns) + ' AND '.join(terms)
+        if (len(ranges) == 1):
+            sql = sql + binning.rangeFilter(cursor, table, ranges[0][0], 
+                ranges[0][1])
+        cursor.execute(sql + ';', params)
+
+    """Rows of table on chrom with start <= high and low <= end; chrom 
+       None reads a table that holds one chromosome
+    """
+    def rangeQuery(self, cursor, table, chrom, low, high, chromName='chrom',
+        startName='chromStart', endName='chromEnd', columns=None):
+        self.rangeSql(cursor, table, chrom, [(low, high)], chromName, 
+            startName, endName, columns)
+        return cursor.fetchall()
+
+    """First row rangeQuery() returns, or None (fetchone semantics)
+    """
+    def rangeFirst(self, cursor, table, chrom, low, high, chromName='chrom',
+        startName='chromStart', endName='chromEnd', columns=None):
+        self.rangeSql(cursor, table, chrom, [(low, high)], chromName, 
+            startName, endName, columns)
+        return cursor.fetchone()
+
+    """Rows of table on chrom covering any of positions
+    """
+    def coverQuery(self, cursor, table, chrom, positions, chromName='chrom',
+        startName='chromStart', endName='chromEnd', columns=None):
+        positions = sorted(set([int(p) for p in positions]))
+        if (len(positions) == 0):
+            return []
+        self.rangeSql(cursor, table, chrom, [(p, p) for p in positions], 
+            chromName, startName, endName, columns)
+        return cursor.fetchall()
+
+    def overlapIndex(self, cursor, table, chromName='chrom',
+        startName='chromStart', endName='chromEnd'):
+        return None
+
+    """Columns of table, as far as the backend can tell, that sort its 
+       rows in the order a range query returns them in: the bin, when 
+       the (chrom, bin) index serves the query
+    """
+    def orderColumns(self, cursor, table):
+        return ['bin'] if binning.hasBinColumn(cursor, table) else []
+
+    """Drops idle connections, e.g. before forking workers
+    """
+    def closeAll(self):
+        pass
+
+
+"""The RDS reference database, through the connection pool in utils
+"""
+class MySQLBackend(Backend):
+
+    def connect(self):
+        return u.db_connect()
+
+    def connection(self):
+        return u.db_connection()
+
+    def streamCursor(self, conn):
+        return conn.cursor(pymysql.cursors.SSCursor)
+
+    def closeAll(self):
+        u.db_pool().closeAll()
+
+
+"""A local SQLite copy of the reference tables
+
+   Tables that have an R*Tree built by buildRTree() answer range 
+   overlaps through it.
+"""
+class SQLiteBackend(Backend):
+    param = '?'
+
+    def __init__(self, path):
+        Backend.__init__(self)
+        self.path = path
+
+    def connect(self):
+        return sqlite3.connect(self.path, check_same_thread=False)
+
+    """Rows of a bin come in rowid order
+    """
+    def orderColumns(self, cursor, table):
+        return Backend.orderColumns(self, cursor, table) + ['rowid']
+
+    def overlapIndex(self, cursor, table, chromName='chrom',
+        startName='chromStart', endName='chromEnd'):
+        cursor.execute("select name from sqlite_master where type='table' " +
+            "and name=?;", (table + '_rtree',))
+        if cursor.fetchone() is None:
+            return None
+        return RTreeIndex(self, cursor, table)
+
+
+"""Every table the stages read held in memory, loaded from another 
+   backend the first time it is asked for
+
+   Range queries and overlaps are answered from an 
+   intervals.IntervalIndex per table and point lookups from a dict per 
+   table and set of columns; rows keep the order of base.scanInOrder(). 
+   Values match as strings. Connections go to the base backend, which 
+   the tables are read through.
+"""
+class MemoryBackend(Backend):
+
+    def __init__(self, base):
+        Backend.__init__(self)
+        self.base = base
+        self.param = base.param
+        # Point lookup tables: (table, columns) -> {values: rows}
+        self.points = {}
+        self.lock = threading.Lock()
+
+    def connect(self):
+        return self.base.connect()
+
+    def connection(self):
+        return self.base.connection()
+
+    def streamCursor(self, conn):
+        return self.base.streamCursor(conn)
+
+    def orderColumns(self, cursor, table):
+        return self.base.orderColumns(cursor, table)
+
+    def columns(self, cursor, table):
+        return self.base.columns(cursor, table)
+
+    def project(self, cursor, table, rows, columns):
+        if columns is None:
+            return rows
+        names = self.columns(cursor, table)
+        inds = [names.index(c) for c in columns]
+        return [tuple([row[i] for i in inds]) for row in rows]
+
+    def pointLookup(self, cursor, table, equal, columns=None):
+        names = tuple(equal.keys())
+        with self.lock:
+            if (table, names) not in self.points:
+                (all_names, rows) = self.base.scanInOrder(cursor, table)
+                inds = [all_names.index(n) for n in names]
+                by_values = {}
+                for row in rows:
+                    by_values.setdefault(tuple([str(row[i]) for i in inds]), 
+                        []).append(row)
+                self.points[(table, names)] = by_values
+        by_values = self.points[(table, names)]
+
+        keys = [()]
+        for value in equal.values():
+            values = value if isinstance(value, (list, tuple)) else [value]
+            keys = [key + (str(v),) for key in keys for v in values]
+        rows = []
+        for key in dict.fromkeys(keys):
+            rows.extend(by_values.get(key, []))
+        return self.project(cursor, table, rows, columns)
+
+    def index(self, cursor, table, chromName, startName, endName):
+        with self.lock:
+            return intervals.getIntervalIndex(cursor, table, 
+                chromName=chromName, startName=startName, endName=endName,
+                scan=self.base.scanInOrder)
+
+    def rangeQuery(self, cursor, table, chrom, low, high, chromName='chrom',
+        startName='chromStart', endName='chromEnd', columns=None):
+        index = self.index(cursor, table, chromName, startName, endName)
+        return self.project(cursor, table, 
+            index.range(None if (chrom is None) else str(chrom), low, high), 
+            columns)
+
+    def rangeFirst(self, cursor, table, chrom, low, high, chromName='chrom',
+        startName='chromStart', endName='chromEnd', columns=None):
+        rows = self.rangeQuery(cursor, table, chrom, low, high, 
+            chromName=chromName, startName=startName, endName=endName, 
+            columns=columns)
+        return rows[0] if (len(rows) > 0) else None
+
+    def coverQuery(self, cursor, table, chrom, positions, chromName='chrom',
+        startName='chromStart', endName='chromEnd', columns=None):
+        index = self.index(cursor, table, chromName, startName, endName)
+        return self.project(cursor, table, index.cover(str(chrom), 
+            [(p, p) for p in positions]), columns)
+
+    def overlapIndex(self, cursor, table, chromName='chrom',
+        startName='chromStart', endName='chromEnd'):
+        return self.index(cursor, table, chromName, startName, endName)
+
+    def closeAll(self):
+        self.base.closeAll()
+
+
+"""Range overlaps on a SQLite table through its R*Tree
+
+   The R*Tree holds (chromosome id, start, end) boxes with integer
+   coordinates, keyed by the table's rowid, and the ordinal of each row
+   in a scan of its chromosome. Hits come back in that order, the order
+   a plain range query returns them in. cursor is only
+   used to set up; lookups go through a ThreadCursor on backend, so 
+   stages on different threads never share a cursor.
+"""
+class RTreeIndex(object):
+
+    def __init__(self, backend, cursor, table):
+        self.cursor = ThreadCursor(backend)
+        cursor.execute('select * from ' + table + ' limit 0;')
+        self.names = [str(d[0]) for d in cursor.description]
+        cursor.execute('select chrom, id from ' + table + '_rtree_chroms;')
+        self.chroms = dict([(str(row[0]), int(row[1]))
+            for row in cursor.fetchall()])
+        self.sql = 'select t.* from ' + table + ' t join ' + table + \
+            '_rtree r on t.rowid = r.id where r.chromLo <= ? and ' + \
+            '? <= r.chromHi and r.startLo <= ? and ? <= r.endHi ' + \
+            'order by r.ordinal'
+
+    def overlap(self, chrom, pos):
+        if chrom not in self.chroms:
+            return []
+        chrom_id = self.chroms[chrom]
+        pos = int(pos)
+        self.cursor.execute(self.sql + ';', (chrom_id, chrom_id, pos, pos))
+        return self.cursor.fetchall()
+
+    def first(self, chrom, pos):
+        rows = self.overlap(chrom, pos)
+        if (len(rows) == 0):
+            return None
+        return rows[0]
+
+    def close(self):
+        self.cursor.close()
+
+
+"""Builds (or rebuilds) the R*Tree of a table in a SQLite database
+
+   Rows are numbered in the order a scan of their chromosome returns 
+   them, which depends on the table's indexes; rebuild the R*Tree after
+   adding an index on the chromosome column.
+"""
+def buildRTree(conn, table, chromName='chrom', startName='chromStart',
+    endName='chromEnd'):
+    conn.execute('drop table if exists ' + table + '_rtree;')
+    conn.execute('drop table if exists ' + table + '_rtree_chroms;')
+    conn.execute('create virtual table ' + table + '_rtree using ' +
+        'rtree_i32(id, chromLo, chromHi, startLo, endHi, +ordinal);')
+    conn.execute('create table ' + table + '_rtree_chroms ' +
+        '(chrom text primary key, id integer);')
+
+    chroms = {}
+    boxes = []
+    for (chrom,) in conn.execute('select distinct ' + chromName + ' from ' +
+        table + ';').fetchall():
+        chrom_id = chroms.setdefault(str(chrom), len(chroms))
+        for (rowid, start, end) in conn.execute('select rowid, ' +
+            startName + ', ' + endName + ' from ' + table + ' where ' +
+            chromName + ' = ?;', (chrom,)):
+            boxes.append((rowid, chrom_id, chrom_id, int(start), int(end),
+                len(boxes)))
+    conn.executemany('insert into ' + table + 
+        '_rtree values (?, ?, ?, ?, ?, ?);', boxes)
+    conn.executemany('insert into ' + table + '_rtree_chroms values (?, ?);',
+        list(chroms.items()))
+    conn.commit()
+    return len(boxes)
+
+
+"""Cursor for stages whose lookups run on several threads at once
+
+   Each thread gets a cursor on a connection of its own, opened from
+   backend the first time the thread queries; execute() and the fetches
+   that follow it on the same thread go to that cursor.
+"""
+class ThreadCursor(object):
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.conns = []
+
+    def cursor(self):
+        if getattr(self.local, 'cursor', None) is None:
+            conn = self.backend.connect()
+            with self.lock:
+                self.conns.append(conn)
+            self.local.cursor = conn.cursor()
+        return self.local.cursor
+
+    @property
+    def description(self):
+        return self.cursor().description
+
+    def execute(self, *args):
+        return self.cursor().execute(*args)
+
+    def fetchone(self):
+        return self.cursor().fetchone()
+
+    def fetchmany(self, size=1):
+        return self.cursor().fetchmany(size)
+
+    def fetchall(self):
+        return self.cursor().fetchall()
+
+    def close(self):
+        with self.lock:
+            for conn in self.conns:
+                conn.close()
+            self.conns = []
+        self.local = threading.local()
+
+
+# Backend of this process, created on first use
+backend = None
+
+"""Backend named by [ann] Backend: mysql (default), sqlite (the file in
+   [ann] SQLitePath) or memory (tables loaded from 
+   [ann] MemoryBackendBase)
+"""
+def getBackend():
+    global backend
+    if backend is None:
+        backend = makeBackend(config.get('ann', 'Backend', fallback='mysql'))
+    return backend
+
+
+def makeBackend(name):
+    if (name == 'sqlite'):
+        path = config.get('ann', 'SQLitePath', fallback='reference.db')
+        if not os.path.isabs(path):
+            path = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                path)
+        return SQLiteBackend(path)
+    if (name == 'memory'):
+        return MemoryBackend(makeBackend(
+            config.get('ann', 'MemoryBackendBase', fallback='mysql')))
+    if (name == 'mysql'):
+        return MySQLBackend()
+    raise ValueError(f"Unknown reference backend: {name}")
+
+
+if __name__ == "__main__":
+    import sys
+
+    if len(sys.argv) < 3:
+        print("Usage: backends.py <sqlite file> " +
+            "<table>[:chromName[:startName:endName]] ...")
+        sys.exit(1)
+
+    conn = sqlite3.connect(sys.argv[1])
+    for spec in sys.argv[2:]:
+        parts = spec.split(':')
+        names = parts[1:] + ['chrom', 'chromStart', 'chromEnd'][len(parts) - 1:]
+        count = buildRTree(conn, parts[0], chromName=names[0],
+            startName=names[1], endName=names[2])
+        print(f"{parts[0]}: {count} intervals indexed")
+    conn.close()
+
+### EOF
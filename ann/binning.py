@@ -0,0 +1,136 @@
+# binning.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# UCSC hierarchical bin scheme, used to narrow range queries on tables
+# that have a bin column to the few bins that can hold a match
+#
+# Add bin columns and (chrom, bin) indexes to tables missing them with:
+#   python binning.py table[:chromName:startName:endName] ...
+#   python binning.py --sqlite ref.db table ...
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import argparse
+
+# First bin number of each level, from the 128kb bins up to the single
+# 512Mb bin; each level's bins are 8 times wider than the one before
+BIN_OFFSETS = [512 + 64 + 8 + 1, 64 + 8 + 1, 8 + 1, 1, 0]
+FIRST_SHIFT = 17
+NEXT_SHIFT = 3
+
+"""(first, last) bin numbers per level of the bins that overlap the
+   half-open range [start, end)
+"""
+def binRanges(start, end):
+    ranges = []
+    shift = FIRST_SHIFT
+    for offset in BIN_OFFSETS:
+        ranges.append((offset + (start >> shift),
+            offset + ((max(end, start + 1) - 1) >> shift)))
+        shift = shift + NEXT_SHIFT
+    return ranges
+
+
+"""SQL condition on column matching the bins that overlap [start, end):
+   an IN list for short ranges, a BETWEEN per level for long ones
+"""
+def binPredicate(start, end, column='bin', max_list=32):
+    ranges = binRanges(start, end)
+    if (sum([hi - lo + 1 for (lo, hi) in ranges]) <= max_list):
+        bins = [b for (lo, hi) in ranges for b in range(lo, hi + 1)]
+        return column + ' IN (' + ','.join([str(b) for b in bins]) + ')'
+    return '(' + ' OR '.join([column + ' BETWEEN ' + str(lo) + ' AND ' +
+        str(hi) for (lo, hi) in ranges]) + ')'
+
+
+# Whether each table queried so far in this process has a bin column
+binned = {}
+
+def hasBinColumn(cursor, table):
+    if table not in binned:
+        cursor.execute('select * from ' + table + ' limit 0;')
+        binned[table] = ('bin' in [str(d[0]) for d in cursor.description])
+    return binned[table]
+
+
+"""Extra condition for a range query on table for rows with
+   start <= high and low <= end, or '' if table has no bin column
+
+   Rows are binned on [start, end) by UCSC; a row that ends at low only
+   covers low - 1 there, so the bins overlapping low - 1 are included.
+"""
+def rangeFilter(cursor, table, low, high):
+    if not hasBinColumn(cursor, table):
+        return ''
+    return ' AND ' + binPredicate(max(int(low) - 1, 0), int(high) + 1)
+
+
+"""SQL expression for the bin of each row of a table, computed from its
+   start and end columns. end is taken as inclusive, which gives the same
+   bin as UCSC's [start, end) or a wider one, so lookups still find the row.
+"""
+def binExpression(startName, endName):
+    cases = []
+    shift = FIRST_SHIFT
+    for offset in BIN_OFFSETS:
+        cases.append('WHEN (' + startName + ' >> ' + str(shift) + ') = (' +
+            endName + ' >> ' + str(shift) + ') THEN ' + str(offset) +
+            ' + (' + startName + ' >> ' + str(shift) + ')')
+        shift = shift + NEXT_SHIFT
+    return 'CASE ' + ' '.join(cases) + ' END'
+
+
+"""Adds a bin column to table if it has none (or refill is set), fills it
+   and adds a (chrom, bin) index
+"""
+def addBins(conn, table, chromName='chrom', startName='chromStart',
+    endName='chromEnd', refill=False):
+    cursor = conn.cursor()
+    binned.pop(table, None)
+    added = not hasBinColumn(cursor, table)
+    if added:
+        cursor.execute('ALTER TABLE ' + table + ' ADD COLUMN bin INT;')
+    if added or refill:
+        cursor.execute('UPDATE ' + table + ' SET bin = ' +
+            binExpression(startName, endName) + ';')
+    try:
+        cursor.execute('CREATE INDEX ' + table + '_' + chromName +
+            '_bin ON ' + table + ' (' + chromName + ', bin);')
+    except Exception as e:
+        print(f"{table}: index not created ({e})")
+    conn.commit()
+    binned.pop(table, None)
+    return added
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='Add UCSC bin columns and indexes to reference tables')
+    parser.add_argument('tables', nargs='+',
+        help='table[:chromName:startName:endName]')
+    parser.add_argument('--refill', action='store_true',
+        help='recompute existing bin columns')
+    parser.add_argument('--sqlite',
+        help='alter this SQLite file instead of the reference database')
+    args = parser.parse_args()
+
+    if args.sqlite:
+        import sqlite3
+        conn = sqlite3.connect(args.sqlite)
+    else:
+        import utils as u
+        conn = u.db_connect()
+
+    for spec in args.tables:
+        parts = spec.split(':')
+        names = parts[1:] + ['chrom', 'chromStart', 'chromEnd'][len(parts) - 1:]
+        added = addBins(conn, parts[0], chromName=names[0],
+            startName=names[1], endName=names[2], refill=args.refill)
+        print(f"{parts[0]}: bin column " + ('added' if added else
+            ('refilled' if args.refill else 'present')))
+    conn.close()
+
+### EOF
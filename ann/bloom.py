@@ -0,0 +1,197 @@
+# bloom.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Bloom filter over dbSNP positions, used to skip dbSNP queries for
+# variants that cannot be in dbSNP
+#
+# Build it with:
+#   python bloom.py dbsnp.bloom                   (reference database)
+#   python bloom.py --sqlite ref.db dbsnp.bloom   (local stand-in table)
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import os
+import mmap
+import math
+import struct
+import hashlib
+import argparse
+
+# magic, hash count, bit count, key count, reference release
+HEADER = struct.Struct('<4sIQQ32s')
+MAGIC = b'DBBF'
+
+"""Key of a dbSNP position, as stored in the filter
+"""
+def positionKey(chr, pos):
+    return (str(chr) + ':' + str(int(pos))).encode()
+
+
+"""Positions of the k bits of key in a filter of nbits bits
+   (double hashing over one 128-bit digest)
+"""
+def bitPositions(key, k, nbits):
+    digest = hashlib.blake2b(key, digest_size=16).digest()
+    h1 = int.from_bytes(digest[:8], 'little')
+    h2 = int.from_bytes(digest[8:], 'little') | 1
+    return [(h1 + i * h2) % nbits for i in range(k)]
+
+
+"""Bit count and hash count for n keys at false positive rate fp_rate
+"""
+def filterSize(n, fp_rate):
+    n = max(n, 1)
+    nbits = int(math.ceil(-n * math.log(fp_rate) / (math.log(2) ** 2)))
+    k = max(1, int(round(nbits / float(n) * math.log(2))))
+    return (nbits, k)
+
+
+"""Read-only Bloom filter memory-mapped from a file written by build()
+   mayContain() has no false negatives; a position it rejects is not
+   in the table the filter was built from
+"""
+class BloomFilter(object):
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as fh:
+            self.map = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, self.k, self.nbits, self.nkeys, release) = \
+            HEADER.unpack_from(self.map, 0)
+        if (magic != MAGIC):
+            raise ValueError(f"{path} is not a dbSNP Bloom filter")
+        self.release = release.rstrip(b'\0').decode()
+
+    def mayContain(self, chr, pos):
+        for bit in bitPositions(positionKey(chr, pos), self.k, self.nbits):
+            if not (self.map[HEADER.size + (bit >> 3)] & (1 << (bit & 7))):
+                return False
+        return True
+
+    """Expected false positive rate at the number of keys it was built with
+    """
+    def fpRate(self):
+        return (1 - math.exp(-self.k * self.nkeys / float(self.nbits))) ** self.k
+
+    def close(self):
+        self.map.close()
+
+
+"""Writes a filter over the (chr, pos) pairs in keys to path
+   n is the number of keys (an estimate is fine); nbits overrides the
+   size derived from n and fp_rate
+"""
+def build(keys, n, path, fp_rate=0.01, nbits=0, release=''):
+    if (len(release.encode()) > 32):
+        raise ValueError(f"Release '{release}' is longer than 32 bytes")
+    (size, k) = filterSize(n, fp_rate)
+    if nbits:
+        size = nbits
+        k = max(1, int(round(size / float(max(n, 1)) * math.log(2))))
+    bits = bytearray((size + 7) // 8)
+
+    count = 0
+    for (chr, pos) in keys:
+        for bit in bitPositions(positionKey(chr, pos), k, size):
+            bits[bit >> 3] |= (1 << (bit & 7))
+        count = count + 1
+
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as fh:
+        fh.write(HEADER.pack(MAGIC, k, size, count, release.encode()))
+        fh.write(bits)
+    os.replace(tmp, path)
+    return count
+
+
+"""(CHR, POS) of every dbSNP row, streamed from cursor
+"""
+def readDbSnpPositions(cursor, fetch_size=100000):
+    cursor.execute('select CHR, POS from dbSNP;')
+    while True:
+        rows = cursor.fetchmany(fetch_size)
+        if (len(rows) == 0):
+            break
+        for row in rows:
+            yield (row[0], row[1])
+
+
+"""Builds the filter from the dbSNP table behind cursor
+   count_cursor sizes the filter when cursor is a streaming cursor that
+   cannot run another query while the scan is open
+"""
+def buildFromCursor(cursor, path, fp_rate=0.01, nbits=0, release='',
+    count_cursor=None):
+    count_cursor = count_cursor or cursor
+    count_cursor.execute('select count(*) from dbSNP;')
+    n = int(count_cursor.fetchone()[0])
+    return build(readDbSnpPositions(cursor), n, path, fp_rate=fp_rate,
+        nbits=nbits, release=release)
+
+
+# Filters opened so far in this process, by path
+filters = {}
+
+"""Opens the filter at path once per process
+   Returns None if the file is missing or was built against another
+   reference release, since a stale filter could hide real dbSNP hits
+"""
+def getFilter(path, release=''):
+    if path not in filters:
+        bloom = None
+        if os.path.exists(path):
+            bloom = BloomFilter(path)
+            if (bloom.release != release):
+                print(f"Ignoring {path}: built for release '{bloom.release}'" +
+                    f", expected '{release}'")
+                bloom.close()
+                bloom = None
+        filters[path] = bloom
+    return filters[path]
+
+
+if __name__ == "__main__":
+    import pymysql
+    import utils as u
+    from configparser import ConfigParser
+
+    config = ConfigParser(os.environ)
+    config.read(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+        'ann_config.ini'))
+
+    parser = argparse.ArgumentParser(
+        description='Build the dbSNP position Bloom filter')
+    parser.add_argument('outfile')
+    parser.add_argument('--fp-rate', type=float,
+        default=config.getfloat('ann', 'DbSnpBloomFpRate', fallback=0.01))
+    parser.add_argument('--bits', type=int,
+        default=config.getint('ann', 'DbSnpBloomBits', fallback=0))
+    parser.add_argument('--release',
+        default=config.get('ann', 'ReferenceRelease', fallback=''))
+    parser.add_argument('--sqlite',
+        help='read dbSNP from this SQLite file instead of the reference database')
+    args = parser.parse_args()
+
+    if args.sqlite:
+        import sqlite3
+        conn = sqlite3.connect(args.sqlite)
+        cursor = conn.cursor()
+        count_cursor = None
+    else:
+        conn = u.db_connect()
+        cursor = conn.cursor(pymysql.cursors.SSCursor)
+        count_cursor = conn.cursor()
+
+    count = buildFromCursor(cursor, args.outfile, fp_rate=args.fp_rate,
+        nbits=args.bits, release=args.release, count_cursor=count_cursor)
+    conn.close()
+
+    bloom = BloomFilter(args.outfile)
+    print(f"{count} positions, {bloom.nbits} bits, {bloom.k} hashes, " +
+        f"expected false positive rate {bloom.fpRate():.4f}")
+    bloom.close()
+
+### EOF
@@ -0,0 +1,157 @@
+# cache.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Persistent annotation result cache shared by the jobs on one host
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import json
+import sqlite3
+import time
+import threading
+
+"""Lookup results of annotation stages kept in a local SQLite file
+
+   Entries are keyed by stage and (chrom, pos, ref, alt); stages that key
+   on position alone leave ref and alt empty. The file is opened in WAL
+   mode so concurrent jobs on the host can read and write it at once.
+   All entries are dropped when the reference release stamp changes, and
+   the least recently used entries are evicted once the cache grows past
+   max_entries. Hits are looked up with one select per chunk of keys; 
+   their last-used times are kept in memory and written with the next 
+   put(), every touch_interval hits, or on close().
+"""
+class ResultCache(object):
+
+    # Inserts between checks of the cache size
+    evict_interval = 1000
+    # Hits whose last-used times are written together
+    touch_interval = 1000
+    # Keys per select (4 parameters each)
+    chunk_size = 200
+
+    def __init__(self, path, release, max_entries=1000000, timeout=30):
+        self.path = path
+        self.release = release
+        self.max_entries = max_entries
+        self.inserts = 0
+        # Last-used times of hits not written yet, by row
+        self.touched = {}
+        # One transaction at a time when stages look up from several threads
+        self.lock = threading.Lock()
+        # Opened by the driver, used by the threads running the stage
+        self.conn = sqlite3.connect(path, timeout=timeout,
+            isolation_level=None, check_same_thread=False)
+        self.conn.execute('pragma journal_mode=WAL;')
+        self.conn.execute('pragma synchronous=NORMAL;')
+        self.conn.execute('create table if not exists meta ' +
+            '(name text primary key, value text);')
+        self.conn.execute('create table if not exists results ' +
+            '(stage text, chrom text, pos text, ref text, alt text, ' +
+            'value text, used real, ' +
+            'primary key (stage, chrom, pos, ref, alt));')
+        self.conn.execute('create index if not exists results_used ' +
+            'on results (used);')
+        self.checkRelease()
+
+    """Drops all entries written against another reference release
+    """
+    def checkRelease(self):
+        self.conn.execute('begin immediate;')
+        try:
+            row = self.conn.execute(
+                'select value from meta where name="release";').fetchone()
+            if (row is None) or (row[0] != self.release):
+                self.conn.execute('delete from results;')
+                self.conn.execute('insert or replace into meta ' +
+                    'values ("release", ?);', (self.release,))
+            self.conn.execute('commit;')
+        except:
+            self.conn.execute('rollback;')
+            raise
+
+    def row(self, stage, key):
+        key = [str(k) for k in key[:4]]
+        return tuple([stage] + key + [''] * (4 - len(key)))
+
+    """Cached values for keys, as a dict from position in keys to value
+    """
+    def get(self, stage, keys):
+        found = {}
+        if (len(keys) == 0):
+            return found
+        with self.lock:
+            rows = [self.row(stage, key) for key in keys]
+            values = {}
+            for i in range(0, len(rows), self.chunk_size):
+                chunk = rows[i:i + self.chunk_size]
+                values.update([(tuple(hit[:4]), hit[4]) 
+                    for hit in self.conn.execute('select chrom, pos, ref, ' +
+                    'alt, value from results where stage=? and ' +
+                    '(chrom, pos, ref, alt) in (values ' + 
+                    ','.join(['(?, ?, ?, ?)'] * len(chunk)) + ');',
+                    [stage] + [k for row in chunk for k in row[1:]])])
+
+            now = time.time()
+            for (i, row) in enumerate(rows):
+                if row[1:] in values:
+                    found[i] = json.loads(values[row[1:]])
+                    self.touched[row] = now
+            if (len(self.touched) >= self.touch_interval):
+                self.conn.execute('begin;')
+                self.touch()
+                self.conn.execute('commit;')
+        return found
+
+    """Writes the last-used times of the hits since the last write, 
+       inside the caller's transaction
+    """
+    def touch(self):
+        if (len(self.touched) == 0):
+            return
+        self.conn.executemany('update results set used=? where ' +
+            'stage=? and chrom=? and pos=? and ref=? and alt=?;',
+            [(used,) + row for (row, used) in self.touched.items()])
+        self.touched = {}
+
+    def put(self, stage, keys, values):
+        if (len(keys) == 0):
+            return
+        with self.lock:
+            now = time.time()
+            self.conn.execute('begin;')
+            self.touch()
+            self.conn.executemany('insert or replace into results ' +
+                'values (?, ?, ?, ?, ?, ?, ?);',
+                [self.row(stage, key) + (json.dumps(value), now)
+                    for (key, value) in zip(keys, values)])
+            self.conn.execute('commit;')
+
+            self.inserts = self.inserts + len(keys)
+            if (self.inserts >= self.evict_interval):
+                self.inserts = 0
+                self.evict()
+
+    """Trims the cache to 90% of max_entries, least recently used first
+    """
+    def evict(self):
+        n = self.conn.execute('select count(*) from results;').fetchone()[0]
+        if (n <= self.max_entries):
+            return
+        self.conn.execute('delete from results where rowid in ' +
+            '(select rowid from results order by used limit ?);',
+            (n - int(self.max_entries * 0.9),))
+
+    def close(self):
+        if self.conn is not None:
+            with self.lock:
+                self.conn.execute('begin;')
+                self.touch()
+                self.conn.execute('commit;')
+            self.conn.close()
+            self.conn = None
+
+### EOF
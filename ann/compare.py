@@ -0,0 +1,224 @@
+# compare.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Runs the annotation driver over the stand-in reference (see standin.py)
+# in every pipeline mode and reference setup, and checks that each run
+# writes the same annotated file and count log as a fused run over the
+# plain SQLite tables. Prints the runtime of each run; exits with 1 if any
+# output differs.
+#
+# Run it with:
+#   python compare.py                      (every setup, every mode)
+#   python compare.py --setups rtree --modes fused,pipelined
+#   python compare.py --set DbSnpBatchSize=1 --variants 20000
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import os
+import sys
+import time
+import shutil
+import hashlib
+import argparse
+import subprocess
+
+MODES = ['fused', 'chained', 'sharded', 'pipelined', 'concurrent', 'async']
+
+# Reference setups: whether the stand-in has R*Tree indexes, the [ann]
+# settings on top of the defaults below, and the modes run against it.
+# ReferenceSnapshot and DbSnpBloomFile settings name files in the work
+# directory, built from the stand-in on first use.
+SETUPS = [
+    ('sqlite', False, {}, MODES),
+    ('sweep', False, {'SweepTables': 'gadAll, hugo'},
+        ['fused', 'sharded', 'pipelined', 'concurrent']),
+    ('rtree', True, {}, MODES),
+    ('snapshot', False, {'ReferenceSnapshot': 'standin.snap'}, MODES),
+    ('bloom', False, {'DbSnpBloomFile': 'standin.bloom'}, MODES),
+    ('memory', False, {'Backend': 'memory', 'MemoryBackendBase': 'sqlite'},
+        MODES),
+]
+
+BUILT_FILES = ['ReferenceSnapshot', 'DbSnpBloomFile']
+
+# Settings of every run: no files shared between runs or left in the
+# annotator directory
+DEFAULTS = {
+    'ReferenceSnapshot': '',
+    'DbSnpBloomFile': '',
+    'ResultCache': 'no',
+    'SweepTables': '',
+}
+
+"""--set style settings of a run over the stand-in database at path, with
+   settings (a dict) on top of DEFAULTS
+"""
+def runSettings(path, settings={}):
+    return ['Backend=sqlite', 'SQLitePath=' + path] + \
+        [key + '=' + value for (key, value) in
+        dict(DEFAULTS, **settings).items()]
+
+
+"""Runs the driver once in this process: outdir gets a copy of vcf as
+   job~input.vcf and the outputs; settings are [ann] Key=Value pairs
+"""
+def runOnce(outdir, vcf, mode, settings):
+    import driver
+    import backends
+    for setting in settings:
+        (key, value) = setting.split('=', 1)
+        driver.config.set('ann', key, value)
+        backends.config.set('ann', key, value)
+    infile = os.path.join(outdir, 'job~input.vcf')
+    shutil.copy(vcf, infile)
+    start = time.time()
+    driver.run(infile, 'vcf', mode=mode)
+    print(f"SECONDS {time.time() - start:.2f}")
+
+
+"""md5 of the annotated file and the count log in outdir
+"""
+def outputDigests(outdir):
+    digests = []
+    for name in ['job~input.annot.vcf', 'job~input.vcf.count.log']:
+        path = os.path.join(outdir, name)
+        if not os.path.exists(path):
+            digests.append(None)
+            continue
+        with open(path, 'rb') as fh:
+            digests.append(hashlib.md5(fh.read()).hexdigest())
+    return digests
+
+
+"""Runs one mode in a child process, so no reference handles or caches
+   carry over from earlier runs; returns (seconds, digests, error output)
+"""
+def runChild(workdir, name, vcf, mode, settings):
+    outdir = os.path.join(workdir, name + '.' + mode)
+    shutil.rmtree(outdir, ignore_errors=True)
+    os.makedirs(outdir)
+    env = dict(os.environ)
+    env['PYTHONHASHSEED'] = '0'
+    child = subprocess.run([sys.executable, os.path.abspath(__file__),
+        '--run', outdir, vcf, mode] + settings, env=env,
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+    seconds = None
+    for line in child.stdout.splitlines():
+        if line.startswith('SECONDS '):
+            seconds = float(line.split()[1])
+    error = child.stderr.strip().splitlines()[-1:] if child.returncode else []
+    return (seconds, outputDigests(outdir), ' '.join(error))
+
+
+"""Stand-in database of workdir, with R*Tree indexes if rtree is set,
+   built on first use
+"""
+def getDatabase(workdir, vcf, rtree, variants):
+    import standin
+    import backends
+    path = os.path.join(workdir, 'standin_rtree.db' if rtree else 'standin.db')
+    if not os.path.exists(path):
+        conn = standin.buildDatabase(path)
+        if rtree:
+            for spec in standin.OVERLAP_TABLES:
+                parts = spec.split(':')
+                backends.buildRTree(conn, parts[0],
+                    chromName=(parts[1] if (len(parts) > 1) else 'chrom'))
+        if not os.path.exists(vcf):
+            standin.writeVcf(conn, vcf, n=variants)
+        conn.close()
+    return path
+
+
+"""File name in workdir for setting (one of BUILT_FILES), a snapshot or
+   dbSNP Bloom filter of the stand-in database at path, built on first
+   use; returns its full path
+"""
+def getBuiltFile(workdir, path, setting, name):
+    import snapshot
+    import bloom
+    import backends
+    outfile = os.path.join(workdir, name)
+    if not os.path.exists(outfile):
+        release = backends.config.get('ann', 'ReferenceRelease', fallback='')
+        with backends.SQLiteBackend(path).connection() as conn:
+            if (setting == 'ReferenceSnapshot'):
+                snapshot.build(conn.cursor(), outfile, release=release,
+                    log=lambda line: None)
+            else:
+                bloom.buildFromCursor(conn.cursor(), outfile, release=release)
+    return outfile
+
+
+if __name__ == "__main__":
+    if (len(sys.argv) > 1) and (sys.argv[1] == '--run'):
+        runOnce(sys.argv[2], sys.argv[3], sys.argv[4], sys.argv[5:])
+        sys.exit(0)
+
+    parser = argparse.ArgumentParser(
+        description='Check that every pipeline mode and reference setup ' +
+        'writes the same output over the stand-in reference')
+    parser.add_argument('--workdir', default='compare_runs')
+    parser.add_argument('--setups',
+        help='comma-separated setup names (default: all)')
+    parser.add_argument('--modes',
+        help='comma-separated pipeline modes (default: each setup\'s list)')
+    parser.add_argument('--variants', type=int, default=4000)
+    parser.add_argument('--set', action='append', default=[],
+        metavar='KEY=VALUE', help='[ann] setting for every run')
+    args = parser.parse_args()
+
+    os.makedirs(args.workdir, exist_ok=True)
+    workdir = os.path.abspath(args.workdir)
+    vcf = os.path.join(workdir, 'standin.vcf')
+    if os.path.exists(vcf):
+        os.remove(vcf)
+    for name in ['standin.db', 'standin_rtree.db'] + \
+        [settings[key] for (name, rtree, settings, modes) in SETUPS
+        for key in BUILT_FILES if key in settings]:
+        if os.path.exists(os.path.join(workdir, name)):
+            os.remove(os.path.join(workdir, name))
+    plain = getDatabase(workdir, vcf, False, args.variants)
+
+    # Fused over the plain tables is what every other run must match
+    (seconds, reference, error) = runChild(workdir, 'reference', vcf,
+        'fused', runSettings(plain) + args.set)
+    if error or (None in reference):
+        print(f"reference run failed: {error}")
+        sys.exit(1)
+    print(f"{'reference':<12} {'fused':<11} {seconds:7.2f}s")
+
+    failed = 0
+    names = args.setups.split(',') if args.setups else None
+    for (name, rtree, settings, modes) in SETUPS:
+        if (names is not None) and (name not in names):
+            continue
+        path = getDatabase(workdir, vcf, rtree, args.variants)
+        settings = dict(settings)
+        for key in BUILT_FILES:
+            if key in settings:
+                settings[key] = getBuiltFile(workdir, path, key,
+                    settings[key])
+        run_settings = runSettings(path, settings) + args.set
+        for mode in (args.modes.split(',') if args.modes else modes):
+            (seconds, digests, error) = runChild(workdir, name, vcf, mode,
+                run_settings)
+            if error:
+                result = 'FAILED ' + error
+            elif (digests != reference):
+                result = 'DIFFERS' + ('' if (digests[0] == reference[0])
+                    else ' (annotations)') + ('' if (digests[1] ==
+                    reference[1]) else ' (count log)')
+            else:
+                result = 'same'
+            if (result != 'same'):
+                failed = failed + 1
+            timing = '' if (seconds is None) else f"{seconds:7.2f}s"
+            print(f"{name:<12} {mode:<11} {timing:>8}  {result}")
+
+    sys.exit(1 if failed else 0)
+
+### EOF
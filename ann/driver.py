@@ -12,110 +12,451 @@ __author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
 
 import sys
 import os
+import shutil
+import logging
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
 import file_utils as fu
+import utils as u
 import annotate as ann
+import intervals
+import cache
+import bloom
+import backends
+import snapshot
+import pipeline
+from configparser import ConfigParser
 
-def run(infile, format):
+config = ConfigParser(os.environ)
+config.read(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    'ann_config.ini'))
+
+logger = logging.getLogger(__name__)
+
+def getTableList(option):
+    return [t.strip() for t in config.get('ann', option, fallback='').split(',')]
+
+
+"""Reference snapshot named by [ann] ReferenceSnapshot, or None if not
+   configured, not built yet or built against another reference release
+"""
+def getSnapshot():
+    path = config.get('ann', 'ReferenceSnapshot', fallback='')
+    if not path:
+        return None
+    if not os.path.isabs(path):
+        path = os.path.join(os.path.dirname(os.path.abspath(__file__)), path)
+    return snapshot.getSnapshot(path, 
+        release=config.get('ann', 'ReferenceRelease', fallback=''))
+
+
+"""Snapshot copy of table, or None if there is no snapshot or it does
+   not hold the table
+"""
+def getSnapshotTable(table):
+    reference = getSnapshot()
+    if (reference is None) or not reference.has(table):
+        return None
+    return reference.table(table)
+
+
+"""Lookup index for table: its snapshot copy if there is one, a sweep over
+   the table if sweep is set and the table is listed in [ann] SweepTables,
+   an in-memory interval index if it is listed in [ann] IntervalIndexTables,
+   otherwise whatever the reference backend offers (None: query per variant)
+"""
+def getIndex(cursor, table, chromName='chrom', sweep=False):
+    index = getSnapshotTable(table)
+    if index is not None:
+        return index
+    backend = backends.getBackend()
+    if sweep and (table in getTableList('SweepTables')):
+        return intervals.SweepIndex(backend.connect, table, 
+            chromName=chromName, openCursor=backend.streamCursor,
+            orderColumns=backend.orderColumns(cursor, table), 
+            param=backend.param)
+    if table in getTableList('IntervalIndexTables'):
+        return intervals.getIntervalIndex(cursor, table, chromName=chromName,
+            scan=backend.scanInOrder)
+    return backend.overlapIndex(cursor, table, chromName=chromName)
+
+
+"""Preloaded transcript models for table if [ann] TranscriptIndex is set,
+   otherwise None (range query per variant); read from the snapshot when
+   it holds the table
+"""
+def getTranscriptIndex(cursor, table, promoter_offset):
+    if not config.getboolean('ann', 'TranscriptIndex', fallback=False):
+        return None
+    rows = getSnapshotTable(table)
+    return ann.getTranscriptIndex(cursor, table, promoter_offset, 
+        rows=None if (rows is None) else rows.rows())
+
+
+"""Result cache shared by the jobs on this host, or None if disabled
+"""
+def getCache():
+    if not config.getboolean('ann', 'ResultCache', fallback=False):
+        return None
+    path = config.get('ann', 'ResultCachePath', fallback='ann_cache.db')
+    if not os.path.isabs(path):
+        path = os.path.join(os.path.dirname(os.path.abspath(__file__)), path)
+    return cache.ResultCache(path, 
+        config.get('ann', 'ReferenceRelease', fallback=''),
+        max_entries=config.getint('ann', 'ResultCacheMaxEntries', 
+        fallback=1000000))
 
-    print("Running . . .")
 
-    ann.getSnpsFromDbSnp(vcf=infile, format='vcf', tmpextin='', 
-        tmpextout='.1')
-    print("dbSNP - done.")
-    tmpextin = 1
-    tmpextout = 2
-
-    ann.getBigRefGene(vcf=infile, format='vcf', tmpextin='.' + str(tmpextin),
-        tmpextout='.' + str(tmpextout))
-    print("BigRefGene - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.getGenes(vcf=infile, format='vcf', table='refGene', 
-        promoter_offset=500, tmpextin='.' + str(tmpextin), 
-        tmpextout='.' + str(tmpextout))
-    print("BigRefGene - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithCytoband(vcf=infile, format='vcf', table='cytoBand', 
-        tmpextin='.' + str(tmpextin), tmpextout='.' + str(tmpextout))
-    print("Cytoband - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithGadAll(vcf=infile, format='vcf', table='gadAll', 
-        tmpextin='.' + str(tmpextin), tmpextout='.' + str(tmpextout))
-    print("gadAll - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithGwasCatalog(vcf=infile, format='vcf', 
-        table='gwasCatalog', tmpextin='.' + str(tmpextin), 
-        tmpextout='.' + str(tmpextout))
-    print("GwasCatalog - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithMiRNA(vcf=infile, format='vcf', table='targetScanS', 
-        tmpextin='.' + str(tmpextin), tmpextout='.' + str(tmpextout))
-    print("miRNA - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWitHUGOGeneNomenclature(vcf=infile, format='vcf', 
-        table='hugo', tmpextin='.' + str(tmpextin), 
-        tmpextout='.' + str(tmpextout))
-    print("HUGO Gene Nomenclature Committee - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithCnvDatabase(vcf=infile, format='vcf', table='dgv_Cnv', 
-        tmpextin='.' + str(tmpextin), tmpextout='.' + str(tmpextout))
-    print("dgv_Cnv - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithCnvDatabase(vcf=infile, format='vcf', 
-        table='abParts_IG_T_CelReceptors', tmpextin='.' + str(tmpextin), 
-        tmpextout='.' + str(tmpextout))
-    print("abParts_IG_T_CelReceptors - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithCnvDatabase(vcf=infile, format='vcf', 
-        table='mcCarroll_Cnv', tmpextin='.' + str(tmpextin), 
-        tmpextout='.' + str(tmpextout))
-    print("mcCarroll_Cnv - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithCnvDatabase(vcf=infile, format='vcf', 
-        table='conrad_Cnv', tmpextin='.' + str(tmpextin), 
-        tmpextout='.' + str(tmpextout))
-    print("conrad_Cnv - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithGenomicSuperDups(vcf=infile, format='vcf', 
-        table='genomicSuperDups', tmpextin='.' + str(tmpextin),
-        tmpextout='.' + str(tmpextout))
-    print("genomicSuperDups - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithTfbsConsSites(vcf=infile, table='tfbsConsSites',
-        tmpextin='.' + str(tmpextin), tmpextout='.' + str(tmpextout))
-    print("addOverlapWithTfbsConsSites - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
+"""dbSNP position filter named by [ann] DbSnpBloomFile, or None if not
+   configured, not built yet or built against another reference release
+"""
+def getDbSnpFilter():
+    path = config.get('ann', 'DbSnpBloomFile', fallback='')
+    if not path:
+        return None
+    if not os.path.isabs(path):
+        path = os.path.join(os.path.dirname(os.path.abspath(__file__)), path)
+    return bloom.getFilter(path, 
+        release=config.get('ann', 'ReferenceRelease', fallback=''))
+
+
+"""Annotation stages, in the order they are applied to each record
+   sweep is set when the records arrive sorted by chromosome and position
+"""
+def getStages(cursor, format='vcf', sweep=False):
+    tiers = [getSnapshotTable(table) for table in ['chrom_pos_equal_base',
+        'chrom_pos_equal_nobase', 'chrom_pos_unequal']]
+    tfbs = [(c, getSnapshotTable('tfbsConsSites' + c)) 
+        for c in ann.TfbsConsSitesAnnotator.allowed_chrom]
+    stages = [
+        ann.DbSnpAnnotator(cursor, format=format, 
+            batch_size=config.getint('ann', 'DbSnpBatchSize', fallback=1),
+            bloom=getDbSnpFilter(), index=getSnapshotTable('dbSNP')),
+        ann.BigRefGeneAnnotator(cursor, format=format, 
+            batch_size=config.getint('ann', 'BigRefGeneBatchSize', 
+            fallback=1), index=None if (None in tiers) else tiers),
+        ann.GenesAnnotator(cursor, format=format, table='refGene', 
+            promoter_offset=500, 
+            index=getTranscriptIndex(cursor, 'refGene', 500),
+            cpg_index=getIndex(cursor, 'cpgIslandExt')),
+        ann.CytobandAnnotator(cursor, format=format, table='cytoBand',
+            index=getIndex(cursor, 'cytoBand', sweep=sweep)),
+        ann.GadAllAnnotator(cursor, format=format, table='gadAll',
+            index=getIndex(cursor, 'gadAll', chromName='chromosome', 
+            sweep=sweep)),
+        ann.GwasCatalogAnnotator(cursor, format=format, table='gwasCatalog',
+            index=getSnapshotTable('gwasCatalog')),
+        ann.MiRNAAnnotator(cursor, format=format, table='targetScanS',
+            index=getIndex(cursor, 'targetScanS', sweep=sweep)),
+        ann.HugoAnnotator(cursor, format=format, table='hugo',
+            index=getIndex(cursor, 'hugo', sweep=sweep)),
+        ann.CnvDatabaseAnnotator(cursor, format=format, table='dgv_Cnv',
+            index=getIndex(cursor, 'dgv_Cnv', sweep=sweep)),
+        ann.CnvDatabaseAnnotator(cursor, format=format, 
+            table='abParts_IG_T_CelReceptors',
+            index=getIndex(cursor, 'abParts_IG_T_CelReceptors', 
+            sweep=sweep)),
+        ann.CnvDatabaseAnnotator(cursor, format=format, table='mcCarroll_Cnv',
+            index=getIndex(cursor, 'mcCarroll_Cnv', sweep=sweep)),
+        ann.CnvDatabaseAnnotator(cursor, format=format, table='conrad_Cnv',
+            index=getIndex(cursor, 'conrad_Cnv', sweep=sweep)),
+        ann.GenomicSuperDupsAnnotator(cursor, format=format, 
+            table='genomicSuperDups', 
+            index=getIndex(cursor, 'genomicSuperDups', sweep=sweep)),
+        ann.TfbsConsSitesAnnotator(cursor, format=format, 
+            table='tfbsConsSites', 
+            span_fetch=config.getboolean('ann', 'TfbsSpanFetch', 
+            fallback=False), 
+            index=dict([(c, t) for (c, t) in tfbs if t is not None]) or None),
+    ]
+
+    results = getCache()
+    if results is not None:
+        for stage in stages:
+            if stage.name in getTableList('ResultCacheStages'):
+                stage.cache = results
+    return stages
+
+
+"""Prints the result cache hits and misses of each cached stage and
+   the dbSNP queries skipped by the position filter, and logs them at 
+   INFO level under the input file name, since the output of annotator 
+   worker processes goes nowhere
+"""
+def printLookupCounts(stages, infile):
+    for stage in stages:
+        lines = []
+        if 'cache_hits' in stage.counts:
+            lines.append(f"{stage.name} - cache: "
+                f"{stage.counts['cache_hits']} hits, "
+                f"{stage.counts['cache_misses']} misses")
+        if 'bloom_skipped' in stage.counts:
+            lines.append(f"{stage.name} - filter: "
+                f"{stage.counts['bloom_skipped']} lookups skipped")
+        for line in lines:
+            print(line)
+            logger.info(f"{os.path.basename(infile)}: {line}")
+
+
+"""Runs the stages one at a time, each writing a full intermediate file
+"""
+def runChained(stages, infile, outfile, logfile, window=1000):
+    tmpextin = ''
+    for i in range(len(stages)):
+        tmpextout = '.' + str(i + 1)
+        pipeline.annotateFile([stages[i]], infile + tmpextin, 
+            infile + tmpextout, window=window)
+        pipeline.writeLogs([stages[i]], logfile, 
+            mode=('w' if (i == 0) else 'a'))
+        print(f"{stages[i].name} - done.")
+        tmpextin = tmpextout
 
     ## Cleanup
-    for i in range(1, tmpextin):
+    for i in range(1, len(stages)):
         fu.delete(infile + '.' + str(i))
+    os.rename(infile + tmpextin, outfile)
+
+
+"""Parses the VCF once and passes every record through all stages 
+   in memory
+"""
+def runFused(stages, infile, outfile, logfile, window=1000):
+    pipeline.annotateFile(stages, infile, outfile, window=window)
+    pipeline.writeLogs(stages, logfile)
+    for stage in stages:
+        print(f"{stage.name} - done.")
+
+
+"""Gives every stage a reference database connection and result cache
+   of its own, so the stages can run on different threads (R*Tree 
+   indexes open a connection per thread themselves)
+   Returns the connections, to be closed when the run is over
+"""
+def openStageConnections(stages):
+    backend = backends.getBackend()
+    conns = []
+    shared = None
+    for stage in stages:
+        conns.append(backend.connect())
+        stage.cursor = conns[-1].cursor()
+        if stage.cache is not None:
+            shared = stage.cache
+            stage.cache = getCache()
+    if shared is not None:
+        shared.close()
+    return conns
+
 
-    os.rename(infile + '.' + str(tmpextin), infile + '.annot')
+"""Runs every stage in its own thread on a connection of its own, passing
+   windows of records along queues of at most depth windows, and prints 
+   how full each stage's input queue was
+"""
+def runPipelined(stages, infile, outfile, logfile, window=1000, depth=4):
+    conns = openStageConnections(stages)
+    try:
+        stats = pipeline.annotateFilePipelined(stages, infile, outfile, 
+            window=window, depth=depth)
+    finally:
+        for conn in conns:
+            conn.close()
+    pipeline.writeLogs(stages, logfile)
+    for stage in stages:
+        print(f"{stage.name} - done.")
+    for stat in stats:
+        print(f"{stat.name} - queue: {stat.occupancy():.1f} of " +
+            f"{stat.depth} windows waiting on average, full " +
+            f"{stat.full} of {stat.windows} times; busy {stat.busy:.2f}s, " +
+            f"waited {stat.starved:.2f}s for input, " +
+            f"{stat.blocked:.2f}s for output")
+
+
+"""Resolves the lookups of independent stages at the same time on a pool
+   of worker threads (0 = one per stage), each stage on a connection of 
+   its own, and applies them in stage order
+"""
+def runConcurrent(stages, infile, outfile, logfile, window=1000, workers=0):
+    conns = openStageConnections(stages)
+    pool = ThreadPoolExecutor(max_workers=(workers or len(stages)))
+    try:
+        pipeline.annotateFileConcurrent(stages, infile, outfile, pool, 
+            window=window)
+    finally:
+        pool.shutdown()
+        for conn in conns:
+            conn.close()
+    pipeline.writeLogs(stages, logfile)
+    for stage in stages:
+        print(f"{stage.name} - done.")
+
+
+"""Runs every record through the stages as its own task, with the lookups
+   of the records in flight batched per stage, keeping up to inflight 
+   batches outstanding on as many threads and reference connections, and
+   writes the records in input order
+"""
+def runAsync(stages, infile, outfile, logfile, window=1000, inflight=32):
+    cursor = backends.ThreadCursor(backends.getBackend())
+    for stage in stages:
+        stage.cursor = cursor
+        # Span fetches read one chromosome at a time, which lookups for
+        # records in flight together do not keep to
+        if hasattr(stage, 'span_fetch'):
+            stage.span_fetch = False
+    executor = ThreadPoolExecutor(max_workers=inflight)
+    try:
+        pipeline.annotateFileAsync(stages, infile, outfile, executor,
+            inflight=inflight, window=window)
+    finally:
+        executor.shutdown()
+        cursor.close()
+    pipeline.writeLogs(stages, logfile)
+    for stage in stages:
+        print(f"{stage.name} - done.")
+
+
+"""Annotates one shard file in a worker process
+   Returns the stages so their counts can be merged
+"""
+def annotateShard(shardfile, outfile, format, window, sweep):
+    with backends.getBackend().connection() as conn:
+        stages = getStages(conn.cursor(), format=format, sweep=sweep)
+        pipeline.annotateFile(stages, shardfile, outfile, window=window)
+    for stage in stages:
+        stage.close()
+    return stages
+
+
+def initShardWorker():
+    # Never share the parent's database connections with a worker
+    u.pool = None
+
+
+"""Splits the VCF by chromosome (or position block) and runs the fused 
+   pipeline on each shard in a process pool, then merges the shards back 
+   into input order and sums the per-shard counts into one .count.log
+"""
+def runSharded(infile, outfile, logfile, format='vcf', processes=0, 
+    by='chrom', window=1000, sweep=False):
+    processes = processes or multiprocessing.cpu_count()
+
+    # Load interval indexes once so forked workers share them
+    with backends.getBackend().connection() as conn:
+        for stage in getStages(conn.cursor(), format=format, sweep=sweep):
+            stage.close()
+    backends.getBackend().closeAll()
+
+    (names, order) = pipeline.splitShards(infile, processes, by=by)
+    outnames = [name + '.annot' for name in names]
+    workers = multiprocessing.Pool(min(processes, len(names)), 
+        initializer=initShardWorker)
+    results = workers.starmap(annotateShard, 
+        [(names[n], outnames[n], format, window, sweep) 
+        for n in range(len(names))])
+    workers.close()
+    workers.join()
+
+    stages = results[0]
+    for shard_stages in results[1:]:
+        for (stage, shard_stage) in zip(stages, shard_stages):
+            stage.merge(shard_stage)
+
+    pipeline.mergeShards(outnames, order, outfile)
+    pipeline.writeLogs(stages, logfile)
+    for stage in stages:
+        print(f"{stage.name} - done.")
+    printLookupCounts(stages, infile)
+
+    for name in names + outnames:
+        fu.delete(name)
+
+
+"""mode is 'fused' (single pass), 'sharded' (fused, one process per 
+   shard), 'pipelined' (single pass, one thread per stage), 'concurrent'
+   (single pass, independent stages' lookups at the same time), 'async'
+   (single pass, many records' lookups in flight) or 'chained' (one pass
+   per stage); defaults to [ann] PipelineMode
+
+   stream, if given, is an open file the records are read from instead of
+   infile (which still names the outputs), e.g. an input still 
+   downloading. It is read once, front to back, so the stages do no 
+   sweep or span lookups; sharded and chained runs, which read the input 
+   more than once, save it to infile first.
+"""
+def run(infile, format, mode=None, stream=None):
+
+    print("Running . . .")
+
+    mode = mode or config.get('ann', 'PipelineMode', fallback='fused')
+    window = config.getint('ann', 'WindowSize', fallback=1000)
     finalout=(infile + '.annot').replace('.vcf.annot', '.annot.vcf')
-    os.rename(infile + '.annot', finalout)
+    logfile = infile + '.count.log'
+
+    if (stream is not None) and (mode in ['sharded', 'chained']):
+        with open(infile, 'w') as fh:
+            shutil.copyfileobj(stream, fh)
+        stream.close()
+        stream = None
+
+    # Sweep lookups need the records sorted by chromosome and position;
+    # unsorted input is either sorted here and restored afterwards or 
+    # annotated with the regular lookups. Async lookups finish in no
+    # particular order and a stream can only be read once, so neither 
+    # sweeps.
+    sweep = (mode != 'async') and (stream is None) and \
+        (len([t for t in getTableList('SweepTables')
+        if t and (getSnapshotTable(t) is None)]) > 0)
+    order = None
+    if sweep and not pipeline.isSorted(infile):
+        if config.getboolean('ann', 'SweepSort', fallback=True):
+            order = pipeline.sortFile(infile, infile + '.sorted')
+        else:
+            sweep = False
+    if order is not None:
+        annotin = infile + '.sorted'
+        annotout = infile + '.sorted.annot'
+    else:
+        annotin = infile if (stream is None) else stream
+        annotout = finalout
+
+    if (mode == 'sharded'):
+        runSharded(annotin, annotout, logfile, format=format, 
+            processes=config.getint('ann', 'ShardProcesses', fallback=0),
+            by=config.get('ann', 'ShardBy', fallback='chrom'), window=window,
+            sweep=sweep)
+    else:
+        with backends.getBackend().connection() as conn:
+            stages = getStages(conn.cursor(), format=format, sweep=sweep)
+            # Span fetches read the whole input before the first lookup
+            if (stream is not None):
+                for stage in stages:
+                    if hasattr(stage, 'span_fetch'):
+                        stage.span_fetch = False
+            if (mode == 'chained'):
+                runChained(stages, annotin, annotout, logfile, window=window)
+            elif (mode == 'pipelined'):
+                runPipelined(stages, annotin, annotout, logfile, 
+                    window=window, 
+                    depth=config.getint('ann', 'PipelineQueueDepth', 
+                    fallback=4))
+            elif (mode == 'async'):
+                runAsync(stages, annotin, annotout, logfile, 
+                    window=window,
+                    inflight=config.getint('ann', 'AsyncInflight',
+                    fallback=32))
+            elif (mode == 'concurrent'):
+                runConcurrent(stages, annotin, annotout, logfile, 
+                    window=window,
+                    workers=config.getint('ann', 'ConcurrentWorkers', 
+                    fallback=0))
+            else:
+                runFused(stages, annotin, annotout, logfile, window=window)
+        for stage in stages:
+            stage.close()
+        printLookupCounts(stages, infile)
+
+    if order is not None:
+        pipeline.unsortFile(annotout, order, finalout)
+        fu.delete(annotin)
+        fu.delete(annotout)
 
-### EOF
\ No newline at end of file
+### EOF
@@ -0,0 +1,248 @@
+# intervals.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Point-overlap lookups over reference table intervals
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+from bisect import bisect_left
+import pymysql
+
+"""Nested containment list over the closed intervals of one chromosome
+
+   Intervals contained in another interval are kept in that interval's
+   sublist, so within any one list both starts and ends are increasing
+   and the overlapping entries can be found by bisection.
+"""
+class NCList(object):
+
+    def __init__(self, intervals):
+        # intervals: (start, end, ordinal)
+        top = []
+        stack = []
+        for (start, end, ordinal) in sorted(intervals,
+            key=lambda iv: (iv[0], -iv[1], iv[2])):
+            while (len(stack) > 0) and (stack[-1][1] < end):
+                stack.pop()
+            node = (start, end, ordinal, [])
+            if (len(stack) > 0):
+                stack[-1][3].append(node)
+            else:
+                top.append(node)
+            stack.append(node)
+        self.root = self._freeze(top)
+
+    def _freeze(self, nodes):
+        return ([n[1] for n in nodes], [(n[0], n[2],
+            self._freeze(n[3]) if (len(n[3]) > 0) else None) for n in nodes])
+
+    """Ordinals of all intervals with start <= pos <= end, unordered; 
+       with high, of all intervals with start <= high and pos <= end
+    """
+    def query(self, pos, high=None):
+        if high is None:
+            high = pos
+        hits = []
+        lists = [self.root]
+        while (len(lists) > 0):
+            (ends, nodes) = lists.pop()
+            i = bisect_left(ends, pos)
+            while (i < len(nodes)) and (nodes[i][0] <= high):
+                hits.append(nodes[i][1])
+                if (nodes[i][2] is not None):
+                    lists.append(nodes[i][2])
+                i = i + 1
+        return hits
+
+
+"""Rows of a reference table indexed per chromosome for point overlap
+   Hits are returned in the order the table was read, so first() matches
+   what fetchone() returns on the same unordered range query
+   names holds the column names of the rows, when read from a table
+"""
+class IntervalIndex(object):
+
+    def __init__(self, rows, chrom_ind, start_ind, end_ind, names=None):
+        self.rows = rows
+        self.names = names
+        by_chrom = {}
+        for (ordinal, row) in enumerate(rows):
+            by_chrom.setdefault(str(row[chrom_ind]), []).append(
+                (int(row[start_ind]), int(row[end_ind]), ordinal))
+        self.lists = dict([(chrom, NCList(intervals))
+            for (chrom, intervals) in by_chrom.items()])
+
+    """All rows overlapping pos (fetchall semantics)
+    """
+    def overlap(self, chrom, pos):
+        if chrom not in self.lists:
+            return []
+        return [self.rows[i] for i in sorted(self.lists[chrom].query(int(pos)))]
+
+    """All rows overlapping low..high, in table order; chrom None takes
+       the rows of every chromosome
+    """
+    def range(self, chrom, low, high):
+        return self.cover(chrom, [(low, high)])
+
+    """All rows overlapping any of the (low, high) ranges, in table order
+    """
+    def cover(self, chrom, ranges):
+        lists = [self.lists[c] for c in self.lists 
+            if (chrom is None) or (c == chrom)]
+        hits = set()
+        for (low, high) in ranges:
+            for nclist in lists:
+                hits.update(nclist.query(int(low), int(high)))
+        return [self.rows[i] for i in sorted(hits)]
+
+    """First row overlapping pos or None (fetchone semantics)
+    """
+    def first(self, chrom, pos):
+        if chrom not in self.lists:
+            return None
+        hits = self.lists[chrom].query(int(pos))
+        if (len(hits) == 0):
+            return None
+        return self.rows[min(hits)]
+
+
+"""Point-overlap lookups answered by a linear sweep over a table
+
+   Each chromosome is streamed from the database on a dedicated 
+   connection, ordered by chromStart, and merged against the queries: 
+   rows are read up to the queried position and only the intervals that 
+   can still overlap later positions are held, in an active list. 
+   Queries must come grouped by chromosome with non-decreasing positions 
+   for the sweep to be a single pass; a query that goes backwards 
+   restarts the sweep of its chromosome. 
+
+   Hits are returned in table order, the order a per-variant query 
+   returns them in: by the order columns (see Backend.orderColumns) 
+   and then by chromStart. openCursor(conn) returns the cursor the rows 
+   are read through (a pymysql SSCursor by default), and param is its
+   placeholder for the chromosome.
+"""
+class SweepIndex(object):
+
+    def __init__(self, connect, table, chromName='chrom', 
+        startName='chromStart', endName='chromEnd', openCursor=None,
+        orderColumns=None, param='%s', batch_size=1000):
+        self.connect = connect
+        self.openCursor = openCursor or \
+            (lambda conn: conn.cursor(pymysql.cursors.SSCursor))
+        self.table = table
+        self.chromName = chromName
+        self.startName = startName
+        self.endName = endName
+        self.orderColumns = orderColumns or []
+        self.param = param
+        self.batch_size = batch_size
+        self.conn = None
+        self.cursor = None
+        self.chrom = None
+        self.pos = None
+
+    def start(self, chrom):
+        if self.conn is None:
+            self.conn = self.connect()
+        self.stop()
+        self.cursor = self.openCursor(self.conn)
+        self.cursor.execute('select t.*' + 
+            ''.join([', t.' + c for c in self.orderColumns]) + ' from ' + 
+            self.table + ' t where t.' + self.chromName + ' = ' + 
+            self.param + ' order by t.' + self.startName + ';', (str(chrom),))
+        names = [str(d[0]) for d in self.cursor.description]
+        self.width = len(names) - len(self.orderColumns)
+        self.start_ind = names.index(self.startName)
+        self.end_ind = names.index(self.endName)
+        self.chrom = chrom
+        self.pos = None
+        # (order key, row) of the rows read so far that still overlap
+        self.active = []
+        # rows fetched but not reached yet, from self.next on
+        self.pending = []
+        self.next = 0
+        self.count = 0
+
+    def stop(self):
+        if self.cursor is not None:
+            self.cursor.close()
+            self.cursor = None
+
+    def close(self):
+        self.stop()
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+    """Next row of the chromosome not read yet, or None at its end
+    """
+    def peek(self):
+        if (self.next == len(self.pending)):
+            if self.cursor is None:
+                return None
+            self.pending = self.cursor.fetchmany(self.batch_size)
+            self.next = 0
+            if (len(self.pending) == 0):
+                self.stop()
+                return None
+        return self.pending[self.next]
+
+    def advance(self, chrom, pos):
+        if (chrom != self.chrom) or (pos < self.pos):
+            self.start(chrom)
+        self.pos = pos
+
+        row = self.peek()
+        while (row is not None) and (int(row[self.start_ind]) <= pos):
+            # rows come in chromStart order; count breaks the ties
+            key = tuple(row[self.width:]) + (self.count,)
+            self.active.append((key, tuple(row[:self.width])))
+            self.count = self.count + 1
+            self.next = self.next + 1
+            row = self.peek()
+        self.active = [item for item in self.active 
+            if int(item[1][self.end_ind]) >= pos]
+        return [row for (key, row) in sorted(self.active, 
+            key=lambda item: item[0])]
+
+    """All rows overlapping pos (fetchall semantics)
+    """
+    def overlap(self, chrom, pos):
+        return self.advance(chrom, int(pos))
+
+    """First row overlapping pos or None (fetchone semantics)
+    """
+    def first(self, chrom, pos):
+        active = self.advance(chrom, int(pos))
+        if (len(active) == 0):
+            return None
+        return active[0]
+
+
+# Indexes loaded so far in this process, by table and columns
+indexes = {}
+
+"""Loads a whole reference table into an IntervalIndex, once per process
+   scan(cursor, table), when given, reads the column names and rows, in 
+   the order hits should come back in (see Backend.scanInOrder())
+"""
+def getIntervalIndex(cursor, table, chromName='chrom',
+    startName='chromStart', endName='chromEnd', scan=None):
+    key = (table, chromName, startName, endName)
+    if key not in indexes:
+        if scan is not None:
+            (names, rows) = scan(cursor, table)
+        else:
+            cursor.execute('select * from ' + table + ';')
+            rows = cursor.fetchall()
+            names = [str(d[0]) for d in cursor.description]
+        indexes[key] = IntervalIndex(rows, names.index(chromName),
+            names.index(startName), names.index(endName), names=names)
+    return indexes[key]
+
+### EOF
@@ -0,0 +1,526 @@
+# pipeline.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Runs annotation stages over a VCF file
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import time
+import heapq
+import queue
+import asyncio
+import pickle
+import tempfile
+import threading
+from array import array
+from records import Record
+
+
+"""Reads a file as lists of at most size stripped lines
+"""
+def readWindows(fh, size=1000):
+    window = []
+    for line in fh:
+        window.append(line.strip())
+        if (len(window) >= size):
+            yield window
+            window = []
+    if (len(window) > 0):
+        yield window
+
+
+"""infile if it is already an open file of lines (e.g. a stream still 
+   downloading), otherwise the file at path infile
+"""
+def openInput(infile):
+    if hasattr(infile, 'read'):
+        return infile
+    return open(infile)
+
+
+"""Streams infile through every stage in order and writes outfile once
+   Each line is parsed into a Record once and written once
+"""
+def annotateFile(stages, infile, outfile, window=1000):
+    for stage in stages:
+        stage.prepare(infile)
+    inds = stages[0].inds
+    sep = stages[0].sep
+    fh = openInput(infile)
+    fh_out = open(outfile, "w")
+    for lines in readWindows(fh, window):
+        records = [Record(line, inds, sep) for line in lines]
+        for stage in stages:
+            records = stage.annotate(records)
+        fh_out.write('\n'.join([record.text(sep) for record in records]) + 
+            '\n')
+    fh_out.close()
+    fh.close()
+
+
+"""How a stage fared in annotateFilePipelined(): seconds spent annotating,
+   waiting for input and waiting for room downstream, and how many windows
+   were in its input queue each time it went for the next one
+
+   The bottleneck is the stage whose input queue stays full while it is
+   busy; the stages after it mostly wait for input.
+"""
+class StageStats(object):
+
+    def __init__(self, name, depth):
+        self.name = name
+        self.depth = depth
+        self.windows = 0
+        self.busy = 0.0
+        self.starved = 0.0
+        self.blocked = 0.0
+        self.queued = 0
+        self.full = 0
+
+    """Mean number of windows waiting in the input queue
+    """
+    def occupancy(self):
+        return self.queued / float(max(self.windows, 1))
+
+
+"""Streams infile through the stages like annotateFile(), with each stage
+   in its own thread so one stage's query latency overlaps the others'
+   work. Windows of records are passed along queues holding at most depth
+   windows; a full queue holds up the stages before it. Each stage must 
+   have a cursor of its own. Returns a StageStats per stage.
+"""
+def annotateFilePipelined(stages, infile, outfile, window=1000, depth=4):
+    for stage in stages:
+        stage.prepare(infile)
+    inds = stages[0].inds
+    sep = stages[0].sep
+    queues = [queue.Queue(maxsize=max(1, depth)) 
+        for i in range(len(stages) + 1)]
+    stats = [StageStats(stage.name, max(1, depth)) for stage in stages]
+    errors = []
+
+    def read():
+        try:
+            with openInput(infile) as fh:
+                for lines in readWindows(fh, window):
+                    if (len(errors) > 0):
+                        break
+                    queues[0].put([Record(line, inds, sep) for line in lines])
+        except Exception as e:
+            errors.append(e)
+        finally:
+            queues[0].put(None)
+
+    # After a failure every thread keeps draining its input until the end
+    # marker, so no thread is left blocked on a full queue
+    def annotate(stage, inq, outq, stat):
+        while True:
+            start = time.time()
+            stat.queued = stat.queued + inq.qsize()
+            if inq.full():
+                stat.full = stat.full + 1
+            records = inq.get()
+            got = time.time()
+            stat.starved = stat.starved + got - start
+            if records is None:
+                break
+            if (len(errors) > 0):
+                continue
+            try:
+                records = stage.annotate(records)
+            except Exception as e:
+                errors.append(e)
+                continue
+            done = time.time()
+            stat.busy = stat.busy + done - got
+            outq.put(records)
+            stat.blocked = stat.blocked + time.time() - done
+            stat.windows = stat.windows + 1
+        outq.put(None)
+
+    threads = [threading.Thread(target=read, daemon=True)] + \
+        [threading.Thread(target=annotate, daemon=True, args=(stages[i], 
+        queues[i], queues[i + 1], stats[i])) for i in range(len(stages))]
+    for thread in threads:
+        thread.start()
+
+    fh_out = open(outfile, "w")
+    while True:
+        records = queues[-1].get()
+        if records is None:
+            break
+        if (len(errors) > 0):
+            continue
+        try:
+            fh_out.write('\n'.join([record.text(sep) for record in records]) +
+                '\n')
+        except Exception as e:
+            errors.append(e)
+    fh_out.close()
+    for thread in threads:
+        thread.join()
+    if (len(errors) > 0):
+        raise errors[0]
+    return stats
+
+
+"""Streams infile through the stages like annotateFile(), resolving the
+   lookups of stages that do not depend on each other at the same time on
+   pool, a concurrent.futures executor. A stage's lookups start once the
+   stages in its after list have annotated the window. Results are applied
+   to the records in stage order, so the INFO fragments come out in the 
+   order annotateFile() writes them. No stage runs two lookups at once, 
+   so each needs a cursor of its own but not a thread-safe one.
+"""
+def annotateFileConcurrent(stages, infile, outfile, pool, window=1000):
+    names = [stage.name for stage in stages]
+    for (i, stage) in enumerate(stages):
+        for name in stage.after:
+            if (name in names) and (names.index(name) > i):
+                raise ValueError(f"{stage.name} reads {name}, which " +
+                    "runs after it")
+
+    for stage in stages:
+        stage.prepare(infile)
+    inds = stages[0].inds
+    sep = stages[0].sep
+    fh = openInput(infile)
+    fh_out = open(outfile, "w")
+    for lines in readWindows(fh, window):
+        records = [Record(line, inds, sep) for line in lines]
+        pending = [stage.pending(records) for stage in stages]
+        lookup = lambda i: stages[i].lookupCached(
+            [stages[i].key(record) for record in pending[i]])
+
+        applied = set()
+        futures = [None] * len(stages)
+        for i in range(len(stages)):
+            for j in range(i, len(stages)):
+                if (futures[j] is None) and all([(name in applied) or 
+                    (name not in names) for name in stages[j].after]):
+                    futures[j] = pool.submit(lookup, j)
+            for (record, result) in zip(pending[i], futures[i].result()):
+                stages[i].apply(record, result)
+            applied.add(stages[i].name)
+
+        fh_out.write('\n'.join([record.text(sep) for record in records]) + 
+            '\n')
+    fh_out.close()
+    fh.close()
+
+
+"""Collects the keys records ask one stage for and looks them up together
+   The keys asked for while the event loop runs its ready tasks form one
+   batch, sent to stage.lookupCached() on executor once those tasks have
+   run or once it holds size keys. At most as many batches as semaphore
+   allows are outstanding at a time, over all stages.
+"""
+class LookupBatcher(object):
+
+    def __init__(self, stage, loop, executor, semaphore, size):
+        self.stage = stage
+        self.loop = loop
+        self.executor = executor
+        self.semaphore = semaphore
+        self.size = size
+        self.keys = []
+        self.futures = []
+        self.tasks = set()
+
+    """Returns a future for the result of key
+    """
+    def lookup(self, key):
+        future = self.loop.create_future()
+        if (len(self.keys) == 0):
+            self.loop.call_soon(self.flush)
+        self.keys.append(key)
+        self.futures.append(future)
+        if (len(self.keys) >= self.size):
+            self.flush()
+        return future
+
+    def flush(self):
+        if (len(self.keys) == 0):
+            return
+        task = self.loop.create_task(self.resolve(self.keys, self.futures))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        self.keys = []
+        self.futures = []
+
+    async def resolve(self, keys, futures):
+        try:
+            async with self.semaphore:
+                results = await self.loop.run_in_executor(self.executor,
+                    self.stage.lookupCached, keys)
+        except Exception as e:
+            for future in futures:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (future, result) in zip(futures, results):
+            if not future.done():
+                future.set_result(result)
+
+
+"""Streams infile through the stages with up to inflight batches of
+   lookups outstanding at a time, run on executor, a concurrent.futures
+   executor
+
+   Every record goes through the stages in order as its own task, so
+   records whose lookups are waiting on the database do not hold up the
+   others. The keys the records in flight need from a stage are looked
+   up in batches of at most window keys (see LookupBatcher). Input is
+   read a window at a time; finished records are kept in a reorder buffer
+   and written in input order, with at most max_records records read 
+   ahead of the first unfinished one. Stage lookups must be safe to run 
+   on several threads at once (see backends.ThreadCursor).
+"""
+def annotateFileAsync(stages, infile, outfile, executor, inflight=32,
+    window=1000, max_records=0):
+    for stage in stages:
+        stage.prepare(infile)
+    asyncio.run(annotateRecords(stages, infile, outfile, executor, inflight,
+        window, max_records or (window * 4)))
+
+
+async def annotateRecords(stages, infile, outfile, executor, inflight,
+    window, max_records):
+    loop = asyncio.get_running_loop()
+    semaphore = asyncio.Semaphore(inflight)
+    batchers = [LookupBatcher(stage, loop, executor, semaphore, window)
+        for stage in stages]
+    inds = stages[0].inds
+    sep = stages[0].sep
+    finished = {}
+    tasks = set()
+    read = 0
+    written = 0
+
+    async def annotate(n, record):
+        for (stage, batcher) in zip(stages, batchers):
+            if not stage.isHeader(record.line):
+                stage.apply(record, await batcher.lookup(stage.key(record)))
+        finished[n] = record
+
+    def write():
+        nonlocal written
+        while written in finished:
+            fh_out.write(finished.pop(written).text(sep) + '\n')
+            written = written + 1
+
+    fh = openInput(infile)
+    fh_out = open(outfile, "w")
+    try:
+        for lines in readWindows(fh, window):
+            for line in lines:
+                tasks.add(asyncio.ensure_future(annotate(read,
+                    Record(line, inds, sep))))
+                read = read + 1
+            while (read - written >= max_records):
+                (done, tasks) = await asyncio.wait(tasks,
+                    return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    task.result()
+                write()
+
+        if (len(tasks) > 0):
+            for task in (await asyncio.wait(tasks))[0]:
+                task.result()
+        write()
+    finally:
+        for task in tasks:
+            task.cancel()
+        fh_out.close()
+        fh.close()
+
+
+"""Writes the counts of every stage to the .count.log, in stage order
+"""
+def writeLogs(stages, logfile, mode='w'):
+    fh_log = open(logfile, mode)
+    for stage in stages:
+        stage.writeLog(fh_log)
+    fh_log.close()
+
+"""Chromosome of a VCF line, without any "chr" prefix
+"""
+def getChrom(line, sep='\t'):
+    chr = line.split(sep, 1)[0].strip()
+    if chr.startswith("chr"):
+        chr = chr[3:]
+    return chr
+
+
+"""Splits infile into at most shards files, infile.shard<n>
+
+   by='chrom' keeps each chromosome in a single shard and spreads the 
+   chromosomes over the shards by line count; by='block' cuts the data 
+   lines into contiguous blocks of equal size. Comment and header lines 
+   go to the first shard. Returns the shard file names and a bytearray 
+   holding the shard of every input line, for mergeShards().
+"""
+def splitShards(infile, shards, by='chrom', sep='\t'):
+    shards = max(1, min(shards, 255))
+    sizes = {}
+    data_lines = 0
+    fh = open(infile)
+    for line in fh:
+        if not line.startswith('#'):
+            data_lines = data_lines + 1
+            if (by == 'chrom'):
+                chr = getChrom(line, sep)
+                sizes[chr] = sizes.get(chr, 0) + 1
+    fh.close()
+
+    # Largest chromosomes first, each to the least loaded shard
+    shard_of = {}
+    load = [0] * shards
+    for chr in sorted(sizes, key=lambda c: -sizes[c]):
+        n = load.index(min(load))
+        shard_of[chr] = n
+        load[n] = load[n] + sizes[chr]
+    block = max(1, -(-data_lines // shards))
+
+    names = [infile + '.shard' + str(n) for n in range(shards)]
+    fh_shards = [open(name, 'w') for name in names]
+    order = bytearray()
+    data_line = 0
+    fh = open(infile)
+    for line in fh:
+        if line.startswith('#'):
+            n = 0
+        elif (by == 'chrom'):
+            n = shard_of[getChrom(line, sep)]
+        else:
+            n = data_line // block
+            data_line = data_line + 1
+        fh_shards[n].write(line)
+        order.append(n)
+    fh.close()
+    for fh_shard in fh_shards:
+        fh_shard.close()
+    return (names, order)
+
+
+"""Interleaves the annotated shards back into the original line order
+"""
+def mergeShards(names, order, outfile):
+    fh_shards = [open(name) for name in names]
+    fh_out = open(outfile, 'w')
+    for n in order:
+        fh_out.write(fh_shards[n].readline())
+    fh_out.close()
+    for fh_shard in fh_shards:
+        fh_shard.close()
+
+"""True if the data lines are grouped by chromosome with non-decreasing
+   positions, the order the sweep lookups need
+"""
+def isSorted(infile, sep='\t'):
+    seen = set()
+    chr = None
+    pos = 0
+    fh = open(infile)
+    try:
+        for line in fh:
+            if line.startswith('#'):
+                continue
+            fields = line.split(sep, 2)
+            if (getChrom(line, sep) != chr):
+                chr = getChrom(line, sep)
+                if chr in seen:
+                    return False
+                seen.add(chr)
+                pos = 0
+            if (int(fields[1]) < pos):
+                return False
+            pos = int(fields[1])
+    except (IndexError, ValueError):
+        return False
+    finally:
+        fh.close()
+    return True
+
+
+"""Sorts (key, line) pairs using temporary files of run_size pairs each
+"""
+def externalSort(pairs, run_size=500000):
+    runs = []
+    run = []
+    for pair in pairs:
+        run.append(pair)
+        if (len(run) >= run_size):
+            runs.append(writeRun(run))
+            run = []
+    run.sort(key=lambda p: p[0])
+    if (len(runs) == 0):
+        for pair in run:
+            yield pair
+        return
+
+    runs.append(writeRun(run))
+    for pair in heapq.merge(*[readRun(fh) for fh in runs], 
+        key=lambda p: p[0]):
+        yield pair
+    for fh in runs:
+        fh.close()
+
+
+def writeRun(run):
+    run.sort(key=lambda p: p[0])
+    fh = tempfile.TemporaryFile()
+    for pair in run:
+        pickle.dump(pair, fh)
+    fh.seek(0)
+    return fh
+
+
+def readRun(fh):
+    while True:
+        try:
+            yield pickle.load(fh)
+        except EOFError:
+            return
+
+
+"""Writes infile to outfile with data lines sorted by chromosome and 
+   position, comment and header lines first; returns the original line 
+   number of every output line for unsortFile()
+"""
+def sortFile(infile, outfile, sep='\t', run_size=500000):
+    def keyed(fh):
+        n = 0
+        for line in fh:
+            if line.startswith('#'):
+                key = ('', -1, n)
+            else:
+                key = (getChrom(line, sep), int(line.split(sep, 2)[1]), n)
+            yield (key, line)
+            n = n + 1
+
+    order = array('L')
+    fh = open(infile)
+    fh_out = open(outfile, 'w')
+    for (key, line) in externalSort(keyed(fh), run_size=run_size):
+        fh_out.write(line)
+        order.append(key[2])
+    fh_out.close()
+    fh.close()
+    return order
+
+
+"""Puts the lines of a file written by sortFile() back in original order
+"""
+def unsortFile(infile, order, outfile, run_size=500000):
+    fh = open(infile)
+    fh_out = open(outfile, 'w')
+    for (n, line) in externalSort(zip(order, fh), run_size=run_size):
+        fh_out.write(line)
+    fh_out.close()
+    fh.close()
+
+### EOF
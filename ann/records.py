@@ -0,0 +1,122 @@
+# records.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# VCF records parsed once and shared by all annotation stages
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+
+"""Chromosome spellings used by the reference tables
+"""
+def withChrPrefix(chr):
+    if not chr.startswith("chr"):
+        chr = "chr" + chr
+    return chr
+
+
+def withoutChrPrefix(chr):
+    if chr.startswith("chr"):
+        chr = chr.replace('chr', '')
+    return chr
+
+
+def clean_mysql_chars(entry):
+    entry = entry.replace("\"", "")
+    entry = entry.replace("\'", "")
+    return str(entry)
+
+
+"""INFO column collected as a list of pieces and written once
+
+   The pieces joined together give the column exactly as the stages, 
+   each rewriting the column in turn, used to write it: the input INFO
+   is kept as it is, and each stage's fragment goes on with the 
+   separator rule that stage has always used. add() puts a ';' in front 
+   unless the column already ends with one, append() always does.
+   set() replaces the column, and dropPlaceholder() removes a leading
+   ".;" left when a fragment was appended to the "." placeholder.
+"""
+class Info(object):
+    __slots__ = ['pieces']
+
+    def __init__(self, text):
+        self.pieces = [text]
+
+    """True when the column is the "." placeholder
+    """
+    def isEmpty(self):
+        return (self.text() == '.')
+
+    def set(self, text):
+        self.pieces = [text]
+
+    def add(self, fragment):
+        if self.endswith(';'):
+            self.pieces.append(fragment)
+        else:
+            self.pieces.extend([';', fragment])
+
+    def append(self, fragment):
+        self.pieces.extend([';', fragment])
+
+    def dropPlaceholder(self):
+        text = self.text()
+        if text.startswith('.;'):
+            self.pieces = [text[2:]]
+
+    def endswith(self, suffix):
+        for piece in reversed(self.pieces):
+            if (piece != ''):
+                return piece.endswith(suffix)
+        return False
+
+    def text(self):
+        if (len(self.pieces) > 1):
+            self.pieces = [''.join(self.pieces)]
+        return self.pieces[0]
+
+
+"""One line of the input, split once
+
+   Data lines also carry what the stages look up by: the chromosome with
+   and without the "chr" prefix, the position as an int and the cleaned
+   REF and ALT. Stages annotate a record by adding to its info and 
+   changing its fields in place; text() gives the line to write. inds 
+   are the chr, pos, ref and alt columns, as given by 
+   getFormatSpecificIndices(). spaced writes the fields separated by 
+   a tab and a space.
+"""
+class Record(object):
+    __slots__ = ['line', 'fields', 'chrom', 'chrom_nochr', 'pos',
+        'ref', 'alt', 'info', 'spaced']
+
+    def __init__(self, line, inds, sep='\t'):
+        self.line = line.strip()
+        self.fields = self.line.split(sep)
+        self.spaced = False
+        if self.line.startswith('#') or self.line.startswith('CHROM'):
+            self.chrom = self.chrom_nochr = self.pos = None
+            self.ref = self.alt = self.info = None
+            return
+
+        chr = self.fields[inds[0]].strip()
+        self.chrom = withChrPrefix(chr)
+        self.chrom_nochr = withoutChrPrefix(chr)
+        self.pos = int(self.fields[inds[1]].strip())
+        self.ref = clean_mysql_chars(self.fields[inds[2]]).strip()
+        self.alt = clean_mysql_chars(self.fields[inds[3]]).strip()
+        self.info = Info(self.fields[7]) if (len(self.fields) > 7) else None
+
+    def text(self, sep='\t'):
+        if self.chrom is None:
+            return self.line
+        if self.info is not None:
+            self.fields[7] = self.info.text()
+        if self.spaced:
+            sep = sep + ' '
+        return sep.join(self.fields)
+
+### EOF
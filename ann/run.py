@@ -12,13 +12,18 @@ from math import log
 import sys
 import time
 import driver
+import s3stream
 import boto3
+from botocore.exceptions import ClientError
 import os
+import logging
 from configparser import ConfigParser
 import json
 
 config = ConfigParser(os.environ)
-config.read("ann_config.ini")
+config.read(
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "ann_config.ini")
+)
 
 """A rudimentary timer for coarse-grained profiling
 """
@@ -39,95 +44,285 @@ class Timer(object):
             print(f"Approximate runtime: {self.secs:.2f} seconds")
 
 
-if __name__ == "__main__":
-    # Call the AnnTools pipeline
-    if len(sys.argv) > 4:
-        input_file_path = sys.argv[1]
-        user_id = sys.argv[2]
-        user_email = sys.argv[3]
-        job_id = sys.argv[4]
-        input_file_name = os.path.basename(input_file_path)
-        with Timer():
-            driver.run(input_file_path, "vcf")
+# AWS clients of this process, created on first use and kept across the
+# jobs a warm worker runs
+clients = {}
 
-        data_folder_name = config["local"][
-            "DataFolderName"
-        ]  # The local dir name storing the results
-        results_bucket_name = config["aws"]["AwsS3ResultsBucket"]
-        aws_s3_key_prefix = config["aws"]["AwsS3KeyPrefix"]
-
-        # Upload to s3
-        s3 = boto3.client("s3", region_name=config["aws"]["AwsRegionName"])
-        annot_file_name = input_file_name.split(".")[0] + ".annot.vcf"
-        annot_file_key = f"{aws_s3_key_prefix}/{user_id}/{annot_file_name}"
-        s3.upload_file(
-            f"{data_folder_name}/{annot_file_name}",
-            Bucket=results_bucket_name,
-            Key=annot_file_key,
+
+def get_client(name):
+    if name not in clients:
+        if name == "dynamodb":
+            clients[name] = boto3.resource("dynamodb")
+        elif name in ["s3", "sqs"]:
+            clients[name] = boto3.client(
+                name, region_name=config["aws"]["AwsRegionName"]
+            )
+        else:
+            clients[name] = boto3.client(name)
+    return clients[name]
+
+
+"""Runs in each of the annotator's worker processes before its first job;
+the driver's lookup counts are logged to the annotator's log file
+"""
+
+
+def init_worker():
+    logging.basicConfig(
+        filename=os.path.join(os.path.dirname(os.path.abspath(__file__)), "error.log"),
+        level=logging.ERROR,
+    )
+    logging.getLogger("driver").setLevel(logging.INFO)
+    for name in ["s3", "dynamodb", "sns", "sqs"]:
+        get_client(name)
+
+
+"""S3 keys of the annotated file and the log of a job's input file
+"""
+
+
+def result_keys(input_file_name, user_id):
+    aws_s3_key_prefix = config["aws"]["AwsS3KeyPrefix"]
+    annot_file_name = input_file_name.split(".")[0] + ".annot.vcf"
+    log_file_name = input_file_name + ".count.log"
+    return (
+        f"{aws_s3_key_prefix}/{user_id}/{annot_file_name}",
+        f"{aws_s3_key_prefix}/{user_id}/{log_file_name}",
+    )
+
+
+"""Key of the result index entry for an input file's content hash
+
+   Entries live in the results bucket, one per (reference release, input
+   SHA-256), and point at the results of the job that first annotated
+   that content.
+"""
+
+
+def index_key(digest):
+    release = config.get("ann", "ReferenceRelease", fallback="hg19")
+    return f"{config['aws']['AwsS3KeyPrefix']}/results-index/{release}/{digest}.json"
+
+
+"""Result index entry for digest, or None if no job has annotated the same
+   content against the current reference release
+"""
+
+
+def find_result(digest):
+    try:
+        response = get_client("s3").get_object(
+            Bucket=config["aws"]["AwsS3ResultsBucket"], Key=index_key(digest)
         )
-        log_file_name = input_file_name + ".count.log"
-        log_file_key = f"{aws_s3_key_prefix}/{user_id}/{log_file_name}"
-        s3.upload_file(
-            f"{data_folder_name}/{log_file_name}",
+    except ClientError as e:
+        if e.response["Error"]["Code"] in ["NoSuchKey", "404"]:
+            return None
+        raise
+    return json.loads(response["Body"].read())
+
+
+"""Marks the job completed, notifies the user and requests the archive of
+   its results; reused_from is the job whose results were copied, if any
+"""
+
+
+def complete_job(
+    user_id, user_email, job_id, annot_file_key, log_file_key, reused_from=None
+):
+    results_bucket_name = config["aws"]["AwsS3ResultsBucket"]
+
+    # Update dynamoDB
+    table = get_client("dynamodb").Table(config["aws"]["AwsDynamodbAnnotationsTable"])
+    update = """
+            SET job_status = :status, 
+                s3_results_bucket = :results_bucket,
+                s3_key_result_file = :result_key,
+                s3_key_log_file = :log_key,
+                complete_time = :complete_time
+        """
+    values = {
+        ":status": "COMPLETED",
+        ":results_bucket": config["aws"]["AwsS3ResultsBucket"],
+        ":result_key": annot_file_key,
+        ":log_key": log_file_key,
+        ":complete_time": int(time.time()),
+    }
+    if reused_from is not None:
+        update = update + ", result_reused_from = :reused_from"
+        values[":reused_from"] = reused_from
+    table.update_item(
+        Key={"job_id": job_id},
+        UpdateExpression=update,
+        ExpressionAttributeValues=values,
+    )
+
+    message = {
+        "email": user_email,
+        "message": f"""Dear user:
+        Your annotation job {job_id} is finished.""",
+    }
+    # Send message to result queue
+    sns_client = get_client("sns")
+    sns_client.publish(
+        TopicArn=config["aws"]["AwsSnsJobCompleteTopic"],
+        Message=json.dumps(message),
+    )
+    print(f"Sent notification for job {job_id}.")
+
+    sqs = get_client("sqs")
+    queue_url = sqs.get_queue_url(QueueName=config["aws"]["AwsSqsArchiveRequestQueueName"])[
+        "QueueUrl"
+    ]
+    body = {
+        "job_id": job_id,
+        "user_id": user_id,
+        "s3_key_result_file": annot_file_key,
+        "s3_results_bucket": results_bucket_name,
+    }
+    response = sqs.send_message(
+        QueueUrl=queue_url, MessageBody=json.dumps(body)
+    )
+    print(f"Pushed delayed archive request for job {job_id}")
+
+
+"""Annotates one input file, uploads the results, marks the job completed
+   and notifies the user; returns the job id and the annotation runtime
+
+   digest is the SHA-256 of the input; when given, the results are
+   recorded in the result index for later jobs with the same input.
+   source, an s3stream.S3Stream, is read instead of the local input file
+   if given; its hash is recorded once it has been read.
+"""
+
+
+def annotate_job(
+    input_file_path, user_id, user_email, job_id, digest=None, source=None
+):
+    input_file_name = os.path.basename(input_file_path)
+    with Timer() as timer:
+        if source is None:
+            driver.run(input_file_path, "vcf")
+        else:
+            try:
+                driver.run(input_file_path, "vcf", stream=s3stream.openText(source))
+            finally:
+                source.close()
+            if config.getboolean("ann", "ResultReuse", fallback=True):
+                digest = source.hexdigest()
+
+    data_folder_name = config["local"][
+        "DataFolderName"
+    ]  # The local dir name storing the results
+    results_bucket_name = config["aws"]["AwsS3ResultsBucket"]
+
+    # Upload to s3
+    s3 = get_client("s3")
+    annot_file_key, log_file_key = result_keys(input_file_name, user_id)
+    annot_file_name = os.path.basename(annot_file_key)
+    s3.upload_file(
+        f"{data_folder_name}/{annot_file_name}",
+        Bucket=results_bucket_name,
+        Key=annot_file_key,
+    )
+    log_file_name = os.path.basename(log_file_key)
+    s3.upload_file(
+        f"{data_folder_name}/{log_file_name}",
+        Bucket=results_bucket_name,
+        Key=log_file_key,
+    )
+    print(f"Result for {input_file_name} has been uploaded.")
+
+    if digest is not None:
+        s3.put_object(
             Bucket=results_bucket_name,
-            Key=log_file_key,
-        )
-        print(f"Result for {input_file_name} has been uploaded.")
-
-        # Update dynamoDB
-        dynamodb = boto3.resource("dynamodb")
-        table = dynamodb.Table(config["aws"]["AwsDynamodbAnnotationsTable"])
-        table.update_item(
-            Key={"job_id": job_id},
-            UpdateExpression="""
-                SET job_status = :status, 
-                    s3_results_bucket = :results_bucket,
-                    s3_key_result_file = :result_key,
-                    s3_key_log_file = :log_key,
-                    complete_time = :complete_time
-            """,
-            ExpressionAttributeValues={
-                ":status": "COMPLETED",
-                ":results_bucket": config["aws"]["AwsS3ResultsBucket"],
-                ":result_key": annot_file_key,
-                ":log_key": log_file_key,
-                ":complete_time": int(time.time()),
-            },
+            Key=index_key(digest),
+            Body=json.dumps(
+                {
+                    "job_id": job_id,
+                    "s3_key_result_file": annot_file_key,
+                    "s3_key_log_file": log_file_key,
+                }
+            ),
         )
 
-        message = {
-            "email": user_email,
-            "message": f"""Dear user:
-            Your annotation job {job_id} is finished.""",
-        }
-        # Send message to result queue
-        sns_client = boto3.client("sns")
-        sns_client.publish(
-            TopicArn=config["aws"]["AwsSnsJobCompleteTopic"],
-            Message=json.dumps(message),
-        )
-        print(f"Sent notification for {input_file_name}.")
-
-        sqs = boto3.client("sqs", region_name=config["aws"]["AwsRegionName"])
-        queue_url = sqs.get_queue_url(QueueName=config["aws"]["AwsSqsArchiveRequestQueueName"])[
-            "QueueUrl"
-        ]
-        body = {
-            "job_id": job_id,
-            "user_id": user_id,
-            "s3_key_result_file": annot_file_key,
-            "s3_results_bucket": results_bucket_name,
-        }
-        response = sqs.send_message(
-            QueueUrl=queue_url, MessageBody=json.dumps(body)
-        )
-        print(f"Pushed delayed archive request for job {job_id}")
+    complete_job(user_id, user_email, job_id, annot_file_key, log_file_key)
 
-        # Deleted local file
-        cur_dir = os.path.dirname(os.path.abspath(__file__))
-        os.remove(os.path.join(cur_dir, data_folder_name, annot_file_name))
-        os.remove(os.path.join(cur_dir, data_folder_name, log_file_name))
+    # Deleted local file
+    cur_dir = os.path.dirname(os.path.abspath(__file__))
+    os.remove(os.path.join(cur_dir, data_folder_name, annot_file_name))
+    os.remove(os.path.join(cur_dir, data_folder_name, log_file_name))
+    if os.path.exists(os.path.join(cur_dir, input_file_path)):
         os.remove(os.path.join(cur_dir, input_file_path))
+    return {"job_id": job_id, "secs": timer.secs}
+
+
+"""Annotates an input read straight from S3 as it downloads, instead of
+   from a local copy; gzipped inputs are decompressed on the fly
+"""
+
+
+def stream_job(bucket, key, input_file_path, user_id, user_email, job_id):
+    source = s3stream.S3Stream(
+        get_client("s3"),
+        bucket,
+        key,
+        part_size=config.getint("ann", "StreamPartSize", fallback=8388608),
+        parallel=config.getint("ann", "StreamParallel", fallback=4),
+        readahead=config.getint("ann", "StreamReadAhead", fallback=8),
+    )
+    return annotate_job(input_file_path, user_id, user_email, job_id, source=source)
+
+
+"""Completes a job from the results of an earlier job with the same input,
+   entry being its result index entry: the results are copied within S3
+   and nothing is annotated. Falls back to annotate_job() if the earlier
+   results are gone (e.g. archived).
+"""
+
+
+def reuse_job(input_file_path, user_id, user_email, job_id, digest, entry):
+    input_file_name = os.path.basename(input_file_path)
+    results_bucket_name = config["aws"]["AwsS3ResultsBucket"]
+    s3 = get_client("s3")
+    annot_file_key, log_file_key = result_keys(input_file_name, user_id)
+    with Timer() as timer:
+        try:
+            for source, target in [
+                (entry["s3_key_result_file"], annot_file_key),
+                (entry["s3_key_log_file"], log_file_key),
+            ]:
+                # A redelivered job finds its own results in the index
+                if source == target:
+                    continue
+                s3.copy(
+                    {"Bucket": results_bucket_name, "Key": source},
+                    Bucket=results_bucket_name,
+                    Key=target,
+                )
+        except ClientError as e:
+            print(f"Results of job {entry['job_id']} unavailable ({e}), annotating.")
+            return annotate_job(input_file_path, user_id, user_email, job_id, digest)
+    print(f"Result for {input_file_name} copied from job {entry['job_id']}.")
+
+    complete_job(
+        user_id,
+        user_email,
+        job_id,
+        annot_file_key,
+        log_file_key,
+        reused_from=entry["job_id"],
+    )
+
+    # Deleted local file
+    cur_dir = os.path.dirname(os.path.abspath(__file__))
+    os.remove(os.path.join(cur_dir, input_file_path))
+    return {"job_id": job_id, "secs": timer.secs}
+
+
+if __name__ == "__main__":
+    # Call the AnnTools pipeline
+    if len(sys.argv) > 4:
+        annotate_job(sys.argv[1], sys.argv[2], sys.argv[3], sys.argv[4])
 
     else:
         print("A valid .vcf file must be provided as input to this program.")
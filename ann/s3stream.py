@@ -0,0 +1,91 @@
+# s3stream.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Reads an S3 object as a stream of lines while it downloads
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import io
+import gzip
+import hashlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+"""Raw byte stream over an S3 object, fetched as ranged GETs of part_size
+   bytes
+
+   Up to parallel parts download at a time and at most readahead parts
+   are held ahead of the reader, fetched or in flight, so memory stays
+   bounded however large the object is. Bytes are handed out in order as
+   soon as the part holding them has arrived. The SHA-256 of the bytes
+   read so far is kept in hash.
+"""
+class S3Stream(io.RawIOBase):
+
+    def __init__(self, client, bucket, key, part_size=8388608, parallel=4,
+        readahead=8):
+        self.client = client
+        self.bucket = bucket
+        self.key = key
+        self.readahead = max(readahead, parallel)
+        size = client.head_object(Bucket=bucket, Key=key)['ContentLength']
+        self.parts = [(start, min(start + part_size, size) - 1)
+            for start in range(0, size, part_size)]
+        self.next_part = 0
+        self.pending = deque()
+        self.pool = ThreadPoolExecutor(max_workers=parallel)
+        self.buffer = memoryview(b'')
+        self.hash = hashlib.sha256()
+        self.fill()
+
+    def fetch(self, first, last):
+        response = self.client.get_object(Bucket=self.bucket, Key=self.key,
+            Range=f"bytes={first}-{last}")
+        return response['Body'].read()
+
+    def fill(self):
+        while (len(self.pending) < self.readahead) and \
+            (self.next_part < len(self.parts)):
+            self.pending.append(self.pool.submit(self.fetch,
+                *self.parts[self.next_part]))
+            self.next_part = self.next_part + 1
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while (len(self.buffer) == 0):
+            if (len(self.pending) == 0):
+                return 0
+            data = self.pending.popleft().result()
+            self.hash.update(data)
+            self.buffer = memoryview(data)
+            self.fill()
+        n = min(len(b), len(self.buffer))
+        b[:n] = self.buffer[:n]
+        self.buffer = self.buffer[n:]
+        return n
+
+    def hexdigest(self):
+        return self.hash.hexdigest()
+
+    def close(self):
+        if not self.closed:
+            self.pool.shutdown(wait=False, cancel_futures=True)
+            self.pending.clear()
+        super().close()
+
+
+"""Text lines of an S3Stream, gunzipped on the fly if it starts with the
+   gzip magic number
+"""
+def openText(source, buffer_size=1048576):
+    fh = io.BufferedReader(source, buffer_size=buffer_size)
+    if (fh.peek(2)[:2] == b'\x1f\x8b'):
+        fh = gzip.GzipFile(fileobj=fh, mode='rb')
+    return io.TextIOWrapper(fh)
+
+### EOF
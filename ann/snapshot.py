@@ -0,0 +1,398 @@
+# snapshot.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Versioned, memory-mapped binary snapshot of the reference tables, so
+# annotation workers answer lookups without the reference database
+#
+# Build it with:
+#   python snapshot.py reference.snap                   (configured backend)
+#   python snapshot.py --sqlite ref.db reference.snap   (local SQLite copy)
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import os
+import mmap
+import json
+import array
+import struct
+import argparse
+from bisect import bisect_left
+
+# magic, format version, reference release, table of contents offset
+# and length
+HEADER = struct.Struct('<4sI32sQQ')
+MAGIC = b'GASR'
+VERSION = 2
+
+TFBS_CHROMS = ['1','2','3','4','5','6','7','8','9','10','11','12','13',
+    '14','15','16','17','18','19','20','21','22','X','Y']
+
+# Tables in a snapshot with the chromosome column and the start and end
+# columns their lookups compare positions against (start = end for the
+# tables looked up by exact position)
+TABLES = [
+    ('dbSNP', 'CHR', 'POS', 'POS'),
+    ('chrom_pos_equal_base', 'CHR', 'start', 'start'),
+    ('chrom_pos_equal_nobase', 'CHR', 'start', 'start'),
+    ('chrom_pos_unequal', 'CHR', 'start', 'end'),
+    ('refGene', 'chrom', 'txStart', 'txEnd'),
+    ('cytoBand', 'chrom', 'chromStart', 'chromEnd'),
+    ('gadAll', 'chromosome', 'chromStart', 'chromEnd'),
+    ('gwasCatalog', 'chrom', 'chromEnd', 'chromEnd'),
+    ('hugo', 'chrom', 'chromStart', 'chromEnd'),
+    ('dgv_Cnv', 'chrom', 'chromStart', 'chromEnd'),
+    ('abParts_IG_T_CelReceptors', 'chrom', 'chromStart', 'chromEnd'),
+    ('mcCarroll_Cnv', 'chrom', 'chromStart', 'chromEnd'),
+    ('conrad_Cnv', 'chrom', 'chromStart', 'chromEnd'),
+    ('genomicSuperDups', 'chrom', 'chromStart', 'chromEnd'),
+    ('targetScanS', 'chrom', 'chromStart', 'chromEnd'),
+    ('cpgIslandExt', 'chrom', 'chromStart', 'chromEnd'),
+] + [('tfbsConsSites' + c, 'chrom', 'chromStart', 'chromEnd')
+    for c in TFBS_CHROMS]
+
+
+"""Smallest array typecode that holds all of values
+"""
+def intTypecode(values):
+    if all([-2**31 <= v < 2**31 for v in values]):
+        return 'i'
+    return 'q'
+
+
+"""Appends data to the bundle being written, 8-byte aligned
+   Returns [offset, typecode, length] as stored in the table of contents
+"""
+def writeArray(fh, typecode, values):
+    fh.write(b'\0' * (-fh.tell() % 8))
+    offset = fh.tell()
+    fh.write(array.array(typecode, values).tobytes())
+    return [offset, typecode, len(values)]
+
+
+def writeBytes(fh, data):
+    fh.write(b'\0' * (-fh.tell() % 8))
+    offset = fh.tell()
+    fh.write(data)
+    return [offset, 'B', len(data)]
+
+
+"""Writes one column of a block: ints and floats as arrays, anything else
+   as a string table (offsets into one blob of utf-8 or raw bytes)
+"""
+def writeColumn(fh, values):
+    nulls = [i for i in range(len(values)) if values[i] is None]
+    present = [v for v in values if v is not None]
+    column = {'nulls': writeArray(fh, 'i', nulls) if nulls else None}
+    fill = lambda default: [default if (v is None) else v for v in values]
+
+    if present and all([type(v) is int for v in present]):
+        column['type'] = 'int'
+        data = fill(0)
+        column['data'] = writeArray(fh, intTypecode(data), data)
+    elif present and all([type(v) is float for v in present]):
+        column['type'] = 'float'
+        column['data'] = writeArray(fh, 'd', fill(0.0))
+    else:
+        is_bytes = present and all([type(v) is bytes for v in present])
+        column['type'] = 'bytes' if is_bytes else 'str'
+        encoded = [b'' if (v is None) else
+            (v if is_bytes else str(v).encode('utf-8')) for v in values]
+        offsets = [0]
+        for v in encoded:
+            offsets.append(offsets[-1] + len(v))
+        column['offsets'] = writeArray(fh, intTypecode(offsets), offsets)
+        column['data'] = writeBytes(fh, b''.join(encoded))
+    return column
+
+
+"""Nested containment list layout of intervals: positions in the flat
+   order, the sublist of each position as a [first, last) range of
+   positions (empty if it contains no other interval) and the length of
+   the top list, which comes first. Within each sublist both starts and
+   ends are increasing.
+"""
+def nestedLayout(starts, ends):
+    top = []
+    children = {}
+    stack = []
+    for i in sorted(range(len(starts)), key=lambda i: (starts[i], -ends[i], i)):
+        while (len(stack) > 0) and (ends[stack[-1]] < ends[i]):
+            stack.pop()
+        if (len(stack) > 0):
+            children.setdefault(stack[-1], []).append(i)
+        else:
+            top.append(i)
+        stack.append(i)
+
+    flat = list(top)
+    sublists = {}
+    k = 0
+    while (k < len(flat)):
+        nested = children.get(flat[k], [])
+        sublists[flat[k]] = (len(flat), len(flat) + len(nested))
+        flat.extend(nested)
+        k = k + 1
+    return (flat, [sublists[i][0] for i in flat],
+        [sublists[i][1] for i in flat], len(top))
+
+
+"""Writes the rows of one chromosome as a block in nested containment
+   list order (see nestedLayout()), so an overlap query only visits the
+   intervals that hold the position and one more per sublist, whatever
+   the lengths of the others. Ordinals keep the order the rows were read
+   in, so lookups can return hits in table order.
+"""
+def writeBlock(fh, rows, start_ind, end_ind):
+    (order, subStarts, subEnds, top) = nestedLayout(
+        [int(row[start_ind]) for row in rows],
+        [int(row[end_ind]) for row in rows])
+    rows = [rows[i] for i in order]
+    starts = [int(row[start_ind]) for row in rows]
+    ends = [int(row[end_ind]) for row in rows]
+
+    return {'count': len(rows), 'top': top,
+        'starts': writeArray(fh, intTypecode(starts), starts),
+        'ends': writeArray(fh, intTypecode(ends), ends),
+        'subStarts': writeArray(fh, intTypecode(subStarts), subStarts),
+        'subEnds': writeArray(fh, intTypecode(subEnds), subEnds),
+        'ordinals': writeArray(fh, intTypecode(order), order),
+        'columns': [writeColumn(fh, [row[c] for row in rows])
+            for c in range(len(rows[0]))]}
+
+
+"""Exports tables (TABLES entries) read through cursor to a snapshot at
+   path, one chromosome at a time
+"""
+def build(cursor, path, release='', tables=TABLES, log=print):
+    if (len(release.encode()) > 32):
+        raise ValueError(f"Release '{release}' is longer than 32 bytes")
+    toc = {}
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as fh:
+        fh.write(HEADER.pack(MAGIC, VERSION, b'', 0, 0))
+        for (table, chromName, startName, endName) in tables:
+            cursor.execute('select distinct ' + chromName + ' from ' +
+                table + ';')
+            chroms = sorted([str(row[0]) for row in cursor.fetchall()])
+            # Column names come from an empty select, so empty tables
+            # have them too
+            cursor.execute('select * from ' + table + ' limit 0;')
+            names = [str(d[0]) for d in cursor.description]
+            entry = {'layout': [chromName, startName, endName],
+                'names': names, 'blocks': {}}
+            count = 0
+            for chrom in chroms:
+                cursor.execute('select * from ' + table + ' where ' +
+                    chromName + '="' + chrom + '";')
+                rows = cursor.fetchall()
+                if (len(rows) == 0):
+                    continue
+                entry['blocks'][chrom] = writeBlock(fh, rows,
+                    names.index(startName), names.index(endName))
+                count = count + len(rows)
+            toc[table] = entry
+            log(f"{table}: {count} rows")
+
+        data = json.dumps(toc).encode('utf-8')
+        toc_offset = fh.tell()
+        fh.write(data)
+        fh.seek(0)
+        fh.write(HEADER.pack(MAGIC, VERSION, release.encode(),
+            toc_offset, len(data)))
+    os.replace(tmp, path)
+
+
+"""Rows of one chromosome of a snapshot table, read in place from the map
+"""
+class Block(object):
+
+    def __init__(self, snapshot, entry):
+        self.map = snapshot.map
+        self.count = entry['count']
+        self.top = entry['top']
+        self.starts = snapshot.view(entry['starts'])
+        self.ends = snapshot.view(entry['ends'])
+        self.subStarts = snapshot.view(entry['subStarts'])
+        self.subEnds = snapshot.view(entry['subEnds'])
+        self.ordinals = snapshot.view(entry['ordinals'])
+        self.columns = []
+        for column in entry['columns']:
+            nulls = frozenset(snapshot.view(column['nulls'])) \
+                if column['nulls'] else frozenset()
+            if column['type'] in ['int', 'float']:
+                self.columns.append((column['type'],
+                    snapshot.view(column['data']), None, nulls))
+            else:
+                self.columns.append((column['type'], column['data'][0],
+                    snapshot.view(column['offsets']), nulls))
+
+    def value(self, column, i):
+        (kind, data, offsets, nulls) = column
+        if i in nulls:
+            return None
+        if offsets is None:
+            return data[i]
+        value = self.map[data + offsets[i]:data + offsets[i + 1]]
+        return value if (kind == 'bytes') else value.decode('utf-8')
+
+    def row(self, i):
+        return tuple([self.value(column, i) for column in self.columns])
+
+    """Positions of the rows with start <= pos <= end, in table order
+    """
+    def hits(self, pos):
+        hits = []
+        lists = [(0, self.top)]
+        while (len(lists) > 0):
+            (first, last) = lists.pop()
+            i = bisect_left(self.ends, pos, first, last)
+            while (i < last) and (self.starts[i] <= pos):
+                hits.append(i)
+                if (self.subStarts[i] < self.subEnds[i]):
+                    lists.append((self.subStarts[i], self.subEnds[i]))
+                i = i + 1
+        return sorted(hits, key=lambda i: self.ordinals[i])
+
+
+"""One table of a snapshot, with the overlap(chrom, pos) and
+   first(chrom, pos) lookups of an intervals.IntervalIndex over its
+   layout columns. Hits come back in the order the table was read.
+"""
+class SnapshotTable(object):
+
+    def __init__(self, snapshot, name, entry):
+        self.name = name
+        self.names = entry['names']
+        self.layout = entry['layout']
+        self.blocks = dict([(chrom, Block(snapshot, block))
+            for (chrom, block) in entry['blocks'].items()])
+
+    def chroms(self):
+        return sorted(self.blocks)
+
+    def overlap(self, chrom, pos):
+        block = self.blocks.get(str(chrom))
+        if block is None:
+            return []
+        return [block.row(i) for i in block.hits(int(pos))]
+
+    def first(self, chrom, pos):
+        block = self.blocks.get(str(chrom))
+        if block is None:
+            return None
+        hits = block.hits(int(pos))
+        if (len(hits) == 0):
+            return None
+        return block.row(hits[0])
+
+    """All rows, a chromosome at a time in table order
+    """
+    def rows(self):
+        for chrom in self.chroms():
+            block = self.blocks[chrom]
+            for i in sorted(range(block.count), key=lambda i: block.ordinals[i]):
+                yield block.row(i)
+
+
+"""Read-only snapshot memory-mapped from a file written by build()
+   Arrays are used in place, so processes mapping the same file share
+   its pages through the page cache.
+"""
+class Snapshot(object):
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as fh:
+            self.map = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, version, release, toc_offset, toc_length) = \
+            HEADER.unpack_from(self.map, 0)
+        if (magic != MAGIC):
+            raise ValueError(f"{path} is not a reference snapshot")
+        if (version != VERSION):
+            raise ValueError(f"{path} has snapshot format {version}, " +
+                f"expected {VERSION}")
+        self.release = release.rstrip(b'\0').decode()
+        self.toc = json.loads(self.map[toc_offset:toc_offset + toc_length])
+        self.views = []
+        self.tables = {}
+
+    def view(self, ref):
+        (offset, typecode, length) = ref
+        size = array.array(typecode).itemsize
+        view = memoryview(self.map)[offset:offset + length * size]
+        cast = view.cast(typecode)
+        self.views.extend([view, cast])
+        return cast
+
+    def has(self, table):
+        return table in self.toc
+
+    def table(self, name):
+        if name not in self.tables:
+            self.tables[name] = SnapshotTable(self, name, self.toc[name])
+        return self.tables[name]
+
+    def close(self):
+        self.tables = {}
+        for view in reversed(self.views):
+            view.release()
+        self.views = []
+        self.map.close()
+
+
+# Snapshots opened so far in this process, by path
+snapshots = {}
+
+"""Opens the snapshot at path once per process
+   Returns None if the file is missing or was built against another
+   reference release
+"""
+def getSnapshot(path, release=''):
+    if path not in snapshots:
+        snapshot = None
+        if os.path.exists(path):
+            snapshot = Snapshot(path)
+            if (snapshot.release != release):
+                print(f"Ignoring {path}: built for release " +
+                    f"'{snapshot.release}', expected '{release}'")
+                snapshot.close()
+                snapshot = None
+        snapshots[path] = snapshot
+    return snapshots[path]
+
+
+if __name__ == "__main__":
+    import backends
+    from configparser import ConfigParser
+
+    config = ConfigParser(os.environ)
+    config.read(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+        'ann_config.ini'))
+
+    parser = argparse.ArgumentParser(
+        description='Export the reference tables to a snapshot file')
+    parser.add_argument('outfile')
+    parser.add_argument('--release',
+        default=config.get('ann', 'ReferenceRelease', fallback=''))
+    parser.add_argument('--sqlite',
+        help='read the tables from this SQLite file instead of the ' +
+        'configured reference backend')
+    parser.add_argument('--tables', nargs='*',
+        help='export only these tables')
+    args = parser.parse_args()
+
+    backend = backends.SQLiteBackend(args.sqlite) if args.sqlite \
+        else backends.getBackend()
+    tables = [t for t in TABLES if (not args.tables) or (t[0] in args.tables)]
+    with backend.connection() as conn:
+        build(conn.cursor(), args.outfile, release=args.release, tables=tables)
+
+    snapshot = Snapshot(args.outfile)
+    print(f"{len(snapshot.toc)} tables, " +
+        f"{os.path.getsize(args.outfile)} bytes, release '{snapshot.release}'")
+    snapshot.close()
+
+### EOF
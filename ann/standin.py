@@ -0,0 +1,260 @@
+# standin.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Builds a small synthetic SQLite stand-in for the reference database,
+# with the tables and columns the annotation stages query, and a VCF
+# whose variants hit them. Rows are stored in random order, as in the
+# production tables, so code that depends on the storage order shows up.
+#
+# Build it with:
+#   python standin.py standin.db standin.vcf
+#   python standin.py --rtree standin.db standin.vcf
+#
+# The range tables get real UCSC bins and (chrom, bin) indexes unless
+# --no-bins is given, so the bin predicates of the range queries narrow
+# the rows as they do on the production tables.
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import os
+import random
+import sqlite3
+import argparse
+
+CHROMS = ['1', '2', '3', 'X']
+CHROM_LENGTH = 200000
+ORDER = {'1': 1, '2': 2, '3': 3, 'X': 23}
+
+BIG_REF_GENE_COLUMNS = ['CHR', 'start', 'end', 'haplotypeReference',
+    'haplotypeAlternate', 'name', 'name2', 'transcriptStrand',
+    'positionType', 'frame', 'mrnaCoord', 'codonCoord', 'spliceDist',
+    'referenceCodon', 'referenceAA', 'variantCodon', 'variantAA',
+    'changesAA', 'functionalClass', 'codingCoordStr', 'proteinCoordStr',
+    'inCodingRegion', 'spliceInfo', 'uorfChange']
+
+# Tables the stages look up through overlap indexes, with their chromosome
+# column where it is not chrom
+OVERLAP_TABLES = ['cytoBand', 'hugo', 'gadAll:chromosome', 'cpgIslandExt',
+    'dgv_Cnv', 'abParts_IG_T_CelReceptors', 'mcCarroll_Cnv', 'conrad_Cnv',
+    'genomicSuperDups', 'targetScanS']
+
+"""Shuffled (chrom, start, end) intervals, n per chromosome
+"""
+def intervals(rand, n, max_length):
+    rows = []
+    for chrom in CHROMS:
+        for i in range(n):
+            start = rand.randint(1, CHROM_LENGTH)
+            rows.append((chrom, start, start + rand.randint(0, max_length)))
+    rand.shuffle(rows)
+    return rows
+
+
+"""Table with UCSC's bin, chrom, chromStart, chromEnd, name layout and six
+   more columns from extra()
+"""
+def addSimpleTable(conn, rand, table, n, max_length, extra):
+    conn.execute('create table ' + table + ' (bin, chrom, chromStart, ' +
+        'chromEnd, name, c5, c6, c7, c8, c9, c10)')
+    conn.executemany('insert into ' + table +
+        ' values (?,?,?,?,?,?,?,?,?,?,?)',
+        [(0, 'chr' + chrom, start, end,
+        table + '_' + str(rand.randint(1, 99))) + extra()
+        for (chrom, start, end) in intervals(rand, n, max_length)])
+
+
+def addDbSnp(conn, rand, n):
+    conn.execute('create table dbSNP ' +
+        '(CHR, POS, REF, ID, ALT, QUAL, INFO, GMAF)')
+    for chrom in CHROMS:
+        for i in range(n):
+            pos = rand.randint(1, CHROM_LENGTH)
+            for k in range(rand.choice([1, 1, 1, 2])):
+                conn.execute('insert into dbSNP values (?,?,?,?,?,?,?,?)',
+                    (chrom, pos, rand.choice('ACGT'),
+                    'rs' + str(rand.randint(1, 10**7)), rand.choice('ACGT'),
+                    '.', rand.choice(['SNV', 'SNV', 'DIV']),
+                    rand.choice(['.', '0.01', '0.2'])))
+
+
+def addBigRefGene(conn, rand):
+    for (table, n, max_length) in [('chrom_pos_equal_base', 1500, 0),
+        ('chrom_pos_equal_nobase', 800, 0), ('chrom_pos_unequal', 600, 3000)]:
+        conn.execute('create table ' + table + ' (id, ' +
+            ','.join(BIG_REF_GENE_COLUMNS) + ')')
+        for (chrom, start, end) in intervals(rand, n, max_length):
+            row = [None, chrom, start, end, rand.choice('ACGT'),
+                rand.choice('ACGT'), 'NM_' + str(rand.randint(1, 999)),
+                'G' + str(rand.randint(1, 99)), rand.choice('+-'),
+                rand.choice(['CDS', 'intron', 'utr5', 'utr3',
+                'non_coding_exon', 'non_coding_intron']),
+                rand.choice([0, 1, 2])] + \
+                [rand.choice(['', '0', 'x' + str(rand.randint(1, 5))])
+                for i in range(14)]
+            conn.execute('insert into ' + table + ' values (' +
+                ','.join('?' * 25) + ')', row)
+
+
+def addRefGene(conn, rand):
+    conn.execute('create table refGene (bin, name, chrom, strand, txStart, ' +
+        'txEnd, cdsStart, cdsEnd, exonCount, exonStarts BLOB, ' +
+        'exonEnds BLOB, score, name2, cdsStartStat, cdsEndStat, exonFrames)')
+    for (chrom, start, end) in intervals(rand, 150, 20000):
+        count = rand.randint(1, 8)
+        bounds = sorted(rand.sample(range(start, end + 1),
+            min(2 * count, end - start + 1)))
+        count = len(bounds) // 2
+        starts = [bounds[2 * i] for i in range(count)]
+        ends = [bounds[2 * i + 1] for i in range(count)]
+        if (count == 0):
+            (starts, ends, count) = ([start], [end], 1)
+        if (rand.random() < 0.3):
+            cds_start = cds_end = end
+        else:
+            cds_start = rand.randint(start, end)
+            cds_end = rand.randint(cds_start, end)
+        conn.execute('insert into refGene values ' +
+            '(?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)',
+            (0, 'NM_' + str(rand.randint(1, 9999)), 'chr' + chrom,
+            rand.choice('+-'), start, end, cds_start, cds_end, count,
+            (','.join(map(str, starts)) + ',').encode(),
+            (','.join(map(str, ends)) + ',').encode(), 0,
+            'GENE' + str(rand.randint(1, 500)), 'cmpl', 'cmpl', ''))
+
+
+def addRangeTables(conn, rand):
+    addSimpleTable(conn, rand, 'cpgIslandExt', 300, 1500,
+        lambda: ('a',) * 6)
+    addSimpleTable(conn, rand, 'cytoBand', 40, 10000, lambda: ('a',) * 6)
+    addSimpleTable(conn, rand, 'hugo', 100, 8000,
+        lambda: ('HGNC:' + str(rand.randint(1, 50)),
+        'desc;x' + str(rand.randint(1, 3)), 'a', 'a', 'a', 'a'))
+    addSimpleTable(conn, rand, 'genomicSuperDups', 60, 8000,
+        lambda: ('+', 'chr' + str(rand.randint(1, 22)),
+        rand.randint(1, 10**6), rand.randint(1, 10**6), 'a', 'a'))
+    for table in ['dgv_Cnv', 'abParts_IG_T_CelReceptors', 'mcCarroll_Cnv',
+        'conrad_Cnv']:
+        addSimpleTable(conn, rand, table, 50, 10000, lambda: ('a',) * 6)
+    addSimpleTable(conn, rand, 'targetScanS', 400, 30, lambda: ('a',) * 6)
+
+    conn.execute('create table gadAll ' +
+        '(bin, chromosome, chromStart, name, chromEnd)')
+    conn.executemany('insert into gadAll values (?,?,?,?,?)',
+        [(0, chrom, start, 'GAD' + str(rand.randint(1, 30)), end)
+        for (chrom, start, end) in intervals(rand, 80, 5000)])
+
+    conn.execute('create table gwasCatalog (bin, chrom, chromStart, ' +
+        'chromEnd, name, pubMedID, a, b, cc, d, trait)')
+    conn.executemany('insert into gwasCatalog values (?,?,?,?,?,?,?,?,?,?,?)',
+        [(0, 'chr' + chrom, start - 1, start, 'rs', rand.randint(1, 10**6),
+        'a', 'b', 'c', 'd', 'trait' + str(rand.randint(1, 9)))
+        for (chrom, start, end) in intervals(rand, 300, 0)])
+
+    # One table per chromosome; the ones the variants are not on stay
+    # empty, and so does X, so some lookups go to an empty table
+    for chrom in [str(i) for i in range(1, 23)] + ['X', 'Y']:
+        conn.execute('create table tfbsConsSites' + chrom +
+            ' (bin, chrom, chromStart, chromEnd, name)')
+        conn.executemany('insert into tfbsConsSites' + chrom +
+            ' values (?,?,?,?,?)',
+            [(0, 'chr' + chrom, start, end, 'V$TF' + str(rand.randint(1, 40)))
+            for (c, start, end) in intervals(rand, 200, 40)
+            if (c == chrom) and (c != 'X')])
+
+
+"""Fills the bin columns of the range tables from their start and end and
+   adds (chrom, bin) indexes
+"""
+def addBins(conn):
+    import binning
+    for spec in OVERLAP_TABLES + ['gwasCatalog', 'refGene:chrom:txStart:txEnd']:
+        parts = spec.split(':')
+        names = parts[1:] + ['chrom', 'chromStart', 'chromEnd'][len(parts) - 1:]
+        binning.addBins(conn, parts[0], chromName=names[0],
+            startName=names[1], endName=names[2], refill=True)
+
+
+"""Builds the stand-in database at path; returns its connection. bins
+   fills the bin columns, which are otherwise left 0
+"""
+def buildDatabase(path, seed=7, bins=True):
+    if os.path.exists(path):
+        os.remove(path)
+    rand = random.Random(seed)
+    conn = sqlite3.connect(path)
+    addDbSnp(conn, rand, 3000)
+    addBigRefGene(conn, rand)
+    addRefGene(conn, rand)
+    addRangeTables(conn, rand)
+    conn.commit()
+    if bins:
+        addBins(conn)
+    return conn
+
+
+"""Writes a VCF of about n variants: dbSNP and bigRefGene positions (some
+   with another reference base) and random positions, in random order
+   with and without the chr prefix; sorted writes them by position
+"""
+def writeVcf(conn, path, n=4000, seed=7, sorted_output=False):
+    rand = random.Random(seed)
+    variants = []
+    rows = conn.execute('select CHR, POS, REF from dbSNP').fetchall()
+    for (chrom, pos, ref) in rand.sample(rows, min(len(rows), n * 3 // 8)):
+        variants.append((chrom, pos,
+            ref if (rand.random() < 0.7) else rand.choice('ACGT')))
+    for table in ['chrom_pos_equal_base', 'chrom_pos_equal_nobase']:
+        rows = conn.execute('select CHR, start, haplotypeReference from ' +
+            table).fetchall()
+        variants.extend(rand.sample(rows, min(len(rows), n * 3 // 40)))
+    for chrom in CHROMS:
+        for i in range(n // 8):
+            variants.append((chrom, rand.randint(1, CHROM_LENGTH),
+                rand.choice('ACGT')))
+    rand.shuffle(variants)
+    if sorted_output:
+        variants.sort(key=lambda v: (ORDER[v[0]], v[1]))
+
+    with open(path, 'w') as fh:
+        fh.write('##fileformat=VCFv4.1\n##source=standin\n' +
+            '#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\tS1\n')
+        for (chrom, pos, ref) in variants:
+            alt = rand.choice([b for b in 'ACGT' if b != ref])
+            fh.write('\t'.join([rand.choice([chrom, 'chr' + chrom]),
+                str(pos), rand.choice(['.', 'rsOld']), ref, alt, '50',
+                'PASS', rand.choice(['.', 'DP=10', 'DP=3;AF=0.5']), 'GT',
+                '0/1']) + '\n')
+    return len(variants)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='Build a synthetic SQLite stand-in reference and VCF')
+    parser.add_argument('database')
+    parser.add_argument('vcf')
+    parser.add_argument('--variants', type=int, default=4000)
+    parser.add_argument('--seed', type=int, default=7)
+    parser.add_argument('--sorted', action='store_true',
+        help='write the variants sorted by chromosome and position')
+    parser.add_argument('--rtree', action='store_true',
+        help='build R*Tree indexes over the overlap tables')
+    parser.add_argument('--no-bins', dest='bins', action='store_false',
+        help='leave the UCSC bin columns 0, without (chrom, bin) indexes')
+    args = parser.parse_args()
+
+    conn = buildDatabase(args.database, seed=args.seed, bins=args.bins)
+    if args.rtree:
+        import backends
+        for spec in OVERLAP_TABLES:
+            parts = spec.split(':')
+            backends.buildRTree(conn, parts[0],
+                chromName=(parts[1] if (len(parts) > 1) else 'chrom'))
+    count = writeVcf(conn, args.vcf, n=args.variants, seed=args.seed,
+        sorted_output=args.sorted)
+    conn.close()
+    print(f"{args.database}: stand-in reference; {args.vcf}: {count} variants")
+
+### EOF
@@ -13,39 +13,166 @@ __author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
 
 import os
 import json
+import time
+import queue
+import threading
+from contextlib import contextmanager
 import pymysql
 import boto3
 from botocore.exceptions import ClientError
+from configparser import ConfigParser
+
+config = ConfigParser(os.environ)
+config.read(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    'ann_config.ini'))
+
+# RDS secret cached for [ann] DbSecretTtl seconds
+rds_secret = None
+rds_secret_time = 0
+rds_secret_lock = threading.Lock()
+
+"""Get RDS credentials from AWS Secrets Manager, cached per process
+"""
+def get_rds_secret(refresh=False):
+    global rds_secret, rds_secret_time
+    ttl = config.getint('ann', 'DbSecretTtl', fallback=300)
+
+    with rds_secret_lock:
+        if refresh or (rds_secret is None) or \
+            (time.time() - rds_secret_time > ttl):
+            AWS_REGION_NAME = os.environ['AWS_REGION_NAME'] if \
+                ('AWS_REGION_NAME' in  os.environ) else "us-east-1"
+
+            asm = boto3.client('secretsmanager', region_name=AWS_REGION_NAME)
+            try:
+                asm_response = asm.get_secret_value(
+                    SecretId='rds/anntools_database')
+                rds_secret = json.loads(asm_response['SecretString'])
+                rds_secret_time = time.time()
+            except ClientError as e:
+                print(f"Unable to retrieve RDS credentials from AWS Secrets Manager: {e}")
+                raise e
+        return rds_secret
+
 
 """Get connection to reference database
 """
 def db_connect():
-    AWS_REGION_NAME = os.environ['AWS_REGION_NAME'] if \
-        ('AWS_REGION_NAME' in  os.environ) else "us-east-1"
-
-    # Get RDS secret from AWS Secrets Manager
-    asm = boto3.client('secretsmanager', region_name=AWS_REGION_NAME)
     try:
-        asm_response = asm.get_secret_value(SecretId='rds/anntools_database')
-        rds_secret = json.loads(asm_response['SecretString'])
-    except ClientError as e:
-        print(f"Unable to retrieve RDS credentials from AWS Secrets Manager: {e}")
-        raise e
-
-    # Extract database connection parameters
-    rds_host = rds_secret['host']
-    mysql_port = rds_secret['port']
-    username = rds_secret['username']
-    password = rds_secret['password']
-    database_name = 'annotator'
+        return db_open(get_rds_secret())
+    except pymysql.err.OperationalError:
+        # Credentials may have been rotated since they were cached
+        return db_open(get_rds_secret(refresh=True))
+
 
+def db_open(secret):
     # Return a connection to the database
     return pymysql.connect(
-        host=rds_host,
-        port=mysql_port,
-        user=username,
-        passwd=password,
-        db=database_name)
+        host=secret['host'],
+        port=secret['port'],
+        user=secret['username'],
+        passwd=secret['password'],
+        db='annotator')
+
+
+"""Pool of reusable reference database connections
+
+   Connections are handed out most recently used first. One that has 
+   been idle longer than check_interval seconds is pinged before it is 
+   handed out and replaced if it has gone stale. get() blocks when all 
+   size connections are in use.
+"""
+class ConnectionPool(object):
+
+    def __init__(self, size=4, check_interval=30, connect=db_connect):
+        self.size = size
+        self.check_interval = check_interval
+        self.connect = connect
+        self.idle = queue.LifoQueue()
+        self.opened = 0
+        self.lock = threading.Lock()
+
+    def get(self):
+        try:
+            (conn, since) = self.idle.get_nowait()
+        except queue.Empty:
+            with self.lock:
+                can_open = (self.opened < self.size)
+                if can_open:
+                    self.opened = self.opened + 1
+            if can_open:
+                return self.open()
+            (conn, since) = self.idle.get()
+
+        if (time.time() - since > self.check_interval):
+            try:
+                conn.ping(reconnect=True)
+            except pymysql.err.Error:
+                self.close(conn)
+                return self.open()
+        return conn
+
+    def put(self, conn):
+        self.idle.put((conn, time.time()))
+
+    def open(self):
+        try:
+            return self.connect()
+        except Exception:
+            with self.lock:
+                self.opened = self.opened - 1
+            raise
+
+    """Closes a connection that should not go back into the pool
+    """
+    def discard(self, conn):
+        self.close(conn)
+        with self.lock:
+            self.opened = self.opened - 1
+
+    def close(self, conn):
+        try:
+            conn.close()
+        except pymysql.err.Error:
+            pass
+
+    def closeAll(self):
+        while True:
+            try:
+                (conn, since) = self.idle.get_nowait()
+            except queue.Empty:
+                break
+            self.discard(conn)
+
+
+# Process-wide pool, created on first use
+pool = None
+pool_lock = threading.Lock()
+
+def db_pool():
+    global pool
+    with pool_lock:
+        if pool is None:
+            pool = ConnectionPool(
+                size=config.getint('ann', 'DbPoolSize', fallback=4),
+                check_interval=config.getint('ann', 'DbPoolCheckInterval', 
+                    fallback=30))
+        return pool
+
+
+"""Borrow a pooled connection for the duration of a with block
+   A connection that raised is closed rather than returned to the pool
+"""
+@contextmanager
+def db_connection():
+    p = db_pool()
+    conn = p.get()
+    try:
+        yield conn
+    except Exception:
+        p.discard(conn)
+        raise
+    p.put(conn)
 
 
 """Column inices for pileup and VCF
@@ -0,0 +1,129 @@
+# queries.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Runs the fused pipeline over the stand-in reference (see
+# ann/standin.py) and prints, for each stage, the reference queries it
+# sent and the seconds it spent annotating. --latency adds a simulated
+# database round trip to every query, which is what batching saves on the
+# production database.
+#
+# Run it from the repository root with:
+#   python bench/queries.py                    (every stage, no latency)
+#   python bench/queries.py --latency 0.001 --stages dbSNP \
+#       --set DbSnpBatchSize=1
+#   python bench/queries.py --latency 0.001 --stages dbSNP \
+#       --set DbSnpBatchSize=500
+#   python bench/queries.py --set BigRefGeneBatchSize=1000 \
+#       --set TfbsSpanFetch=yes
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import os
+import sys
+import time
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    '..', 'ann'))
+
+import standin
+import backends
+import driver
+import pipeline
+
+"""Cursor that counts the queries sent through it and sleeps latency
+   seconds before each one
+"""
+class TimedCursor(object):
+
+    def __init__(self, cursor, latency):
+        self.cursor = cursor
+        self.latency = latency
+        self.queries = 0
+
+    def execute(self, *args):
+        self.queries = self.queries + 1
+        if (self.latency > 0):
+            time.sleep(self.latency)
+        return self.cursor.execute(*args)
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+
+"""Wraps stage.annotate so the seconds it takes are added to seconds, a
+   dict of stage name -> seconds
+"""
+def timeStage(stage, seconds):
+    annotate = stage.annotate
+    def timed(records):
+        start = time.time()
+        records = annotate(records)
+        seconds[stage.name] = seconds.get(stage.name, 0.0) + \
+            time.time() - start
+        return records
+    stage.annotate = timed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='Count the reference queries of each annotation stage')
+    parser.add_argument('--workdir',
+        help='directory for the stand-in files (default: a temporary one)')
+    parser.add_argument('--variants', type=int, default=4000)
+    parser.add_argument('--latency', type=float, default=0.0,
+        help='seconds added to every query')
+    parser.add_argument('--stages',
+        help='comma-separated stage names to run (default: all)')
+    parser.add_argument('--set', action='append', default=[],
+        metavar='KEY=VALUE', help='[ann] setting')
+    args = parser.parse_args()
+
+    workdir = args.workdir or tempfile.mkdtemp()
+    os.makedirs(workdir, exist_ok=True)
+    path = os.path.join(workdir, 'standin.db')
+    vcf = os.path.join(workdir, 'standin.vcf')
+    conn = standin.buildDatabase(path)
+    variants = standin.writeVcf(conn, vcf, n=args.variants)
+    conn.close()
+
+    settings = ['Backend=sqlite', 'SQLitePath=' + path, 'ResultCache=no',
+        'ReferenceSnapshot=', 'DbSnpBloomFile=', 'SweepTables='] + args.set
+    for setting in settings:
+        (key, value) = setting.split('=', 1)
+        driver.config.set('ann', key, value)
+        backends.config.set('ann', key, value)
+
+    names = args.stages.split(',') if args.stages else None
+    seconds = {}
+    with backends.getBackend().connection() as conn:
+        stages = driver.getStages(conn.cursor())
+        for stage in stages:
+            if (names is not None) and (stage.name not in names):
+                stage.close()
+        stages = [stage for stage in stages
+            if (names is None) or (stage.name in names)]
+        for stage in stages:
+            stage.cursor = TimedCursor(stage.cursor, args.latency)
+            timeStage(stage, seconds)
+        start = time.time()
+        pipeline.annotateFile(stages, vcf, vcf + '.annot')
+        total = time.time() - start
+
+    print(f"{variants} variants, {args.latency * 1000:.1f} ms per query")
+    for stage in stages:
+        print(f"{stage.name:<28} {stage.cursor.queries:>8} queries " +
+            f"{seconds.get(stage.name, 0.0):8.2f}s")
+        stage.close()
+    print(f"{'total':<28} " +
+        f"{sum([stage.cursor.queries for stage in stages]):>8} queries " +
+        f"{total:8.2f}s")
+
+### EOF
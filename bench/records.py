@@ -0,0 +1,100 @@
+# records.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Micro-benchmark of how the pipeline handles lines between stages, with
+# no lookups: the old strip/split/join of every line in every stage
+# against parsing each line once into a records.Record. Prints the
+# seconds each takes over the synthetic lines and the peak memory of one
+# window.
+#
+# Run it from the repository root with:
+#   python bench/records.py
+#   python bench/records.py --lines 100000 --stages 14
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import os
+import sys
+import time
+import random
+import argparse
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    '..', 'ann'))
+
+from records import Record, withChrPrefix, withoutChrPrefix, \
+    clean_mysql_chars
+
+INDS = [0, 1, 3, 4]
+
+"""n synthetic VCF data lines
+"""
+def makeLines(n, seed=1):
+    rand = random.Random(seed)
+    return ['chr%d\t%d\t.\tA\tG\t50\tPASS\tDP=%d\tGT\t0/1' %
+        (rand.randint(1, 22), rand.randint(1, 10**8), rand.randint(1, 99))
+        for i in range(n)]
+
+
+"""Every stage splits each line, builds its key and joins the line again
+   (every third stage keys on the bases too, like dbSNP)
+"""
+def splitJoin(window, stages):
+    for s in range(stages):
+        out = []
+        for line in window:
+            fields = line.strip().split('\t')
+            if (s % 3 == 0):
+                key = (withoutChrPrefix(fields[0].strip()), fields[1].strip(),
+                    clean_mysql_chars(fields[3]).strip(),
+                    clean_mysql_chars(fields[4]).strip())
+            else:
+                key = (withChrPrefix(fields[0].strip()), fields[1].strip())
+            fields[7] = fields[7] + ';x=1'
+            out.append('\t'.join(fields))
+        window = out
+    return window
+
+
+"""Each line is parsed into a Record once and written once
+"""
+def parsedOnce(window, stages):
+    records = [Record(line, INDS) for line in window]
+    for s in range(stages):
+        for record in records:
+            if (s % 3 == 0):
+                key = (record.chrom_nochr, record.pos, record.ref, record.alt)
+            else:
+                key = (record.chrom, record.pos)
+            record.info.add('x=1')
+    return [record.text() for record in records]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='Time split/join per stage against parsed records')
+    parser.add_argument('--lines', type=int, default=1000000)
+    parser.add_argument('--stages', type=int, default=14)
+    parser.add_argument('--window', type=int, default=1000)
+    args = parser.parse_args()
+
+    lines = makeLines(args.lines)
+    window = lines[:args.window]
+    assert splitJoin(window, args.stages) == parsedOnce(window, args.stages)
+    for f in [splitJoin, parsedOnce]:
+        start = time.time()
+        for i in range(0, len(lines), args.window):
+            f(lines[i:i + args.window], args.stages)
+        seconds = time.time() - start
+        tracemalloc.start()
+        f(window, args.stages)
+        (current, peak) = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print(f"{f.__name__:<12} {seconds:7.2f}s  " +
+            f"{peak / 1024:5.0f} KiB peak per window")
+
+### EOF
@@ -0,0 +1,75 @@
+# snapshot_lookups.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Times overlap lookups on a reference snapshot (see ann/snapshot.py)
+# of one synthetic table: short intervals, optionally preceded by one
+# interval spanning the whole chromosome, which a lookup that scans back
+# over earlier starts has to walk past every time.
+#
+# Run it from the repository root with:
+#   python bench/snapshot_lookups.py
+#   python bench/snapshot_lookups.py --rows 200000 --long 50000000
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import os
+import sys
+import time
+import random
+import sqlite3
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    '..', 'ann'))
+
+import snapshot
+
+"""Snapshot at path of a table t on chromosome 1: rows intervals of up to
+   2 kb over length bases, after one interval from 1 to long if long is
+   not 0
+"""
+def buildSnapshot(path, rows, length, long, seed=5):
+    rand = random.Random(seed)
+    conn = sqlite3.connect(':memory:')
+    conn.execute('create table t (chrom, chromStart, chromEnd, name)')
+    if (long > 0):
+        conn.execute("insert into t values ('chr1', 1, ?, 'long')", (long,))
+    starts = sorted([rand.randint(2, length) for i in range(rows)])
+    conn.executemany('insert into t values (?,?,?,?)',
+        [('chr1', start, start + rand.randint(0, 2000), 'r' + str(i))
+        for (i, start) in enumerate(starts)])
+    snapshot.build(conn.cursor(), path, tables=[('t', 'chrom', 'chromStart',
+        'chromEnd')], log=lambda line: None)
+    conn.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='Time overlap lookups on a snapshot table')
+    parser.add_argument('--rows', type=int, default=200000)
+    parser.add_argument('--length', type=int, default=49000000)
+    parser.add_argument('--long', type=int, default=50000000,
+        help='end of the long interval (0: none)')
+    parser.add_argument('--lookups', type=int, default=2000)
+    args = parser.parse_args()
+
+    path = os.path.join(tempfile.mkdtemp(), 'bench.snap')
+    buildSnapshot(path, args.rows, args.length, args.long)
+    table = snapshot.Snapshot(path).table('t')
+    rand = random.Random(6)
+    positions = [rand.randint(1, args.length) for i in range(args.lookups)]
+    start = time.time()
+    hits = 0
+    for pos in positions:
+        hits = hits + len(table.overlap('chr1', pos))
+    seconds = time.time() - start
+    print(f"{args.rows} rows, long interval to {args.long}: " +
+        f"{seconds / len(positions) * 1000:.3f} ms per lookup, " +
+        f"{hits / float(len(positions)):.1f} hits on average")
+    os.remove(path)
+
+### EOF
@@ -0,0 +1,162 @@
+# baseline.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Runs the annotation driver of an earlier commit over the stand-in
+# reference (see ann/standin.py) and prints the md5 of the annotated
+# file and the count log it writes. The driver of that commit talks to
+# MySQL through pymysql, so its connections are answered by the SQLite
+# stand-in here: %s placeholders become ? and the RDS secret is faked.
+#
+# With the default commit, the one every change since is checked
+# against, this prints the BASELINE digests in test_pipeline.py.
+#
+# Run it from the repository root with:
+#   python tests/baseline.py
+#   python tests/baseline.py --commit <commit>
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import os
+import sys
+import json
+import shutil
+import sqlite3
+import hashlib
+import argparse
+import tempfile
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BASELINE_COMMIT = '7545f488d09cce44ca7d8f39b6eb575e5f0f6f62'
+
+"""pymysql cursor answered by a SQLite connection
+"""
+class SQLiteCursor(object):
+
+    def __init__(self, conn):
+        self.cursor = conn.cursor()
+        self.description = None
+
+    def execute(self, sql, args=None):
+        sql = sql.replace('%%', '%')
+        if args:
+            self.cursor.execute(sql.replace('%s', '?'), args)
+        else:
+            self.cursor.execute(sql)
+        self.description = self.cursor.description
+        return 0
+
+    def fetchall(self):
+        return tuple(self.cursor.fetchall())
+
+    def fetchone(self):
+        return self.cursor.fetchone()
+
+    def fetchmany(self, size=1):
+        return tuple(self.cursor.fetchmany(size))
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+    def close(self):
+        pass
+
+
+"""pymysql connection answered by the SQLite file at path
+"""
+class SQLiteConnection(object):
+
+    def __init__(self, path):
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+
+    def cursor(self, *args, **kwargs):
+        return SQLiteCursor(self.conn)
+
+    def ping(self, reconnect=True):
+        return True
+
+    def commit(self):
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+
+"""Secrets Manager client returning a made-up RDS secret
+"""
+class FakeSecrets(object):
+
+    def get_secret_value(self, SecretId):
+        return {'SecretString': json.dumps({'host': 'localhost',
+            'port': 3306, 'username': 'ann', 'password': 'ann'})}
+
+
+"""Runs the driver in anndir over infile in this process, with pymysql
+   and the secrets client pointed at the SQLite file at path
+"""
+def runDriver(anndir, path, infile):
+    import boto3
+    import pymysql
+    connect = lambda *args, **kwargs: SQLiteConnection(path)
+    pymysql.connect = connect
+    pymysql.Connect = connect
+    client = boto3.client
+    boto3.client = lambda name, *args, **kwargs: FakeSecrets() \
+        if (name == 'secretsmanager') else client(name, *args, **kwargs)
+    sys.path.insert(0, anndir)
+    os.chdir(anndir)
+    import driver
+    driver.run(infile, 'vcf')
+
+
+"""md5 of the annotated file and the count log of infile
+"""
+def outputDigests(infile):
+    digests = []
+    for path in [infile.replace('.vcf', '.annot.vcf'), infile + '.count.log']:
+        with open(path, 'rb') as fh:
+            digests.append(hashlib.md5(fh.read()).hexdigest())
+    return digests
+
+
+if __name__ == "__main__":
+    if (len(sys.argv) > 1) and (sys.argv[1] == '--run'):
+        runDriver(sys.argv[2], sys.argv[3], sys.argv[4])
+        sys.exit(0)
+
+    parser = argparse.ArgumentParser(
+        description='Digests of an earlier driver\'s output over the ' +
+        'stand-in reference')
+    parser.add_argument('--commit', default=BASELINE_COMMIT)
+    parser.add_argument('--variants', type=int, default=4000)
+    args = parser.parse_args()
+
+    sys.path.insert(0, os.path.join(ROOT, 'ann'))
+    import standin
+
+    workdir = tempfile.mkdtemp()
+    path = os.path.join(workdir, 'standin.db')
+    infile = os.path.join(workdir, 'job~input.vcf')
+    conn = standin.buildDatabase(path)
+    standin.writeVcf(conn, infile, n=args.variants)
+    conn.close()
+
+    # The earlier tree's ann directory, unpacked from git
+    archive = subprocess.run(['git', '-C', ROOT, 'archive', args.commit,
+        'ann'], stdout=subprocess.PIPE, check=True).stdout
+    subprocess.run(['tar', '-x', '-C', workdir], input=archive, check=True)
+
+    env = dict(os.environ)
+    env['PYTHONHASHSEED'] = '0'
+    subprocess.run([sys.executable, os.path.abspath(__file__), '--run',
+        os.path.join(workdir, 'ann'), path, infile], env=env, check=True,
+        stdout=subprocess.DEVNULL)
+    (annotated, log) = outputDigests(infile)
+    shutil.rmtree(workdir)
+    print(f"annotated file {annotated}")
+    print(f"count log      {log}")
+
+### EOF
@@ -0,0 +1,34 @@
+# conftest.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Puts the annotator modules on the import path and builds the stand-in
+# reference (see ann/standin.py) once per test session
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import os
+import sys
+
+import pytest
+
+ANN = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    'ann')
+sys.path.insert(0, ANN)
+
+# Variants in the stand-in VCF; the baseline digests are for this many
+VARIANTS = 4000
+
+"""(work directory, stand-in database, stand-in VCF), built once
+"""
+@pytest.fixture(scope='session')
+def standin(tmp_path_factory):
+    import compare
+    workdir = str(tmp_path_factory.mktemp('standin'))
+    vcf = os.path.join(workdir, 'standin.vcf')
+    path = compare.getDatabase(workdir, vcf, False, VARIANTS)
+    return (workdir, path, vcf)
+
+### EOF
@@ -0,0 +1,70 @@
+# test_bloom.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Checks the dbSNP position filter built from the stand-in reference
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import random
+
+import pytest
+
+import bloom
+import backends
+import standin
+
+"""(dbSNP positions, filter path) of the stand-in, built once
+"""
+@pytest.fixture(scope='module')
+def built(standin, tmp_path_factory):
+    (workdir, path, vcf) = standin
+    outfile = str(tmp_path_factory.mktemp('bloom') / 'standin.bloom')
+    with backends.SQLiteBackend(path).connection() as conn:
+        count = bloom.buildFromCursor(conn.cursor(), outfile, fp_rate=0.01,
+            release='test')
+        rows = conn.execute('select CHR, POS from dbSNP;').fetchall()
+    assert count == len(rows)
+    return (set(rows), outfile)
+
+
+def test_no_false_negatives(built):
+    (positions, path) = built
+    filter = bloom.BloomFilter(path)
+    assert all([filter.mayContain(chr, pos) for (chr, pos) in positions])
+    filter.close()
+
+
+def test_false_positive_rate(built):
+    (positions, path) = built
+    filter = bloom.BloomFilter(path)
+    rand = random.Random(3)
+    others = [(chr, rand.randint(1, standin.CHROM_LENGTH))
+        for chr in standin.CHROMS for i in range(5000)]
+    others = [key for key in others if key not in positions]
+    hits = len([key for key in others if filter.mayContain(*key)])
+    assert hits / float(len(others)) < 0.03
+    assert filter.fpRate() < 0.02
+    filter.close()
+
+
+def test_other_release_is_ignored(built):
+    (positions, path) = built
+    bloom.filters.clear()
+    assert bloom.getFilter(path, release='other') is None
+    bloom.filters.clear()
+    assert bloom.getFilter(path, release='test') is not None
+    assert bloom.getFilter(str(path) + '.missing', release='test') is None
+    bloom.filters[path].close()
+    bloom.filters.clear()
+
+
+def test_not_a_filter(tmp_path):
+    path = tmp_path / 'junk'
+    path.write_bytes(b'\0' * 64)
+    with pytest.raises(ValueError):
+        bloom.BloomFilter(str(path))
+
+### EOF
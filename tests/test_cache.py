@@ -0,0 +1,77 @@
+# test_cache.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Checks the persistent annotation result cache
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import sqlite3
+
+import cache
+
+
+def test_get_returns_what_was_put(tmp_path):
+    results = cache.ResultCache(str(tmp_path / 'c.db'), 'r1')
+    keys = [('1', i, 'A', 'G') for i in range(500)]
+    results.put('dbSNP', keys[:300], [['DB', i] for i in range(300)])
+    results.put('hugo', [('1', 5)], ['H'])
+    found = results.get('dbSNP', keys)
+    assert found == dict([(i, ['DB', i]) for i in range(300)])
+    assert results.get('hugo', [('1', 5), ('1', 6)]) == {0: 'H'}
+    assert results.get('dbSNP', [('1', 5)]) == {}
+    assert results.get('dbSNP', []) == {}
+    results.close()
+
+
+def test_entries_outlive_the_cache_object(tmp_path):
+    path = str(tmp_path / 'c.db')
+    results = cache.ResultCache(path, 'r1')
+    results.put('dbSNP', [('1', 1, 'A', 'G')], ['DB'])
+    results.close()
+    results = cache.ResultCache(path, 'r1')
+    assert results.get('dbSNP', [('1', 1, 'A', 'G')]) == {0: 'DB'}
+    results.close()
+
+
+def test_release_change_drops_entries(tmp_path):
+    path = str(tmp_path / 'c.db')
+    results = cache.ResultCache(path, 'r1')
+    results.put('dbSNP', [('1', 1, 'A', 'G')], ['DB'])
+    results.close()
+    results = cache.ResultCache(path, 'r2')
+    assert results.get('dbSNP', [('1', 1, 'A', 'G')]) == {}
+    results.close()
+
+
+def test_hits_are_touched_on_close(tmp_path):
+    path = str(tmp_path / 'c.db')
+    results = cache.ResultCache(path, 'r1')
+    results.put('dbSNP', [('1', 1, 'A', 'G')], ['DB'])
+    before = sqlite3.connect(path).execute(
+        'select used from results;').fetchone()[0]
+    results.get('dbSNP', [('1', 1, 'A', 'G')])
+    assert len(results.touched) == 1
+    results.close()
+    after = sqlite3.connect(path).execute(
+        'select used from results;').fetchone()[0]
+    assert after >= before
+
+
+def test_least_recently_used_are_evicted(tmp_path):
+    path = str(tmp_path / 'c.db')
+    results = cache.ResultCache(path, 'r1', max_entries=100)
+    results.evict_interval = 10
+    for i in range(20):
+        results.put('hugo', [('1', i * 10 + j) for j in range(10)],
+            ['H'] * 10)
+    count = sqlite3.connect(path).execute(
+        'select count(*) from results;').fetchone()[0]
+    assert count <= 100
+    assert results.get('hugo', [('1', 199)]) == {0: 'H'}
+    assert results.get('hugo', [('1', 0)]) == {}
+    results.close()
+
+### EOF
@@ -0,0 +1,64 @@
+# test_intervals.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Checks the nested containment lists and interval indexes against a
+# scan of every interval
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import random
+
+import intervals
+
+"""n (start, end, ordinal) intervals over 0..1000, with points, nested
+   and long ones
+"""
+def randomIntervals(n, seed):
+    rand = random.Random(seed)
+    result = []
+    for i in range(n):
+        start = rand.randint(0, 1000)
+        result.append((start, start + rand.choice([0, 1, 5, 50, 500]), i))
+    return result + [(10, 900, n), (10, 900, n + 1), (300, 300, n + 2)]
+
+
+def test_nclist_point_queries():
+    ivs = randomIntervals(2000, 1)
+    nclist = intervals.NCList(ivs)
+    for pos in range(-2, 1600):
+        expected = [o for (start, end, o) in ivs if start <= pos <= end]
+        assert sorted(nclist.query(pos)) == expected
+
+
+def test_nclist_range_queries():
+    ivs = randomIntervals(500, 2)
+    nclist = intervals.NCList(ivs)
+    rand = random.Random(3)
+    for i in range(500):
+        low = rand.randint(-10, 1500)
+        high = low + rand.randint(0, 200)
+        expected = [o for (start, end, o) in ivs
+            if (start <= high) and (low <= end)]
+        assert sorted(nclist.query(low, high)) == expected
+
+
+def test_nclist_empty():
+    assert intervals.NCList([]).query(5) == []
+
+
+def test_index_keeps_table_order():
+    rows = [('1', 50, 60, 'a'), ('1', 10, 100, 'b'), ('2', 55, 55, 'c'),
+        ('1', 55, 58, 'd'), ('1', 200, 300, 'e')]
+    index = intervals.IntervalIndex(rows, 0, 1, 2)
+    assert index.overlap('1', 55) == [rows[0], rows[1], rows[3]]
+    assert index.first('1', 55) == rows[0]
+    assert index.first('1', 150) is None
+    assert index.overlap('3', 55) == []
+    assert index.range('1', 90, 250) == [rows[1], rows[4]]
+    assert index.range(None, 55, 55) == [rows[0], rows[1], rows[2], rows[3]]
+    assert index.cover('1', [(5, 12), (250, 260)]) == [rows[1], rows[4]]
+
+### EOF
@@ -0,0 +1,58 @@
+# test_pipeline.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Runs the driver over the stand-in reference in every pipeline mode and
+# reference setup of compare.py and checks the annotated file and count
+# log against a fused run, and the fused run against the baseline driver
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import pytest
+
+import compare
+from conftest import VARIANTS
+
+# md5 of the annotated file and count log the baseline driver writes over
+# the stand-in, as printed by tests/baseline.py
+BASELINE = ['2239bf6d5af22494505cea9af281c912',
+    '223603ae92f6578ef55d758c5c33c89d']
+
+RUNS = [(name, mode) for (name, rtree, settings, modes) in compare.SETUPS
+    for mode in modes]
+
+"""Digests of a fused run over the plain stand-in tables
+"""
+@pytest.fixture(scope='module')
+def reference(standin):
+    (workdir, path, vcf) = standin
+    (seconds, digests, error) = compare.runChild(workdir, 'reference', vcf,
+        'fused', compare.runSettings(path))
+    assert error == ''
+    return digests
+
+
+def test_fused_matches_baseline(reference):
+    assert reference == BASELINE
+
+
+@pytest.mark.parametrize('name,mode', RUNS,
+    ids=[name + '-' + mode for (name, mode) in RUNS])
+def test_mode_matches_fused(standin, reference, name, mode):
+    (workdir, plain, vcf) = standin
+    (rtree, settings) = [(rtree, dict(settings))
+        for (setup, rtree, settings, modes) in compare.SETUPS
+        if (setup == name)][0]
+    path = compare.getDatabase(workdir, vcf, rtree, VARIANTS)
+    for key in compare.BUILT_FILES:
+        if key in settings:
+            settings[key] = compare.getBuiltFile(workdir, path, key,
+                settings[key])
+    (seconds, digests, error) = compare.runChild(workdir, name, vcf, mode,
+        compare.runSettings(path, settings))
+    assert error == ''
+    assert digests == reference
+
+### EOF
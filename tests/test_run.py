@@ -0,0 +1,144 @@
+# test_run.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Checks the result reuse path of run.py against made-up AWS clients
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import io
+import json
+
+import pytest
+from botocore.exceptions import ClientError
+
+import run
+
+"""S3 client that records copies and puts; keys in missing do not exist
+"""
+class FakeS3(object):
+
+    def __init__(self, objects={}, missing=[]):
+        self.objects = dict(objects)
+        self.missing = missing
+        self.copies = []
+
+    def copy(self, CopySource, Bucket, Key):
+        if CopySource['Key'] in self.missing:
+            raise ClientError({'Error': {'Code': '404'}}, 'CopyObject')
+        self.copies.append((CopySource['Key'], Key))
+
+    def get_object(self, Bucket, Key):
+        if Key not in self.objects:
+            raise ClientError({'Error': {'Code': 'NoSuchKey'}}, 'GetObject')
+        return {'Body': io.BytesIO(self.objects[Key])}
+
+
+class FakeTable(object):
+
+    def __init__(self):
+        self.updates = []
+
+    def update_item(self, **kwargs):
+        self.updates.append(kwargs)
+
+
+class FakeDynamo(object):
+
+    def __init__(self):
+        self.table = FakeTable()
+
+    def Table(self, name):
+        return self.table
+
+
+class FakeSNS(object):
+
+    def __init__(self):
+        self.messages = []
+
+    def publish(self, TopicArn, Message):
+        self.messages.append(json.loads(Message))
+
+
+class FakeSQS(object):
+
+    def __init__(self):
+        self.messages = []
+
+    def get_queue_url(self, QueueName):
+        return {'QueueUrl': 'https://sqs/' + QueueName}
+
+    def send_message(self, QueueUrl, MessageBody):
+        self.messages.append(json.loads(MessageBody))
+
+
+@pytest.fixture
+def clients(monkeypatch):
+    clients = {'s3': FakeS3(), 'dynamodb': FakeDynamo(), 'sns': FakeSNS(),
+        'sqs': FakeSQS()}
+    monkeypatch.setattr(run, 'clients', clients)
+    return clients
+
+
+"""Index entry of an earlier job by another user
+"""
+def earlierEntry():
+    (annot_key, log_key) = run.result_keys('job1~input.vcf', 'user1')
+    return {'job_id': 'job1', 's3_key_result_file': annot_key,
+        's3_key_log_file': log_key}
+
+
+def test_reuse_copies_results_and_completes(clients, tmp_path):
+    infile = tmp_path / 'job2~input.vcf'
+    infile.write_text('#CHROM\n')
+    entry = earlierEntry()
+    result = run.reuse_job(str(infile), 'user2', 'u2@example.com', 'job2',
+        'abc', entry)
+
+    (annot_key, log_key) = run.result_keys('job2~input.vcf', 'user2')
+    assert clients['s3'].copies == [
+        (entry['s3_key_result_file'], annot_key),
+        (entry['s3_key_log_file'], log_key)]
+    (update,) = clients['dynamodb'].table.updates
+    assert update['Key'] == {'job_id': 'job2'}
+    assert update['ExpressionAttributeValues'][':reused_from'] == 'job1'
+    assert update['ExpressionAttributeValues'][':result_key'] == annot_key
+    assert clients['sns'].messages[0]['email'] == 'u2@example.com'
+    assert clients['sqs'].messages[0]['s3_key_result_file'] == annot_key
+    assert not infile.exists()
+    assert result['job_id'] == 'job2'
+
+
+def test_redelivered_job_copies_nothing(clients, tmp_path):
+    infile = tmp_path / 'job1~input.vcf'
+    infile.write_text('#CHROM\n')
+    run.reuse_job(str(infile), 'user1', 'u1@example.com', 'job1', 'abc',
+        earlierEntry())
+    assert clients['s3'].copies == []
+    assert len(clients['dynamodb'].table.updates) == 1
+
+
+def test_missing_results_are_annotated_again(clients, tmp_path, monkeypatch):
+    entry = earlierEntry()
+    clients['s3'].missing = [entry['s3_key_result_file']]
+    calls = []
+    monkeypatch.setattr(run, 'annotate_job',
+        lambda *args: calls.append(args) or {'job_id': args[3], 'secs': 0})
+    infile = tmp_path / 'job2~input.vcf'
+    infile.write_text('#CHROM\n')
+    run.reuse_job(str(infile), 'user2', 'u2@example.com', 'job2', 'abc',
+        entry)
+    assert calls == [(str(infile), 'user2', 'u2@example.com', 'job2', 'abc')]
+    assert clients['dynamodb'].table.updates == []
+
+
+def test_find_result(clients):
+    entry = earlierEntry()
+    assert run.find_result('abc') is None
+    clients['s3'].objects[run.index_key('abc')] = json.dumps(entry).encode()
+    assert run.find_result('abc') == entry
+
+### EOF
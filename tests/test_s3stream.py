@@ -0,0 +1,86 @@
+# test_s3stream.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Checks the streamed S3 reader against an in-memory S3 client
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import io
+import gzip
+import hashlib
+import threading
+
+import s3stream
+
+"""S3 client holding one object in memory; records the ranges asked for
+"""
+class FakeS3(object):
+
+    def __init__(self, data):
+        self.data = data
+        self.ranges = []
+        self.lock = threading.Lock()
+
+    def head_object(self, Bucket, Key):
+        return {'ContentLength': len(self.data)}
+
+    def get_object(self, Bucket, Key, Range):
+        (first, last) = [int(n) for n in Range[len('bytes='):].split('-')]
+        with self.lock:
+            self.ranges.append((first, last))
+        return {'Body': io.BytesIO(self.data[first:last + 1])}
+
+
+def vcfBytes(lines):
+    return ''.join(['1\t%d\t.\tA\tG\t50\tPASS\t.\n' % i
+        for i in range(lines)]).encode()
+
+
+def test_reads_object_in_order():
+    data = vcfBytes(5000)
+    client = FakeS3(data)
+    stream = s3stream.S3Stream(client, 'b', 'k', part_size=1000, parallel=3,
+        readahead=4)
+    assert stream.read() == data
+    assert stream.hexdigest() == hashlib.sha256(data).hexdigest()
+    assert sorted(client.ranges) == [(start, min(start + 1000, len(data)) - 1)
+        for start in range(0, len(data), 1000)]
+    stream.close()
+
+
+def test_readahead_is_bounded():
+    data = vcfBytes(5000)
+    client = FakeS3(data)
+    stream = s3stream.S3Stream(client, 'b', 'k', part_size=1000, parallel=2,
+        readahead=3)
+    stream.read(10)
+    assert len(client.ranges) <= 4
+    stream.close()
+
+
+def test_text_lines():
+    data = vcfBytes(300)
+    fh = s3stream.openText(s3stream.S3Stream(FakeS3(data), 'b', 'k',
+        part_size=100))
+    assert fh.read() == data.decode()
+    fh.close()
+
+
+def test_gzipped_text_lines():
+    data = vcfBytes(300)
+    fh = s3stream.openText(s3stream.S3Stream(FakeS3(gzip.compress(data)),
+        'b', 'k', part_size=100))
+    assert fh.readlines() == data.decode().splitlines(True)
+    fh.close()
+
+
+def test_empty_object():
+    stream = s3stream.S3Stream(FakeS3(b''), 'b', 'k')
+    assert stream.read() == b''
+    assert stream.hexdigest() == hashlib.sha256(b'').hexdigest()
+    stream.close()
+
+### EOF
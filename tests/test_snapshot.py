@@ -0,0 +1,107 @@
+# test_snapshot.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Checks overlap lookups on a reference snapshot against the range
+# queries the stages send to the database
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import random
+import sqlite3
+import struct
+
+import pytest
+
+import backends
+import snapshot
+import standin
+
+"""Snapshot of the stand-in reference, built once
+"""
+@pytest.fixture(scope='module')
+def reference(standin, tmp_path_factory):
+    (workdir, path, vcf) = standin
+    outfile = str(tmp_path_factory.mktemp('snapshot') / 'standin.snap')
+    backend = backends.SQLiteBackend(path)
+    with backend.connection() as conn:
+        snapshot.build(conn.cursor(), outfile, release='test',
+            log=lambda line: None)
+    reference = snapshot.Snapshot(outfile)
+    yield (backend, reference)
+    reference.close()
+
+
+@pytest.mark.parametrize('spec', standin.OVERLAP_TABLES)
+def test_overlap_matches_range_query(reference, spec):
+    (backend, reference) = reference
+    parts = spec.split(':')
+    chromName = parts[1] if (len(parts) > 1) else 'chrom'
+    table = reference.table(parts[0])
+    rand = random.Random(11)
+    with backend.connection() as conn:
+        cursor = conn.cursor()
+        for chrom in ['chr' + c for c in standin.CHROMS]:
+            for i in range(200):
+                pos = rand.randint(1, standin.CHROM_LENGTH)
+                expected = backend.rangeQuery(cursor, parts[0], chrom, pos,
+                    pos, chromName=chromName)
+                assert table.overlap(chrom, pos) == list(expected)
+                assert table.first(chrom, pos) == \
+                    (expected[0] if expected else None)
+
+
+def test_rows_keep_table_order(reference):
+    (backend, reference) = reference
+    with backend.connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('select * from hugo where chrom = ?;', ('chr2',))
+        expected = cursor.fetchall()
+    rows = [row for row in reference.table('hugo').rows() if row[1] == 'chr2']
+    assert rows == expected
+
+
+"""Snapshot at path of one table t of intervals (chrom, start, end, name)
+"""
+def buildTable(path, rows):
+    conn = sqlite3.connect(':memory:')
+    conn.execute('create table t (chrom, chromStart, chromEnd, name)')
+    conn.executemany('insert into t values (?, ?, ?, ?)', rows)
+    snapshot.build(conn.cursor(), path, tables=[('t', 'chrom', 'chromStart',
+        'chromEnd')], log=lambda line: None)
+    conn.close()
+
+
+def test_long_and_nested_intervals(tmp_path):
+    rand = random.Random(5)
+    rows = []
+    for i in range(3000):
+        start = rand.randint(0, 1000)
+        rows.append(('1', start, start + rand.choice([0, 1, 5, 50, 500]),
+            'r' + str(i)))
+    rows = rows + [('1', 10, 900, 'long'), ('1', 10, 900, 'long2'),
+        ('1', 300, 300, 'point'), ('1', -5, 5000, 'all')]
+    rand.shuffle(rows)
+    path = str(tmp_path / 't.snap')
+    buildTable(path, rows)
+    reference = snapshot.Snapshot(path)
+    table = reference.table('t')
+    for pos in range(-10, 1600):
+        expected = [row for row in rows if row[1] <= pos <= row[2]]
+        assert table.overlap('1', pos) == expected
+    assert table.overlap('2', 5) == []
+    reference.close()
+
+
+def test_other_format_version_is_rejected(tmp_path):
+    path = str(tmp_path / 't.snap')
+    buildTable(path, [('1', 1, 10, 'a')])
+    with open(path, 'r+b') as fh:
+        fh.seek(4)
+        fh.write(struct.pack('<I', snapshot.VERSION + 1))
+    with pytest.raises(ValueError):
+        snapshot.Snapshot(path)
+
+### EOF
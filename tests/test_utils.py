@@ -0,0 +1,122 @@
+# test_utils.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Checks the reference database connection pool with made-up connections
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import threading
+
+import pymysql
+import pytest
+
+import utils
+
+"""Connection that counts its pings and can be made to fail them
+"""
+class FakeConnection(object):
+
+    def __init__(self, n):
+        self.n = n
+        self.pings = 0
+        self.stale = False
+        self.closed = False
+
+    def ping(self, reconnect=True):
+        self.pings = self.pings + 1
+        if self.stale:
+            raise pymysql.err.OperationalError(2006, 'gone away')
+
+    def close(self):
+        self.closed = True
+
+
+class Opener(object):
+
+    def __init__(self):
+        self.opened = []
+        self.fail = False
+
+    def __call__(self):
+        if self.fail:
+            raise pymysql.err.OperationalError(2003, 'cannot connect')
+        self.opened.append(FakeConnection(len(self.opened)))
+        return self.opened[-1]
+
+
+def test_reuses_most_recent_connection():
+    opener = Opener()
+    pool = utils.ConnectionPool(size=4, connect=opener)
+    (a, b) = (pool.get(), pool.get())
+    pool.put(a)
+    pool.put(b)
+    assert pool.get() is b
+    assert pool.get() is a
+    assert len(opener.opened) == 2
+
+
+def test_blocks_when_all_in_use():
+    opener = Opener()
+    pool = utils.ConnectionPool(size=1, connect=opener)
+    conn = pool.get()
+    got = []
+    waiter = threading.Thread(target=lambda: got.append(pool.get()))
+    waiter.start()
+    waiter.join(0.2)
+    assert got == []
+    pool.put(conn)
+    waiter.join(5)
+    assert got == [conn]
+    assert len(opener.opened) == 1
+
+
+def test_stale_connection_is_replaced():
+    opener = Opener()
+    pool = utils.ConnectionPool(size=1, check_interval=0, connect=opener)
+    conn = pool.get()
+    pool.put(conn)
+    assert pool.get() is conn
+    assert conn.pings == 1
+    conn.stale = True
+    pool.put(conn)
+    fresh = pool.get()
+    assert (fresh is not conn) and conn.closed
+    assert pool.opened == 1
+
+
+def test_recent_connection_is_not_pinged():
+    opener = Opener()
+    pool = utils.ConnectionPool(size=1, check_interval=30, connect=opener)
+    conn = pool.get()
+    pool.put(conn)
+    assert pool.get() is conn
+    assert conn.pings == 0
+
+
+def test_failed_open_and_discard_free_their_slot():
+    opener = Opener()
+    pool = utils.ConnectionPool(size=1, connect=opener)
+    opener.fail = True
+    with pytest.raises(pymysql.err.OperationalError):
+        pool.get()
+    assert pool.opened == 0
+    opener.fail = False
+    conn = pool.get()
+    pool.discard(conn)
+    assert conn.closed and (pool.opened == 0)
+    assert pool.get() is not conn
+
+
+def test_close_all():
+    opener = Opener()
+    pool = utils.ConnectionPool(size=2, connect=opener)
+    (a, b) = (pool.get(), pool.get())
+    pool.put(a)
+    pool.put(b)
+    pool.closeAll()
+    assert a.closed and b.closed and (pool.opened == 0)
+
+### EOF